@@ -18,8 +18,12 @@
 """RQL library (implementation independant)."""
 __docformat__ = "restructuredtext en"
 
+from contextlib import contextmanager
 from math import log
+from random import random
+from timeit import default_timer
 
+import logging
 import sys
 import threading
 
@@ -30,6 +34,7 @@ from rql._exceptions import *
 
 
 __version__ = pkg_resources.get_distribution('rql').version
+LOGGER = logging.getLogger('rql')
 # REQUIRED_TYPES = ['String', 'Float', 'Int', 'Boolean', 'Date']
 
 
@@ -40,21 +45,38 @@ class RQLHelper(object):
       - parsing RQL strings
       - variables type resolving
       - comparison of two queries
+
+    `cartesian` tells how queries implying a cartesian product are handled
+    when checked: ignored (None), with a warning ('warn') or rejected
+    ('error'), see `rql.stcheck.RQLSTChecker`.
+
+    `trusted_check_rate` is the fraction (from 0 to 1) of queries parsed in
+    trusted mode which are fully checked anyway, for debugging purpose.
+
+    Calls and time spent in each processing stage (see `STAGES`) are counted,
+    see `stats`, and callbacks may be registered for each stage using
+    `add_hook`.
     """
+    trusted_check_rate = 0
+    # processing stages: parsing, checking (or normalization of trusted
+    # queries), annotation, solutions computation and simplification
+    STAGES = ('parse', 'check', 'annotate', 'solve', 'simplify')
 
     def __init__(self, schema, uid_func_mapping=None, special_relations=None,
-                 resolver_class=None, backend=None):
+                 resolver_class=None, backend=None, cartesian=None):
         # chech schema
         # for e_type in REQUIRED_TYPES:
         #    if not schema.has_entity(e_type):
         #        raise MissingType(e_type)
         # create helpers
-        from rql.stcheck import RQLSTChecker, RQLSTAnnotator
+        from rql.stcheck import RQLSTChecker, RQLSTNormalizer, RQLSTAnnotator
         special_relations = special_relations or {}
         if uid_func_mapping:
             for key in uid_func_mapping:
                 special_relations[key] = 'uid'
-        self._checker = RQLSTChecker(schema, special_relations, backend)
+        self._checker = RQLSTChecker(schema, special_relations, backend,
+                                     cartesian)
+        self._normalizer = RQLSTNormalizer(schema, special_relations)
         self._annotator = RQLSTAnnotator(schema, special_relations)
         self._analyser_lock = threading.Lock()
         if resolver_class is None:
@@ -65,7 +87,12 @@ class RQLHelper(object):
         from rql.analyze import ETypeResolverIgnoreTypeRestriction
         self._itr_analyser_lock = threading.Lock()
         self._itr_analyser = ETypeResolverIgnoreTypeRestriction(schema, uid_func_mapping)
+        from rql.cost import CostEstimator
+        self._cost_estimator = CostEstimator(schema)
         self.set_schema(schema)
+        from rql.utils import StageCounter
+        self._counters = dict((stage, StageCounter()) for stage in self.STAGES)
+        self._hooks = {}
 
     def set_schema(self, schema):
         from rql.utils import is_keyword
@@ -78,8 +105,10 @@ class RQLHelper(object):
             if is_keyword(rtype):
                 raise UsesReservedWord(rtype)
         self._checker.schema = schema
+        self._normalizer.schema = schema
         self._annotator.schema = schema
         self._analyser.set_schema(schema)
+        self._cost_estimator.schema = schema
 
     def get_backend(self):
         return self._checker.backend
@@ -88,17 +117,115 @@ class RQLHelper(object):
         self._checker.backend = backend
     backend = property(get_backend, set_backend)
 
-    def parse(self, rqlstring, annotate=True):
-        """Return a syntax tree created from a RQL string."""
-        rqlst = parse(rqlstring, False)
-        self._checker.check(rqlst)
+    # instrumentation #########################################################
+
+    def add_hook(self, stage, callback):
+        """Register a callback called after each run of the given processing
+        stage (one of `STAGES`) as
+        `callback(stage, rqlst, duration, size, error)`, where `duration` is
+        in seconds and `size` is the length of the RQL string for the 'parse'
+        stage, the number of solutions for the 'solve' stage and the number of
+        variables of the tree for other stages. `error` is the exception
+        raised by the stage if it failed, else None (`rqlst` and `size` are
+        None when parsing failed). Exceptions raised by callbacks after a
+        failure are logged, the stage's exception being propagated.
+        """
+        if stage not in self.STAGES:
+            raise ValueError('unknown stage %r' % stage)
+        self._hooks.setdefault(stage, []).append(callback)
+
+    def remove_hook(self, stage, callback):
+        """Unregister a callback registered using `add_hook`."""
+        self._hooks[stage].remove(callback)
+        if not self._hooks[stage]:
+            del self._hooks[stage]
+
+    def stats(self, reset=False):
+        """Return a dictionary with, for each processing stage, a dictionary
+        with the number of runs ('count'), of failed runs ('errors'), total
+        and maximal time spent in seconds ('total', 'max') and an histogram
+        of durations ('histogram', see `rql.utils.DURATION_BUCKETS`).
+
+        If `reset` is true, counters are reset.
+        """
+        stats = dict((stage, counter.as_dict())
+                     for stage, counter in self._counters.items())
+        if reset:
+            from rql.utils import StageCounter
+            self._counters = dict((stage, StageCounter()) for stage in self.STAGES)
+        return stats
+
+    def log_slow_queries(self, threshold, sink=None):
+        """Report queries whose type resolution takes more than `threshold`
+        seconds (None to disable) with solver statistics, see
+        `rql.analyze.ETypeResolver.log_slow_queries`.
+        """
+        self._analyser.log_slow_queries(threshold, sink)
+        self._itr_analyser.log_slow_queries(threshold, sink)
+
+    @contextmanager
+    def _stage(self, stage, rqlst):
+        """time the processing stage run in the with block, whether it fails or
+        not, see `_stage_done`
+        """
+        start = default_timer()
+        try:
+            yield
+        except Exception as exc:
+            self._stage_done(stage, start, rqlst, error=exc)
+            raise
+        self._stage_done(stage, start, rqlst)
+
+    def _stage_done(self, stage, start, rqlst, size=None, error=None):
+        duration = default_timer() - start
+        self._counters[stage].add(duration, error is not None)
+        hooks = self._hooks.get(stage)
+        if hooks:
+            if size is None and rqlst is not None:
+                if stage == 'solve':
+                    size = _nb_solutions(rqlst)
+                else:
+                    size = _nb_variables(rqlst)
+            for callback in hooks:
+                if error is None:
+                    callback(stage, rqlst, duration, size, None)
+                    continue
+                # don't hide the stage's exception
+                try:
+                    callback(stage, rqlst, duration, size, error)
+                except Exception:
+                    LOGGER.exception('error in %s hook %r', stage, callback)
+
+    # processing ##############################################################
+
+    def parse(self, rqlstring, annotate=True, trusted=False):
+        """Return a syntax tree created from a RQL string.
+
+        If `trusted` is true, the query is considered as already validated:
+        semantic checks are skipped and only the tree rewriting needed by
+        further processing is done.
+        """
+        start = default_timer()
+        try:
+            rqlst = parse(rqlstring, False)
+        except Exception as exc:
+            self._stage_done('parse', start, None, error=exc)
+            raise
+        self._stage_done('parse', start, rqlst, len(rqlstring))
+        with self._stage('check', rqlst):
+            if trusted and not (self.trusted_check_rate
+                                and random() < self.trusted_check_rate):
+                self._normalizer.check(rqlst)
+            else:
+                self._checker.check(rqlst)
         if annotate:
             self.annotate(rqlst)
         rqlst.schema = self._annotator.schema
         return rqlst
 
     def annotate(self, rqlst):
-        self._annotator.annotate(rqlst)
+        with self._stage('annotate', rqlst):
+            self._annotator.annotate(rqlst)
 
     def compute_solutions(self, rqlst, uid_func_mapping=None, kwargs=None,
                           debug=False):
@@ -107,7 +234,7 @@ class RQLHelper(object):
         Each solution is a dictionary with variable's name as key and
         variable's type as value.
         """
-        with self._analyser_lock:
+        with self._stage('solve', rqlst), self._analyser_lock:
             return self._analyser.visit(rqlst, uid_func_mapping, kwargs,
                                         debug)
 
@@ -116,7 +243,7 @@ class RQLHelper(object):
         """compute syntax tree solutions with all types restriction (eg
         is/instance_of relations) ignored
         """
-        with self._itr_analyser_lock:
+        with self._stage('solve', rqlst), self._itr_analyser_lock:
             self._itr_analyser.visit(rqlst, uid_func_mapping, kwargs,
                                      debug)
 
@@ -127,9 +254,73 @@ class RQLHelper(object):
         The tree is modified in-place.
         """
         # print('simplify', rqlst.as_string())
-        if rqlst.TYPE == 'select':
-            for select in rqlst.children:
-                self._simplify(select)
+        with self._stage('simplify', rqlst):
+            if rqlst.TYPE == 'select':
+                for select in rqlst.children:
+                    self._simplify(select)
+
+    def fold_constants(self, rqlst, kwargs=None):
+        """Replace, in place, constant math expressions and calls to pure
+        functions by the resulting constant, see `rql.optimize.fold_constants`.
+        Substitutions are considered as constants only if `kwargs` is given.
+        """
+        from rql.optimize import fold_constants
+        return fold_constants(rqlst, kwargs)
+
+    def optimize_restrictions(self, rqlst, kwargs=None):
+        """Rewrite restrictions of `rqlst` in place: disjunctions of
+        equalities on the same variable and relation are merged into IN
+        restrictions and duplicated relations are removed. If the tree has
+        been solved, type restrictions which don't change its solutions are
+        removed too. See `rql.optimize` for details.
+
+        The tree is annotated again (and solved again if it was) when
+        modified. Return the number of rewritings.
+        """
+        from rql import optimize
+        solved = bool(_nb_solutions(rqlst))
+
+        def resolve(rqlst):
+            self.annotate(rqlst)
+            if solved:
+                self.compute_solutions(rqlst, kwargs=kwargs)
+        nbrewritten = optimize.merge_equality_disjunctions(rqlst)
+        nbrewritten += optimize.remove_duplicate_restrictions(rqlst)
+        if nbrewritten:
+            resolve(rqlst)
+        if solved:
+            nbrewritten += optimize.remove_redundant_type_restrictions(
+                rqlst, resolve)
+        return nbrewritten
+
+    def push_down_restrictions(self, rqlst, kwargs=None):
+        """Move restrictions of subqueries column aliases into each select of
+        the subquery, see `rql.optimize.push_down_restrictions`. The tree is
+        solved beforehand if necessary, then annotated and solved again when
+        modified. Return the number of moved restrictions.
+        """
+        from rql.optimize import push_down_restrictions
+        if not _nb_solutions(rqlst):
+            self.compute_solutions(rqlst, kwargs=kwargs)
+        nbpushed = push_down_restrictions(rqlst)
+        if nbpushed:
+            self.annotate(rqlst)
+            self.compute_solutions(rqlst, kwargs=kwargs)
+        return nbpushed
+
+    def push_down_limit(self, rqlst):
+        """Copy the LIMIT (and sort order) of selects wrapping an union into
+        each select of the union, see `rql.optimize.push_down_limit`. Return
+        the number of limited selects.
+        """
+        from rql.optimize import push_down_limit
+        return push_down_limit(rqlst)
+
+    def estimate_cost(self, rqlst):
+        """Return a (score, breakdown) tuple estimating the cost of the given
+        annotated and solved select query, see `rql.cost.CostEstimator`.
+        """
+        return self._cost_estimator.estimate(rqlst)
 
     def _simplify(self, select):
         # recurse on subqueries first
@@ -160,6 +351,7 @@ class RQLHelper(object):
                                 )
                                 select.selection[index] = rhs
                                 rhs.parent = select
+                                select.invalidate_nodes_index()
                             else:
                                 vref.parent.replace(vref, rhs)
                         elif any(term.is_equivalent(o) for o in select.orderby):
@@ -172,6 +364,7 @@ class RQLHelper(object):
                             rhs = copy_uid_node(select, rhs, vconsts)
                             select.groupby[select.groupby.index(vref)] = rhs
                             rhs.parent = select
+                            select.invalidate_nodes_index()
                     elif rel is uidrel:
                         uidrel.parent.remove(uidrel)
                     elif rel.is_types_restriction():
@@ -197,6 +390,20 @@ class RQLHelper(object):
         return compare_tree(self.parse(rqlstring1), self.parse(rqlstring2))
 
 
+def _statements(rqlst):
+    if rqlst.TYPE == 'select':
+        return rqlst.children
+    return (rqlst,)
+
+
+def _nb_variables(rqlst):
+    return sum(len(stmt.defined_vars) for stmt in _statements(rqlst))
+
+
+def _nb_solutions(rqlst):
+    return sum(len(stmt.solutions) for stmt in _statements(rqlst))
+
+
 def copy_uid_node(select, node, vconsts):
     node = node.copy(select)
     node.uid = True
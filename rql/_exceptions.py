@@ -46,3 +46,15 @@ class BadRQLQuery(RQLException):
 
 class CoercionError(RQLException):
     """Failed to infer type of a math expression."""
+
+
+class FrozenTreeError(RQLException):
+    """Raised when trying to modify a frozen syntax tree."""
+
+
+class UndoError(RQLException):
+    """Raised when a saved state can't be recovered anymore."""
+
+
+class CartesianProductWarning(UserWarning):
+    """Warning emitted when a query implies a cartesian product."""
@@ -22,12 +22,15 @@ from __future__ import print_function
 
 __docformat__ = "restructuredtext en"
 
+import logging
 import os
+from timeit import default_timer
 
 from six import StringIO, string_types
 from six.moves import zip
 
 from rql import TypeResolverException, nodes
+from rql.utils import visitor_handler
 
 
 try:
@@ -44,8 +47,12 @@ except ImportError:
     # Gecode solver not available
 # rql_solve = None # uncomment to force using logilab-constraint
 
+LOGGER = logging.getLogger('rql.analyze')
+
 
 class ConstraintCSPProblem(object):
+    backend = 'logilab'
+
     def __init__(self):
         self.constraints = []
         self.domains = {}
@@ -67,12 +74,13 @@ class ConstraintCSPProblem(object):
     def solve(self):
         repo = Repository(self.domains.keys(), self.domains, self.get_constraints())
         solver = Solver(printer=self.printer)
-        # used for timing
-        # import time
-        # t0=time.time()
-        sols = solver.solve(repo, verbose=(True or self.debug))
-        # print("RUNTIME:", time.time()-t0)
-        return sols
+        return solver.solve(repo, verbose=(True or self.debug))
+
+    def domain_sizes(self):
+        return dict((name, domain.size()) for name, domain in self.domains.items())
+
+    def nb_constraints(self):
+        return len(self.constraints)
 
     def add_var(self, name, values):
         self.domains[name] = fd.FiniteDomain(values)
@@ -159,6 +167,7 @@ class GecodeCSPProblem(object):
     but it should be fixed anyways.
     When fixing that we should also replace string nodes by integers
     """
+    backend = 'gecode'
 
     def __init__(self):
         self.constraints = []
@@ -199,11 +208,6 @@ class GecodeCSPProblem(object):
 
     def solve(self):
         constraints = self.op
-
-        # used for timing
-        # import time
-        # t0=time.time()
-
         sols = rql_solve.solve(self.idx_domains, len(self.all_values), constraints)
         rql_sols = []
         for s in sols:
@@ -211,9 +215,14 @@ class GecodeCSPProblem(object):
             for var, val in zip(self.ivariables, s):
                 r[var] = self.all_values[val]
             rql_sols.append(r)
-        # print("RUNTIME:", time.time()-t0)
         return rql_sols
 
+    def domain_sizes(self):
+        return dict((name, len(values)) for name, values in self.domains.items())
+
+    def nb_constraints(self):
+        return len(self.op) - 1
+
     def add_var(self, name, values):
         assert name not in self.variables
         self.all_values.update(values)
@@ -292,6 +301,18 @@ else:
 # CSPProblem = ConstraintCSPProblem
 
 
+def log_slow_query(record):
+    """Default sink of slow queries records, see `ETypeResolver.log_slow_queries`,
+    logging them as warnings of the 'rql.analyze' logger.
+    """
+    LOGGER.warning('slow type resolution (%.3fs: init %.3fs, extraction %.3fs, '
+                   '%s solve %.3fs) of %s variables, %s constraints, '
+                   '%s solutions: %s', record['time'], record['init'],
+                   record['extract'], record['backend'], record['solve'],
+                   record['variables'], record['constraints'],
+                   record['solutions'], record['rql'])
+
+
 class ETypeResolver(object):
     """Resolve variables types according to the schema.
 
@@ -301,6 +322,13 @@ class ETypeResolver(object):
      * constraints <-> relations between (RQL) variables
     """
     var_solkey = 'possibletypes'
+    # type resolution taking more than this number of seconds is reported to
+    # `slow_query_sink`, see `log_slow_queries`
+    slow_query_threshold = None
+    slow_query_sink = staticmethod(log_slow_query)
+    # statistics of the solver for the query being resolved, only collected
+    # when slow queries are logged
+    _solver_stats = None
 
     def __init__(self, schema, uid_func_mapping=None):
         """
@@ -329,6 +357,28 @@ class ETypeResolver(object):
         self._nonfinal_domain = set(str(etype) for etype in schema.entities()
                                     if not etype.final)
 
+    def log_slow_queries(self, threshold, sink=None):
+        """Report queries whose type resolution takes more than `threshold`
+        seconds (None to disable) to `sink`, a callable taking a dictionary
+        with the following keys:
+
+        * 'rql', the query,
+        * 'backend', the solver used ('gecode' or 'logilab'),
+        * 'time', total time spent,
+        * 'init', 'extract', 'solve', time spent to initialize CSP problems,
+          to extract constraints from the tree and to solve them,
+        * 'variables', 'constraints', 'solutions', number of variables,
+          constraints and solutions,
+        * 'domains', list of dictionaries of domain size by variable name,
+          one for each resolved statement.
+
+        Numbers and times are summed over all statements of the query (unions
+        and subqueries). Records are logged by default (see `log_slow_query`).
+        """
+        self.slow_query_threshold = threshold
+        if sink is not None:
+            self.slow_query_sink = sink
+
     def solve(self, node, constraints):
         # debug info
         if self.debug > 1:
@@ -337,7 +387,18 @@ class ETypeResolver(object):
             print("CONSTRAINTS:")
             constraints.debug()
 
+        stats = self._solver_stats
+        if stats is not None:
+            start = default_timer()
+            stats['extract'] += start - stats.pop('_extract_start')
+            domains = constraints.domain_sizes()
+            stats['domains'].append(domains)
+            stats['variables'] += len(domains)
+            stats['constraints'] += constraints.nb_constraints()
         sols = constraints.solve()
+        if stats is not None:
+            stats['solve'] += default_timer() - start
+            stats['solutions'] += len(sols or ())
 
         if not sols:
             rql = node.as_string(kwargs=self.kwargs)
@@ -353,10 +414,10 @@ class ETypeResolver(object):
             * node: rql node to process
             * constraints: a XxxCSPProblem object.
         """
-        func = getattr(self, 'visit_%s' % node.__class__.__name__.lower())
+        func = visitor_handler(self, node)
         if constraints is None:
-            func(node)
-        elif func(node, constraints) is None:
+            func(self, node)
+        elif func(self, node, constraints) is None:
             for c in node.children:
                 self._visit(c, constraints)
 
@@ -371,10 +432,16 @@ class ETypeResolver(object):
         return types
 
     def _init_stmt(self, node):
+        stats = self._solver_stats
+        if stats is not None:
+            start = default_timer()
         pb = CSPProblem()
         # set domain for all the variables
         for var in node.defined_vars.values():
             pb.add_var(var.name, self._base_domain)
+        if stats is not None:
+            stats['_extract_start'] = end = default_timer()
+            stats['init'] += end - start
         # no variable short cut
         return pb
 
@@ -398,12 +465,42 @@ class ETypeResolver(object):
             self.uid_func = next(iter(uid_func_mapping.values()))
         self.kwargs = kwargs
         self.deambiguifiers = set()
-        self._visit(node)
+        if self.slow_query_threshold is None:
+            self._visit(node)
+        else:
+            self._timed_visit(node)
         if uid_func_mapping is not None:
             self.uid_func_mapping = None
             self.uid_func = None
         return self.deambiguifiers
 
+    def _timed_visit(self, node):
+        self._solver_stats = stats = {
+            'init': 0., 'extract': 0., 'solve': 0., 'variables': 0,
+            'constraints': 0, 'solutions': 0, 'domains': []}
+        start = default_timer()
+        try:
+            self._visit(node)
+        except Exception:
+            # don't hide the resolution error
+            try:
+                self._report_slow_query(node, stats, start)
+            except Exception:
+                LOGGER.exception('error while reporting slow type resolution')
+            raise
+        finally:
+            self._solver_stats = None
+        self._report_slow_query(node, stats, start)
+
+    def _report_slow_query(self, node, stats, start):
+        duration = default_timer() - start
+        if duration >= self.slow_query_threshold:
+            stats.pop('_extract_start', None)
+            stats['time'] = duration
+            stats['backend'] = CSPProblem.backend
+            stats['rql'] = node.as_string()
+            self.slow_query_sink(stats)
+
     def visit_union(self, node):
         for select in node.children:
             self._visit(select)
@@ -24,11 +24,50 @@ __docformat__ = "restructuredtext en"
 
 import sys
 
+from six.moves import range
+
 from rql.utils import VisitableMixIn
 
 
+def combine_fingerprints(label, fingerprints):
+    """Return the fingerprint of a node given its label and the fingerprints
+    of its children.
+
+    A fingerprint is a (hash, variable names) tuple, where variable names are
+    the names of variables used in the subtree in order of first occurrence.
+    Children hashes are combined with the index of their variables among the
+    node's variables, so that hashes only depend on variables identity, not on
+    their names.
+    """
+    varnames = []
+    varindex = {}
+    hashes = []
+    for fhash, fvarnames in fingerprints:
+        indices = []
+        for varname in fvarnames:
+            try:
+                indices.append(varindex[varname])
+            except KeyError:
+                varindex[varname] = len(varnames)
+                indices.append(len(varnames))
+                varnames.append(varname)
+        hashes.append((fhash, tuple(indices)))
+    return hash((label, tuple(hashes))), tuple(varnames)
+
+
 class BaseNode(VisitableMixIn):
-    __slots__ = ('parent',)
+    # `_position` is the index of the node in its parent's children, kept by
+    # `Node` edition methods (see `Node.child_index`)
+    __slots__ = ('parent', '_position')
+    # true on nodes of frozen syntax tree (see `Statement.freeze`)
+    frozen = False
+
+    @property
+    def _thawed_class(self):
+        """Return the class to use for copies of this node, which differs from
+        the node's class for nodes of frozen trees.
+        """
+        return self.__class__
 
     def __str__(self):
         s = self.as_string()
@@ -99,7 +138,9 @@ class BaseNode(VisitableMixIn):
                 stack += node.children
 
     def is_equivalent(self, other):
-        if other.__class__ is not self.__class__:
+        # compare thawed classes so that frozen trees (see `Statement.freeze`)
+        # are equivalent to their mutable counterpart
+        if other._thawed_class is not self._thawed_class:
             return False
         for i, child in enumerate(self.children):
             try:
@@ -109,25 +150,104 @@ class BaseNode(VisitableMixIn):
                 return False
         return True
 
+    def fingerprint(self, abstract_constants=False):
+        """Return a structural hash of the subtree.
+
+        The hash covers nodes type and attributes (relation type, operator,
+        constants...) and variables identity by order of first occurrence, so
+        that trees which only differ by variables naming get the same
+        fingerprint. If `abstract_constants` is true, constant values are not
+        considered, only their type.
+
+        Fingerprints are cached on nodes and invalidated by methods modifying
+        the tree. Like `hash()`, they are only meaningful inside a process and
+        distinct trees may get the same fingerprint, though it's unlikely.
+        """
+        return self._fingerprint(abstract_constants)[0]
+
+    def _fingerprint(self, abstract_constants):
+        return combine_fingerprints(
+            self._fingerprint_label(abstract_constants),
+            [child._fingerprint(abstract_constants) for child in self.children])
+
+    def _fingerprint_label(self, abstract_constants):
+        """Return a hashable label of this node (children excluded) for
+        fingerprint computation.
+        """
+        return self._thawed_class.__name__
+
+    def invalidate_fingerprint(self):
+        """Forget fingerprints cached for this node and its ancestors.
+
+        This is done by methods modifying the tree, and should be called when a
+        node's attributes are modified directly.
+        """
+        node = self
+        while node is not None:
+            try:
+                if node._fpcache is None:
+                    break
+                node._fpcache = None
+            except AttributeError:
+                pass  # node without fingerprint cache
+            node = getattr(node, 'parent', None)
+
+    def invalidate_nodes_index(self):
+        """Forget node indexes maintained by statements containing this node
+        (see :meth:`rql.stmts.Statement.get_nodes`), and column descriptions
+        cached by unions containing it (see
+        :meth:`rql.stmts.Union.get_description`).
+
+        This is done by methods modifying the tree structure, and should be
+        called when children of a node are modified directly.
+        """
+        node = self
+        while node is not None:
+            if getattr(node, '_nodes_index', None) is not None:
+                node._nodes_index = None
+            if getattr(node, '_descriptions', None) is not None:
+                node._descriptions = None
+            node = getattr(node, 'parent', None)
+
+    def invalidate_descriptions(self):
+        """Forget column descriptions cached by unions containing this node
+        (see :meth:`rql.stmts.Union.get_description`).
+
+        This is done when solutions or annotations of the tree change.
+        """
+        node = self
+        while node is not None:
+            if getattr(node, '_descriptions', None) is not None:
+                node._descriptions = None
+            node = getattr(node, 'parent', None)
+
+    def child_index(self, child):
+        """Return the index of the given node in this node's children."""
+        return self.children.index(child)
+
     def index_path(self):
-        if self.parent is None:
-            return []
-        myindex = self.parent.children.index(self)
-        parentindexpath = self.parent.index_path()
-        parentindexpath.append(myindex)
-        return parentindexpath
+        path = []
+        node = self
+        parent = node.parent
+        while parent is not None:
+            path.append(parent.child_index(node))
+            node = parent
+            parent = node.parent
+        path.reverse()
+        return path
 
     def go_to_index_path(self, path):
-        if not path:
-            return self
-        return self.children[path[0]].go_to_index_path(path[1:])
+        node = self
+        for index in path:
+            node = node.children[index]
+        return node
 
     def copy(self, stmt):
         """Create and return a copy of this node and its descendant.
 
         stmt is the root node, which should be use to get new variables
         """
-        new = self.__class__(*self.initargs(stmt))
+        new = self._thawed_class(*self.initargs(stmt))
         for child in self.children:
             new.append(child.copy(stmt))
         return new
@@ -135,38 +255,88 @@ class BaseNode(VisitableMixIn):
 
 class Node(BaseNode):
     """Class for nodes of the tree which may have children (almost all...)"""
-    __slots__ = ('children',)
+    __slots__ = ('children', '_fpcache')
 
     def __init__(self):
         self.parent = None
         self.children = []
+        self._fpcache = None
+
+    def _fingerprint(self, abstract_constants):
+        cache = self._fpcache
+        if cache is None:
+            if self.frozen:
+                # caches of frozen trees are filled by `Statement.freeze` and
+                # never written afterwards
+                return BaseNode._fingerprint(self, abstract_constants)
+            cache = self._fpcache = {}
+        try:
+            return cache[abstract_constants]
+        except KeyError:
+            fingerprint = BaseNode._fingerprint(self, abstract_constants)
+            if not self.frozen:
+                cache[abstract_constants] = fingerprint
+            return fingerprint
+
+    def child_index(self, child):
+        """Return the index of the given node in this node's children, using
+        the position recorded on the child when it's up to date.
+        """
+        children = self.children
+        try:
+            index = child._position
+            if children[index] is child:
+                return index
+        except (AttributeError, IndexError):
+            pass  # position not set or outdated
+        return children.index(child)
+
+    def _update_positions(self, start):
+        children = self.children
+        for index in range(start, len(children)):
+            children[index]._position = index
 
     def append(self, child):
         """add a node to children"""
+        child._position = len(self.children)
         self.children.append(child)
         child.parent = self
+        if self._fpcache is not None:
+            self.invalidate_fingerprint()
+        self.invalidate_nodes_index()
 
     def remove(self, child):
         """Remove a child node. Return the removed node, its old parent and
         index in the children list.
         """
-        index = self.children.index(child)
+        index = self.child_index(child)
         del self.children[index]
+        self._update_positions(index)
         parent = child.parent
         child.parent = None
+        if self._fpcache is not None:
+            self.invalidate_fingerprint()
+        self.invalidate_nodes_index()
         return child, parent, index
 
     def insert(self, index, child):
         """insert a child node"""
         self.children.insert(index, child)
+        self._update_positions(max(index, 0))
         child.parent = self
+        if self._fpcache is not None:
+            self.invalidate_fingerprint()
+        self.invalidate_nodes_index()
 
     def replace(self, old_child, new_child):
         """replace a child node with another"""
-        i = self.children.index(old_child)
-        self.children.pop(i)
-        self.children.insert(i, new_child)
+        i = self.child_index(old_child)
+        self.children[i] = new_child
+        new_child._position = i
         new_child.parent = self
+        if self._fpcache is not None:
+            self.invalidate_fingerprint()
+        self.invalidate_nodes_index()
         return old_child, self, i
 
 
@@ -182,7 +352,7 @@ class BinaryNode(Node):
 
     def remove(self, child):
         """Remove the child and replace this node with the other child."""
-        index = self.children.index(child)
+        index = self.child_index(child)
         return self.parent.replace(self, self.children[not index])
 
     def get_parts(self):
@@ -203,4 +373,4 @@ class LeafNode(BaseNode):
 
         stmt is the root node, which should be use to get new variables.
         """
-        return self.__class__(*self.initargs(stmt))
+        return self._thawed_class(*self.initargs(stmt))
@@ -23,9 +23,16 @@ from __future__ import print_function
 __docformat__ = "restructuredtext en"
 
 
+from hashlib import sha1
+
+from six import text_type
 from six.moves import range
 
-from rql.nodes import VariableRef, Variable, Function, Relation, Comparison
+from rql import CoercionError
+from rql.nodes import (VariableRef, Variable, Function, Relation, Comparison,
+                       Constant, MathExpression, UnaryExpression, And, Or,
+                       SubQuery)
+from rql.utils import rqlvar_maker
 
 
 def compare_tree(request1, request2):
@@ -220,3 +227,323 @@ def make_rhs_reminder(rhs, canon):
     except AttributeError:
         pass
     return (rhs.operator, child)
+
+
+# canonical form ##############################################################
+
+def canonical_form(rqlst):
+    """Return a canonical string representation of a syntax tree, such that
+    queries only differing by variables naming, restrictions order, IN
+    function arguments order or commutative operands order get the same
+    representation. The tree is not modified.
+
+    Unions and subqueries are supported. Other variables than selected ones
+    are named according to the restrictions they are used in, and may not be
+    canonical for unusual symmetric queries.
+    """
+    return RQLCanonicalFormBuilder().render(rqlst)
+
+
+def canonical_fingerprint(rqlst):
+    """Return an hexadecimal digest of the canonical form of a syntax tree,
+    suitable for grouping equivalent queries.
+    """
+    form = canonical_form(rqlst)
+    if isinstance(form, text_type):
+        form = form.encode('utf-8')
+    return sha1(form).hexdigest()
+
+
+def _not_string(node):
+    """return True if `node` is known not to be a string, according to every
+    solution of its statement, or else to the schema
+    """
+    solutions = getattr(node.stmt, 'solutions', None)
+    if solutions:
+        for solution in solutions:
+            try:
+                ntype = node.get_type(solution)
+            except (CoercionError, KeyError):
+                return False
+            if ntype in (None, 'Any', 'String', 'Password'):
+                return False
+        return True
+    if isinstance(node, Constant):
+        return node.type not in (None, 'String', 'Substitute')
+    if isinstance(node, (MathExpression, UnaryExpression)):
+        return all(_not_string(child) for child in node.children)
+    if isinstance(node, Function):
+        return node.get_type() not in ('Any', 'String', 'Password')
+    if isinstance(node, VariableRef) and isinstance(node.variable, Variable):
+        return _not_string_variable(node.variable)
+    return False
+
+
+def _not_string_variable(var):
+    """return True if `var` is the object of a relation whose object types,
+    according to the schema, aren't strings
+    """
+    schema = var.schema
+    if schema is None:
+        return False
+    for relation in var.stinfo.get('rhsrelations', ()):
+        try:
+            otypes = schema.rschema(relation.r_type).objects()
+        except KeyError:
+            continue
+        return not any(str(otype) in ('String', 'Password') for otype in otypes)
+    return False
+
+
+def _conjuncts(node, result):
+    """fill result with operands of the AND expression `node`"""
+    if isinstance(node, And):
+        for child in node.children:
+            _conjuncts(child, result)
+    else:
+        result.append(node)
+    return result
+
+
+def _variables(node):
+    """return names of variables used in `node` in order of first occurrence,
+    excluding those from subqueries
+    """
+    result = []
+    if isinstance(node, SubQuery):
+        stack = list(reversed(node.aliases))
+    else:
+        stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, VariableRef):
+            if node.name not in result:
+                result.append(node.name)
+        elif not isinstance(node, SubQuery):
+            stack += reversed(node.children)
+    return result
+
+
+class RQLCanonicalFormBuilder(object):
+    """Build the canonical string representation of a syntax tree (see
+    :func:`canonical_form`).
+    """
+
+    def render(self, node, names=None):
+        return node.accept(self, names)
+
+    def _render_all(self, nodes, names):
+        return [node.accept(self, names) for node in nodes]
+
+    def _name_variables(self, selected, atoms):
+        """return a dictionary mapping variable names to canonical names.
+
+        `selected` variables are named first, in order. Others are iteratively
+        classified according to the rendering of the `atoms` (restriction
+        terms...) they are used in, until classes are stable.
+        """
+        varmaker = rqlvar_maker()
+        names = {}
+        for varname in selected:
+            if varname not in names:
+                names[varname] = next(varmaker)
+        atoms = [(atom, _variables(atom)) for atom in atoms]
+        unnamed = []
+        for atom, varnames in atoms:
+            for varname in varnames:
+                if varname not in names and varname not in unnamed:
+                    unnamed.append(varname)
+        ranks = dict.fromkeys(unnamed, 0)
+        nbclasses = 1
+        while unnamed:
+            current = dict(names)
+            for varname in unnamed:
+                current[varname] = '?%s' % ranks[varname]
+            signatures = dict((varname, []) for varname in unnamed)
+            for atom, varnames in atoms:
+                for varname in varnames:
+                    if varname in signatures:
+                        label = current[varname]
+                        current[varname] = '*'
+                        signatures[varname].append(self.render(atom, current))
+                        current[varname] = label
+            for varname in unnamed:
+                signatures[varname] = (ranks[varname],
+                                       sorted(signatures[varname]))
+            classes = sorted(set((rank, tuple(sig))
+                                 for rank, sig in signatures.values()))
+            classes = dict((sig, i) for i, sig in enumerate(classes))
+            for varname in unnamed:
+                rank, sig = signatures[varname]
+                ranks[varname] = classes[(rank, tuple(sig))]
+            if len(classes) == nbclasses:
+                break
+            nbclasses = len(classes)
+        # variables of the same class are named in order of first occurrence
+        for varname in sorted(unnamed, key=ranks.__getitem__):
+            names[varname] = next(varmaker)
+        return names
+
+    def _where_atoms(self, stmt):
+        atoms = []
+        if stmt.where is not None:
+            _conjuncts(stmt.where, atoms)
+        atoms += stmt.having
+        return atoms
+
+    def _where_parts(self, stmt, names):
+        parts = []
+        if stmt.where is not None:
+            parts.append('WHERE ' + self.render(stmt.where, names))
+        if stmt.having:
+            parts.append('HAVING ' + ','.join(
+                sorted(self._render_all(stmt.having, names))))
+        return parts
+
+    # statement nodes #########################################################
+
+    def visit_union(self, union, names=None):
+        selects = sorted(self._render_all(union.children, None))
+        if len(selects) == 1:
+            return selects[0]
+        return ' UNION '.join('(%s)' % select for select in selects)
+
+    def visit_select(self, select, names=None):
+        selected = []
+        for term in select.selection:
+            selected += _variables(term)
+        names = self._name_variables(
+            selected, list(select.selection) + list(select.groupby)
+            + list(select.orderby) + self._where_atoms(select)
+            + list(select.with_))
+        parts = [','.join(self._render_all(select.selection, names))]
+        if select.groupby:
+            parts.append('GROUPBY ' + ','.join(
+                sorted(self._render_all(select.groupby, names))))
+        if select.orderby:
+            parts.append('ORDERBY ' + ','.join(
+                self._render_all(select.orderby, names)))
+        if select.limit is not None:
+            parts.append('LIMIT %s' % select.limit)
+        if select.offset:
+            parts.append('OFFSET %s' % select.offset)
+        parts += self._where_parts(select, names)
+        if select.with_:
+            parts.append('WITH ' + ','.join(
+                sorted(self._render_all(select.with_, names))))
+        if select.distinct:
+            return 'DISTINCT Any ' + ' '.join(parts)
+        return 'Any ' + ' '.join(parts)
+
+    def _main_variables_parts(self, stmt, keyword):
+        names = self._name_variables(
+            [vref.name for etype, vref in stmt.main_variables],
+            stmt.main_relations + self._where_atoms(stmt))
+        parts = [keyword, ', '.join(sorted(
+            '%s %s' % (etype, names[vref.name])
+            for etype, vref in stmt.main_variables))]
+        if stmt.main_relations:
+            parts.append(': ' + ', '.join(
+                sorted(self._render_all(stmt.main_relations, names))))
+        return parts + self._where_parts(stmt, names)
+
+    def visit_insert(self, insert, names=None):
+        return ' '.join(self._main_variables_parts(insert, 'INSERT'))
+
+    def visit_delete(self, delete, names=None):
+        return ' '.join(self._main_variables_parts(delete, 'DELETE'))
+
+    def visit_set(self, update, names=None):
+        names = self._name_variables((), update.main_relations
+                                     + self._where_atoms(update))
+        parts = ['SET', ', '.join(
+            sorted(self._render_all(update.main_relations, names)))]
+        return ' '.join(parts + self._where_parts(update, names))
+
+    # tree nodes ##############################################################
+
+    def visit_subquery(self, subquery, names):
+        return '%s BEING (%s)' % (
+            ','.join(self._render_all(subquery.aliases, names)),
+            self.render(subquery.query))
+
+    def visit_exists(self, exists, names):
+        return 'EXISTS(%s)' % self.render(exists.query, names)
+
+    def visit_sortterm(self, sortterm, names):
+        if sortterm.asc:
+            return self.render(sortterm.term, names)
+        return '%s DESC' % self.render(sortterm.term, names)
+
+    def visit_and(self, et, names):
+        return ', '.join(sorted(set(self._render_all(_conjuncts(et, []),
+                                                     names))))
+
+    def visit_or(self, ou, names):
+        operands = []
+        stack = [ou]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Or):
+                stack += node.children
+            else:
+                operands.append('(%s)' % self.render(node, names))
+        return ' OR '.join(sorted(set(operands)))
+
+    def visit_not(self, not_, names):
+        return 'NOT %s' % self.render(not_.children[0], names)
+
+    def visit_relation(self, relation, names):
+        lhs, rhs = self._render_all(relation.children, names)
+        if relation.optional in ('left', 'both'):
+            lhs += '?'
+        if relation.optional in ('right', 'both'):
+            rhs += '?'
+        return '%s %s %s' % (lhs, relation.r_type, rhs)
+
+    def visit_comparison(self, comparison, names):
+        operands = self._render_all(comparison.children, names)
+        if len(operands) == 2:
+            if comparison.operator in ('=', '!='):
+                operands.sort()
+            return '%s %s %s' % (operands[0], comparison.operator, operands[1])
+        if comparison.operator == '=':
+            return operands[0]
+        return '%s %s' % (comparison.operator, operands[0])
+
+    def visit_mathexpression(self, mathexpr, names):
+        operator = mathexpr.operator
+        if operator not in ('+', '*'):
+            lhs, rhs = self._render_all(mathexpr.children, names)
+            return '(%s %s %s)' % (lhs, operator, rhs)
+        # flatten and sort operands of commutative operators
+        operands = []
+        stack = [mathexpr]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, MathExpression) and node.operator == operator:
+                stack += node.children
+            else:
+                operands.append(node)
+        if operator == '+' and not all(_not_string(node) for node in operands):
+            # string concatenation isn't commutative
+            lhs, rhs = self._render_all(mathexpr.children, names)
+            return '(%s %s %s)' % (lhs, operator, rhs)
+        return '(%s)' % (' %s ' % operator).join(
+            sorted(self._render_all(operands, names)))
+
+    def visit_unaryexpression(self, unaryexpr, names):
+        return '%s%s' % (unaryexpr.operator,
+                         self.render(unaryexpr.children[0], names))
+
+    def visit_function(self, function, names):
+        args = self._render_all(function.children, names)
+        if function.name == 'IN':
+            args = sorted(set(args))
+        return '%s(%s)' % (function.name, ', '.join(args))
+
+    def visit_variableref(self, vref, names):
+        return names[vref.name]
+
+    def visit_constant(self, constant, names):
+        return constant.as_string()
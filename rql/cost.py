@@ -0,0 +1,140 @@
+# copyright 2004-2010 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This file is part of rql.
+#
+# rql is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# rql is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with rql. If not, see <http://www.gnu.org/licenses/>.
+"""Estimation of queries cost before their execution.
+
+"""
+__docformat__ = "restructuredtext en"
+
+from rql.nodes import Function, Relation, VariableRef
+from rql.stcheck import disconnected_components
+
+# keys of the breakdown returned by `CostEstimator.estimate`
+BREAKDOWN_KEYS = ('selects', 'solutions', 'joins', 'fanouts', 'cartesian',
+                  'optional', 'aggregates')
+
+
+class CostEstimator(object):
+    """Estimate the cost of annotated and solved syntax trees, eg to reject or
+    queue expensive queries before their execution.
+
+    The score has no unit and is only meaningful when compared to other
+    scores. For each select, it is computed as follow:
+
+    * 1 plus the number of joins (relations between two entity variables),
+      each join on a multi-valued side of a relation ('*' or '+' cardinality)
+      adding `FANOUT_WEIGHT`,
+    * multiplied by `CARTESIAN_FACTOR` for each group of variables unrelated
+      to other variables (cartesian product, see
+      `rql.stcheck.disconnected_components`),
+    * plus `OPTIONAL_WEIGHT` for each optional relation and
+      `AGGREGATE_WEIGHT` for each aggregate function,
+    * multiplied by the number of solutions, since each one usually becomes a
+      branch of a SQL UNION,
+    * plus scores of subqueries.
+
+    Scores of selects of an union are summed.
+    """
+    FANOUT_WEIGHT = 5
+    CARTESIAN_FACTOR = 100
+    OPTIONAL_WEIGHT = 2
+    AGGREGATE_WEIGHT = 2
+
+    def __init__(self, schema):
+        self.schema = schema
+
+    def estimate(self, union):
+        """return a (score, breakdown) tuple for the given select query, where
+        breakdown is a dictionary of factors summed over all selects,
+        including subqueries:
+
+        * 'selects', number of selects,
+        * 'solutions', number of solutions,
+        * 'joins', number of relations between two entity variables,
+        * 'fanouts', number of multi-valued sides of those relations,
+        * 'cartesian', number of cartesian products,
+        * 'optional', number of optional relations,
+        * 'aggregates', number of aggregate functions.
+        """
+        breakdown = dict.fromkeys(BREAKDOWN_KEYS, 0)
+        score = self._union_cost(union, breakdown)
+        return score, breakdown
+
+    def _union_cost(self, union, breakdown):
+        return sum(self._select_cost(select, breakdown)
+                   for select in union.children)
+
+    def _select_cost(self, select, breakdown):
+        joins = fanouts = optional = 0
+        if select.where is not None:
+            for relation in select.where.iget_nodes(Relation):
+                if relation.optional:
+                    optional += 1
+                nbmulti = self._relation_fanouts(select, relation)
+                if nbmulti is not None:
+                    joins += 1
+                    fanouts += nbmulti
+        aggregates = 0
+        terms = list(select.selection)
+        terms += [sortterm.term for sortterm in select.orderby]
+        if select.having:
+            terms += select.having
+        for term in terms:
+            for func in term.iget_nodes(Function):
+                if func.descr().aggregat:
+                    aggregates += 1
+        cartesian = max(len(disconnected_components(select)) - 1, 0)
+        nbsols = max(len(select.solutions or ()), 1)
+        cost = 1 + joins + self.FANOUT_WEIGHT * fanouts
+        cost *= self.CARTESIAN_FACTOR ** cartesian
+        cost += self.OPTIONAL_WEIGHT * optional + self.AGGREGATE_WEIGHT * aggregates
+        cost *= nbsols
+        breakdown['selects'] += 1
+        breakdown['solutions'] += nbsols
+        breakdown['joins'] += joins
+        breakdown['fanouts'] += fanouts
+        breakdown['cartesian'] += cartesian
+        breakdown['optional'] += optional
+        breakdown['aggregates'] += aggregates
+        for subquery in select.with_:
+            cost += self._union_cost(subquery.query, breakdown)
+        return cost
+
+    def _relation_fanouts(self, select, relation):
+        """return the number of multi-valued sides of a relation between two
+        entity variables, or None if the relation isn't such a join
+        """
+        if relation.is_types_restriction():
+            return None
+        lhs, rhs = relation.get_variable_parts()
+        # either side may be a constant, eg in simplified trees
+        if not (isinstance(lhs, VariableRef) and isinstance(rhs, VariableRef)):
+            return None
+        try:
+            rschema = self.schema.rschema(relation.r_type)
+        except KeyError:
+            return None
+        if rschema.final:
+            return None
+        # only consider relation definitions used by some solution
+        pairs = set((sol.get(lhs.name), sol.get(rhs.name))
+                    for sol in select.solutions or ())
+        rdefs = [rdef for pair, rdef in rschema.rdefs.items() if pair in pairs]
+        if not rdefs:
+            rdefs = rschema.rdefs.values()
+        return sum(1 for cardidx in (0, 1)
+                   if any(rdef.cardinality[cardidx] in '*+' for rdef in rdefs))
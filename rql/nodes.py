@@ -29,9 +29,14 @@ from datetime import datetime, date, time, timedelta
 
 from six import string_types
 
+if sys.version_info < (3,):
+    from collections import MutableMapping
+else:
+    from collections.abc import MutableMapping
+
 from rql import CoercionError, RQLException
 from rql.base import BaseNode, Node, BinaryNode, LeafNode
-from rql.utils import (function_description, uquote, common_parent,
+from rql.utils import (function_description, uquote, common_scope,
                        VisitableMixIn)
 
 CONSTANT_TYPES = frozenset((None, 'Date', 'Datetime', 'Boolean', 'Float', 'Int',
@@ -90,6 +95,9 @@ class OperatorExpressionMixin(object):
             return False
         return self.operator == other.operator
 
+    def _fingerprint_label(self, abstract_constants):
+        return (self._thawed_class.__name__, self.operator)
+
     def get_description(self, mainindex, tr):
         """if there is a variable in the math expr used as rhs of a relation,
         return the name of this relation, else return the type of the math
@@ -265,10 +273,12 @@ class SubQuery(BaseNode):
         self.aliases = aliases
         for node in aliases:
             node.parent = self
+        self.invalidate_nodes_index()
 
     def set_query(self, node):
         self.query = node
         node.parent = self
+        self.invalidate_nodes_index()
 
     def copy(self, stmt):
         return SubQuery([v.copy(stmt) for v in self.aliases], self.query.copy())
@@ -382,6 +392,8 @@ class Exists(EditableMixIn, BaseNode):
         assert self.query is None
         self.query = node
         node.parent = self
+        self.invalidate_fingerprint()
+        self.invalidate_nodes_index()
 
     def is_equivalent(self, other):
         if self is other:
@@ -398,6 +410,8 @@ class Exists(EditableMixIn, BaseNode):
     def set_where(self, node):
         self.query = node
         node.parent = self
+        self.invalidate_fingerprint()
+        self.invalidate_nodes_index()
 
     @property
     def where(self):
@@ -407,6 +421,8 @@ class Exists(EditableMixIn, BaseNode):
         assert oldnode is self.query
         self.query = newnode
         newnode.parent = self
+        self.invalidate_fingerprint()
+        self.invalidate_nodes_index()
         return oldnode, self, None
 
     def remove(self, child):
@@ -455,6 +471,9 @@ class Relation(Node):
             return False
         return True
 
+    def _fingerprint_label(self, abstract_constants):
+        return ('Relation', self.r_type, self.optional)
+
     def as_string(self, kwargs=None):
         """return the tree as an encoded rql string"""
         try:
@@ -486,6 +505,7 @@ class Relation(Node):
                 self.optional = 'both'
             else:
                 self.optional = optional
+            self.invalidate_fingerprint()
 
     def relation(self):
         """return the parent relation where self occurs or None"""
@@ -574,6 +594,10 @@ class Comparison(HSMixin, Node):
             self.optional = 'left'
         elif right:
             self.optional = 'right'
+        self.invalidate_fingerprint()
+
+    def _fingerprint_label(self, abstract_constants):
+        return ('Comparison', self.operator, self.optional)
 
     def is_equivalent(self, other):
         if not Node.is_equivalent(self, other):
@@ -699,6 +723,9 @@ class Function(HSMixin, Node):
             return False
         return self.name == other.name
 
+    def _fingerprint_label(self, abstract_constants):
+        return ('Function', self.name)
+
     def as_string(self, kwargs=None):
         """return the tree as an encoded rql string"""
         return '%s(%s)' % (self.name, ', '.join(c.as_string(kwargs=kwargs)
@@ -752,6 +779,11 @@ class Constant(HSMixin, LeafNode):
             return False
         return self.type == other.type and self.value == other.value
 
+    def _fingerprint_label(self, abstract_constants):
+        if abstract_constants:
+            return ('Constant', self.type)
+        return ('Constant', self.type, self.value)
+
     def as_string(self, kwargs=None):
         """return the tree as an encoded rql string (an unicode string is
         returned if encoding is None)
@@ -825,6 +857,9 @@ class VariableRef(HSMixin, LeafNode):
             return False
         return self.name == other.name
 
+    def _fingerprint(self, abstract_constants):
+        return hash('VariableRef'), (self.name,)
+
     def as_string(self, kwargs=None):
         """return the tree as an encoded rql string"""
         return self.name
@@ -887,6 +922,9 @@ class SortTerm(Node):
             return False
         return self.asc == other.asc
 
+    def _fingerprint_label(self, abstract_constants):
+        return ('SortTerm', bool(self.asc))
+
     def as_string(self, kwargs=None):
         if self.asc:
             return '%s' % self.term
@@ -904,16 +942,147 @@ class SortTerm(Node):
 
 ###############################################################################
 
+class VariableInfo(MutableMapping):
+    """Information collected about a variable in the syntax tree, available as
+    the `stinfo` mapping of variables and column aliases.
+
+    Known keys are stored in slots, other keys in a dictionary allocated on
+    demand. Sets of references, relations, rhs relations and selection indexes
+    are only allocated when first accessed through `[]`: use `get` to read them
+    without allocating an empty set.
+    """
+    __slots__ = (
+        # link to VariableReference objects in the syntax tree
+        'references',
+        # scope node of the variable
+        'scope',
+        # relations where this variable is used on the lhs/rhs
+        'relations', 'rhsrelations',
+        # selection indexes if any
+        'selected',
+        # type restriction (e.g. "is" / "is_instance_of") where this variable
+        # is used on the lhs
+        'typerel',
+        # uid relations (e.g. "eid") where this variable is used on the lhs
+        'uidrel',
+        # if this variable is an attribute variable (ie final entity), link to
+        # the (prefered) attribute owner variable
+        'attrvar', 'attrvars',
+        # constant node linked to an uid variable if any
+        'constnode',
+        # possible types, according to solutions
+        'possibletypes',
+        # optional information
+        'optrelations', 'blocsimplification', 'ftirels', 'having',
+        'optcomparisons',
+        # other keys
+        '_extra')
+
+    def __init__(self):
+        self._extra = None
+
+    def __getitem__(self, key):
+        try:
+            return _VARINFO_SLOTS[key].__get__(self)
+        except AttributeError:  # slot not set
+            if key in _VARINFO_LAZY_SETS:
+                value = set()
+                _VARINFO_SLOTS[key].__set__(self, value)
+                return value
+            raise KeyError(key)
+        except KeyError:  # not a slot
+            if self._extra is None:
+                raise
+            return self._extra[key]
+
+    def get(self, key, default=None):
+        try:
+            return _VARINFO_SLOTS[key].__get__(self)
+        except AttributeError:  # slot not set
+            if key in _VARINFO_LAZY_SETS:
+                return _EMPTY_SET
+            return default
+        except KeyError:  # not a slot
+            if self._extra is None:
+                return default
+            return self._extra.get(key, default)
+
+    def __setitem__(self, key, value):
+        try:
+            _VARINFO_SLOTS[key].__set__(self, value)
+        except KeyError:  # not a slot
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        try:
+            _VARINFO_SLOTS[key].__delete__(self)
+        except AttributeError:  # slot not set
+            if key not in _VARINFO_LAZY_SETS:
+                raise KeyError(key)
+        except KeyError:  # not a slot
+            if self._extra is None:
+                raise
+            del self._extra[key]
+            if not self._extra:
+                self._extra = None
+
+    def __contains__(self, key):
+        try:
+            _VARINFO_SLOTS[key].__get__(self)
+        except AttributeError:  # slot not set
+            return key in _VARINFO_LAZY_SETS
+        except KeyError:  # not a slot
+            return self._extra is not None and key in self._extra
+        return True
+
+    def __iter__(self):
+        for key, descr in _VARINFO_SLOTS.items():
+            if key in _VARINFO_LAZY_SETS:
+                yield key
+            else:
+                try:
+                    descr.__get__(self)
+                except AttributeError:  # slot not set
+                    continue
+                yield key
+        if self._extra is not None:
+            for key in list(self._extra):
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return '{%s}' % ', '.join('%r: %r' % (key, self.get(key)) for key in self)
+
+    def reset_annotation(self):
+        """Reset information computed by the annotator."""
+        for key in ('relations', 'rhsrelations', 'selected',
+                    'optrelations', 'blocsimplification', 'ftirels'):
+            try:
+                _VARINFO_SLOTS[key].__delete__(self)
+            except AttributeError:  # slot not set
+                pass
+        self.scope = self.typerel = self.uidrel = None
+        self.attrvar = self.constnode = None
+
+
+_VARINFO_SLOTS = dict((key, VariableInfo.__dict__[key])
+                      for key in VariableInfo.__slots__ if key != '_extra')
+_VARINFO_LAZY_SETS = frozenset(('references', 'relations', 'rhsrelations',
+                                'selected'))
+_EMPTY_SET = frozenset()
+
+
 class Referenceable(VisitableMixIn):
     __slots__ = ('name', 'stinfo', 'stmt')
 
     def __init__(self, name):
         self.name = name.strip()
         # used to collect some global information about the syntax tree
-        self.stinfo = {
-            # link to VariableReference objects in the syntax tree
-            'references': set(),
-            }
+        self.stinfo = VariableInfo()
         # reference to the selection
         self.stmt = None
 
@@ -947,33 +1116,14 @@ class Referenceable(VisitableMixIn):
         return tuple(self.stinfo['references'])
 
     def prepare_annotation(self):
-        self.stinfo.update({
-            'scope': None,
-            # relations where this variable is used on the lhs/rhs
-            'relations': set(),
-            'rhsrelations': set(),
-            # selection indexes if any
-            'selected': set(),
-            # type restriction (e.g. "is" / "is_instance_of") where this
-            # variable is used on the lhs
-            'typerel': None,
-            # uid relations (e.g. "eid") where this variable is used on the lhs
-            'uidrel': None,
-            # if this variable is an attribute variable (ie final entity), link
-            # to the (prefered) attribute owner variable
-            'attrvar': None,
-            # constant node linked to an uid variable if any
-            'constnode': None,
-            })
-        # remove optional st infos
-        for key in ('optrelations', 'blocsimplification', 'ftirels'):
-            self.stinfo.pop(key, None)
+        self.stinfo.reset_annotation()
 
     def _set_scope(self, key, scopenode):
         if scopenode is self.stmt or self.stinfo[key] is None:
             self.stinfo[key] = scopenode
         elif not (self.stinfo[key] is self.stmt or scopenode is self.stinfo[key]):
-            self.stinfo[key] = common_parent(self.stinfo[key], scopenode).scope
+            self.stinfo[key] = common_scope(self.stinfo[key], scopenode,
+                                            self.stmt.scopes_index)
 
     def set_scope(self, scopenode):
         self._set_scope('scope', scopenode)
@@ -0,0 +1,592 @@
+# copyright 2004-2010 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This file is part of rql.
+#
+# rql is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# rql is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with rql. If not, see <http://www.gnu.org/licenses/>.
+"""Optional optimization passes rewriting syntax trees.
+
+Rewritings are registered in the undo manager of the tree when it is
+recording operations (see `Union.save_state`).
+"""
+
+__docformat__ = "restructuredtext en"
+
+import math
+import operator
+
+from rql import CoercionError, TypeResolverException
+from rql.nodes import (And, Or, ColumnAlias, Comparison, Constant, Function,
+                       MathExpression, Relation, SortTerm, UnaryExpression,
+                       VariableRef, etype_from_pyobj)
+from rql.stmts import Select
+
+# types of constants which may be folded
+FOLDABLE_TYPES = frozenset(('Int', 'Float', 'String'))
+# integers are usually 64 bits at most in databases, don't fold values which
+# would overflow
+INT_MIN, INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def _int_div(lhs, rhs):
+    # SQL integer division truncates toward zero
+    quotient = abs(lhs) // abs(rhs)
+    if (lhs < 0) != (rhs < 0):
+        return -quotient
+    return quotient
+
+
+def _int_mod(lhs, rhs):
+    # SQL modulo has the sign of the dividend
+    return lhs - rhs * _int_div(lhs, rhs)
+
+
+# operator: (implementation for Int operands or None, for Float operands or
+# None). Integer division isn't folded since some backends return a decimal.
+BINARY_OPERATORS = {
+    '+': (operator.add, operator.add),
+    '-': (operator.sub, operator.sub),
+    '*': (operator.mul, operator.mul),
+    '/': (None, operator.truediv),
+    '%': (_int_mod, math.fmod),
+    '&': (operator.and_, None),
+    '|': (operator.or_, None),
+    '#': (operator.xor, None),
+}
+UNARY_OPERATORS = {
+    '-': (operator.neg, operator.neg),
+    '~': (operator.invert, None),
+}
+# function name: (implementation, accepted types of arguments). String
+# arguments are only folded if they're ASCII, since case mapping and length
+# of other characters depend on the backend (eg MySQL's LENGTH counts bytes).
+PURE_FUNCTIONS = {
+    'UPPER': (lambda value: value.upper(), ('String',)),
+    'LOWER': (lambda value: value.lower(), ('String',)),
+    'LENGTH': (len, ('String',)),
+    'ABS': (abs, ('Int', 'Float')),
+}
+
+
+def _undo_manager(rqlst):
+    """return the undo manager of the tree if it's recording operations, else
+    None
+    """
+    root = rqlst.root
+    if root is not None and root.should_register_op:
+        return root.undo_manager
+    return None
+
+
+def _leaves(node, klass):
+    """return the operands of a chain of `klass` (And or Or) nodes"""
+    if isinstance(node, klass):
+        return _leaves(node.children[0], klass) + _leaves(node.children[1], klass)
+    return [node]
+
+
+def _replace(node, newnode, undo_manager):
+    for vref in node.iget_nodes(VariableRef):
+        vref.unregister_reference()
+    node.parent.replace(node, newnode)
+    if undo_manager is not None:
+        from rql.undo import ReplaceNodeOperation
+        undo_manager.add_operation(ReplaceNodeOperation(node, newnode))
+
+
+def _constant(node, kwargs):
+    """return (type, value) of `node` if it's a constant which may be folded,
+    else None
+    """
+    if not isinstance(node, Constant) or node.uid:
+        return None
+    if node.type == 'Substitute':
+        if kwargs is None or node.value not in kwargs:
+            return None
+        value = kwargs[node.value]
+        try:
+            ctype = etype_from_pyobj(value)
+        except KeyError:
+            return None
+    else:
+        ctype, value = node.type, node.value
+    if ctype not in FOLDABLE_TYPES:
+        return None
+    return ctype, value
+
+
+def _evaluate(node, operands, kwargs):
+    """return the Constant node resulting from the evaluation of `node` given
+    its (type, value) `operands`, or None if it can't be evaluated
+    """
+    types = [ctype for ctype, value in operands]
+    values = [value for ctype, value in operands]
+    if isinstance(node, Function):
+        try:
+            func, argtypes = PURE_FUNCTIONS[node.name]
+        except KeyError:
+            return None
+        if len(values) != 1 or types[0] not in argtypes:
+            return None
+        if types[0] == 'String' and not all(ord(char) < 128 for char in values[0]):
+            return None
+    else:
+        if 'String' in types:
+            return None
+        if isinstance(node, MathExpression):
+            funcs = BINARY_OPERATORS.get(node.operator)
+        else:
+            funcs = UNARY_OPERATORS.get(node.operator)
+        if funcs is None:
+            return None
+        func = funcs['Float' in types]
+        if func is None:
+            return None
+    try:
+        rtype = node.get_type(kwargs=kwargs)
+    except CoercionError:
+        return None
+    if rtype not in FOLDABLE_TYPES:
+        return None
+    try:
+        value = func(*values)
+    except (ArithmeticError, ValueError):
+        return None
+    if rtype == 'Float':
+        value = float(value)
+        # exponent notation isn't valid RQL
+        if math.isinf(value) or math.isnan(value) or 'e' in str(value):
+            return None
+    elif rtype == 'Int' and not INT_MIN <= value <= INT_MAX:
+        return None
+    return Constant(value, rtype)
+
+
+def fold_constants(rqlst, kwargs=None):
+    """Replace, in place, math expressions, unary expressions and calls to
+    pure functions (see `PURE_FUNCTIONS`) whose operands are constants by
+    the resulting constant. Return the number of replaced nodes.
+
+    Constants are evaluated as most backends do, except that integer
+    divisions and string functions on non ASCII strings are never folded
+    (see `BINARY_OPERATORS` and `PURE_FUNCTIONS`), nor are floats which
+    would be written using an exponent.
+
+    Substitutions (eg `%(x)s`) are only considered as constants if `kwargs`
+    is given. Dates constants (`TODAY` and `NOW`) are evaluated when the query
+    is executed, so they are never folded.
+    """
+    return _fold(rqlst, kwargs, _undo_manager(rqlst))
+
+
+def _fold(node, kwargs, undo_manager):
+    """fold constants in the subtree of `node`, return the number of replaced
+    nodes. If `node` has been folded, it's replaced by a constant in its
+    parent.
+    """
+    nbfolded = 0
+    operands = []
+    for child in list(node.children):
+        nbfolded += _fold(child, kwargs, undo_manager)
+    if not isinstance(node, (MathExpression, UnaryExpression, Function)):
+        return nbfolded
+    if _is_sort_or_group_term(node):
+        return nbfolded
+    for child in node.children:
+        operand = _constant(child, kwargs)
+        if operand is None:
+            return nbfolded
+        operands.append(operand)
+    newnode = _evaluate(node, operands, kwargs)
+    if newnode is None:
+        return nbfolded
+    _replace(node, newnode, undo_manager)
+    return nbfolded + 1
+
+
+def _is_sort_or_group_term(node):
+    """return True if `node` is a sort or group term, which mustn't be replaced
+    by a constant (an integer constant being a column index in ORDERBY)
+    """
+    parent = node.parent
+    if isinstance(parent, SortTerm):
+        return True
+    return (isinstance(parent, Select)
+            and any(term is node for term in parent.groupby or ()))
+
+
+def _equality_values(node):
+    """return (group key, constant nodes) if `node` is a relation which may be
+    merged with others into an IN restriction, else None
+    """
+    if not isinstance(node, Relation) or node.optional or node.operator() != '=':
+        return None
+    lhs, rhs = node.get_variable_parts()
+    if isinstance(rhs, Function) and rhs.name == 'IN':
+        values = rhs.children
+    else:
+        values = [rhs]
+    if not all(isinstance(value, Constant) and value.type is not None
+               for value in values):
+        return None
+    return (lhs.name, node.r_type), values
+
+
+def _add_unique(node, seen):
+    """add `node` to `seen`, a dictionary of lists of nodes by fingerprint,
+    unless an equivalent node is already there. Return True if it was added.
+    """
+    candidates = seen.setdefault(node.fingerprint(), [])
+    if any(node.is_equivalent(other) for other in candidates):
+        return False
+    candidates.append(node)
+    return True
+
+
+def merge_equality_disjunctions(rqlst):
+    """Rewrite, in place, disjunctions of equality restrictions on the same
+    variable and relation type into a single IN restriction, eg
+    `X name "a" OR X name "b" OR Y name "c"` into
+    `X name IN("a", "b") OR Y name "c"`. Return the number of rewritten
+    disjunctions.
+    """
+    undo_manager = _undo_manager(rqlst)
+    nbrewritten = 0
+    for ornode in rqlst.get_nodes(Or):
+        if isinstance(ornode.parent, Or):
+            continue
+        leaves = _leaves(ornode, Or)
+        groups = {}
+        for leaf in leaves:
+            equality = _equality_values(leaf)
+            if equality is not None:
+                groups.setdefault(equality[0], []).append(leaf)
+        if all(len(group) < 2 for group in groups.values()):
+            continue
+        stmt = ornode.stmt
+        newleaves = []
+        done = set()
+        for leaf in leaves:
+            equality = _equality_values(leaf)
+            if equality is None or len(groups[equality[0]]) < 2:
+                newleaves.append(leaf.copy(stmt))
+                continue
+            if equality[0] in done:
+                continue
+            done.add(equality[0])
+            values = []
+            seen = {}
+            for relation in groups[equality[0]]:
+                for value in _equality_values(relation)[1]:
+                    if _add_unique(value, seen):
+                        values.append(value)
+            if len(values) == 1:
+                rhs = values[0].copy(stmt)
+            else:
+                rhs = Function('IN')
+                for value in values:
+                    rhs.append(value.copy(stmt))
+            newleaf = Relation(leaf.r_type)
+            newleaf.append(VariableRef(leaf.children[0].variable))
+            newleaf.append(Comparison('=', rhs))
+            newleaves.append(newleaf)
+        newnode = newleaves[0]
+        for leaf in newleaves[1:]:
+            newnode = Or(newnode, leaf)
+        _replace(ornode, newnode, undo_manager)
+        nbrewritten += 1
+    return nbrewritten
+
+
+def remove_duplicate_restrictions(rqlst):
+    """Remove, in place, relations which are equivalent to a previous relation
+    of the same conjunction, eg the second `X is Person` of
+    `X is Person, X name "a", X is Person`. Return the number of removed
+    relations.
+    """
+    nbremoved = 0
+    for andnode in rqlst.get_nodes(And):
+        if isinstance(andnode.parent, And):
+            continue
+        kept = {}
+        for leaf in _leaves(andnode, And):
+            if not isinstance(leaf, Relation):
+                continue
+            if not _add_unique(leaf, kept):
+                leaf.stmt.remove_node(leaf)
+                nbremoved += 1
+    return nbremoved
+
+
+def _solutions(rqlst):
+    """return solutions of every select of the tree, in a comparable form"""
+    if isinstance(rqlst, Select) or rqlst.TYPE != 'select':
+        stmts = [rqlst]
+    else:
+        stmts = rqlst.get_nodes(Select)
+    return [sorted(sorted(sol.items()) for sol in stmt.solutions or ())
+            for stmt in stmts]
+
+
+def _remove(node):
+    """remove `node` from the tree, return the operation to undo it"""
+    from rql.undo import RemoveNodeOperation
+    stmt = node.stmt
+    for vref in node.iget_nodes(VariableRef):
+        vref.unregister_reference()
+    node, parent, index = node.parent.remove(node)
+    return RemoveNodeOperation(node, parent, stmt, index)
+
+
+def _add_restriction(select, relation):
+    """add `relation` to the WHERE clause of `select`, return the operation to
+    undo it
+    """
+    from rql.undo import AddNodeOperation, ReplaceNodeOperation
+    where = select.where
+    if where is None:
+        select.set_where(relation)
+        return AddNodeOperation(relation)
+    newnode = And(where, relation)
+    select.set_where(newnode)
+    return ReplaceNodeOperation(where, newnode)
+
+
+def remove_redundant_type_restrictions(rqlst, resolve):
+    """Remove, in place, type restrictions (`is` and `is_instance_of`
+    relations) which don't change solutions of the tree, because other
+    relations already restrict the variable's types, eg `X is Person` in
+    `X is Person, X firstname F` if only persons have a first name. Return
+    the number of removed relations.
+
+    `resolve` should annotate the tree and compute its solutions. It's called
+    to check each candidate restriction, so the tree should have been solved
+    beforehand.
+    """
+    undo_manager = _undo_manager(rqlst)
+    solutions = _solutions(rqlst)
+    nbremoved = 0
+    for relation in rqlst.get_nodes(Relation):
+        if not relation.is_types_restriction() or relation.optional:
+            continue
+        if (relation.scope is not relation.stmt or relation.ored()
+                or relation.neged()):
+            continue
+        variable = relation.children[0].variable
+        if not any(vref.relation() not in (None, relation)
+                   for vref in variable.references()):
+            continue
+        operation = _remove(relation)
+        try:
+            resolve(rqlst)
+            redundant = _solutions(rqlst) == solutions
+        except TypeResolverException:
+            redundant = False
+        if redundant:
+            nbremoved += 1
+            if undo_manager is not None:
+                undo_manager.add_operation(operation)
+        else:
+            operation.undo(rqlst)
+            resolve(rqlst)
+    return nbremoved
+
+
+def _pushable_alias(relation):
+    """return the column alias restricted by `relation` if this restriction may
+    be pushed into the alias's subquery, else None
+    """
+    if relation.optional or relation.is_types_restriction():
+        return None
+    lhs, rhs = relation.get_parts()
+    # the lhs may be a constant in simplified trees
+    if not isinstance(lhs, VariableRef):
+        return None
+    alias = lhs.variable
+    if not isinstance(alias, ColumnAlias) or any(rhs.iget_nodes(VariableRef)):
+        return None
+    # restrictions of the optional side of an outer join are part of the join
+    # condition
+    for vref in alias.references():
+        vrel = vref.relation()
+        if vrel is not None and vrel.optional:
+            return None
+    for select in alias.query.children:
+        # restricting before LIMIT / OFFSET would change the results, and only
+        # variables can be restricted
+        if select.limit is not None or select.offset:
+            return None
+        term = select.selection[alias.colnum]
+        if not isinstance(term, VariableRef):
+            return None
+        # the restriction would be part of the join condition instead of
+        # filtering out rows where the variable is NULL
+        if _outer_joined(term.variable):
+            return None
+    return alias
+
+
+def _outer_joined(var):
+    """return True if `var` is on the optional side of one of its relations"""
+    for vref in var.references():
+        relation = vref.relation()
+        if relation is None or not relation.optional:
+            continue
+        if relation.children[0] is vref:
+            if relation.optional in ('left', 'both'):
+                return True
+        elif relation.optional in ('right', 'both'):
+            return True
+    return False
+
+
+def _selects(union):
+    """return selects of `union` and of their subqueries, outer ones first"""
+    selects = []
+    for select in union.children:
+        selects.append(select)
+        for subquery in select.with_:
+            selects += _selects(subquery.query)
+    return selects
+
+
+def push_down_restrictions(rqlst):
+    """Move, in place, restrictions of a column alias into each select of its
+    subquery, eg rewrite `Any X WHERE X name "foo" WITH X BEING (Any Y WHERE
+    Y is Person)` into `Any X WITH X BEING (Any Y WHERE Y is Person, Y name
+    "foo")`. Return the number of moved restrictions.
+
+    Only relations of the top-level conjunction of the WHERE clause whose left
+    hand side is an alias and right hand side doesn't involve any variable
+    are considered. Type restrictions, optional relations and subqueries
+    using LIMIT / OFFSET, selecting something else than variables or whose
+    selected variable is on the optional side of an outer join are left
+    untouched.
+
+    The tree should have been solved, so that subqueries members which are
+    incompatible with the outer query have been removed (see
+    `Select.set_possible_types`), and should be annotated and solved again
+    afterwards.
+    """
+    # operations are registered by hand since subqueries have their own undo
+    # manager
+    undo_manager = _undo_manager(rqlst)
+    nbpushed = 0
+    # outer selects first, so that restrictions go down nested subqueries
+    for select in _selects(rqlst):
+        if not select.with_ or select.where is None:
+            continue
+        for relation in _leaves(select.where, And):
+            if not isinstance(relation, Relation):
+                continue
+            alias = _pushable_alias(relation)
+            if alias is None:
+                continue
+            for subselect in alias.query.children:
+                var = subselect.selection[alias.colnum].variable
+                newrelation = Relation(relation.r_type)
+                newrelation.append(VariableRef(var))
+                newrelation.append(relation.children[1].copy(subselect))
+                operation = _add_restriction(subselect, newrelation)
+                if undo_manager is not None:
+                    undo_manager.add_operation(operation)
+            operation = _remove(relation)
+            if undo_manager is not None:
+                undo_manager.add_operation(operation)
+            nbpushed += 1
+    return nbpushed
+
+
+def _aggregates(select):
+    """return True if `select` uses aggregate functions"""
+    terms = list(select.selection)
+    terms += [sortterm.term for sortterm in select.orderby]
+    return any(func.descr().aggregat
+               for term in terms for func in term.iget_nodes(Function))
+
+
+def _sort_columns(select):
+    """return the list of (column index, ascending) of the single subquery of
+    `select` on which its result is sorted, or None if it's sorted on
+    something else than those columns
+    """
+    columns = []
+    for sortterm in select.orderby:
+        term = sortterm.term
+        if not (isinstance(term, VariableRef)
+                and isinstance(term.variable, ColumnAlias)):
+            return None
+        columns.append((term.variable.colnum, sortterm.asc))
+    return columns
+
+
+def _limit_select(select, limit, columns):
+    """limit results of `select` to its `limit` first rows sorted by the given
+    `columns` (see `_sort_columns`), return the list of operations to undo it
+    (empty if nothing has been done)
+    """
+    from rql.undo import AddSortOperation, RemoveSortOperation, SetLimitOperation
+    if select.offset or (select.limit is not None
+                         and (columns or select.limit <= limit)):
+        return []
+    operations = []
+    if columns:
+        # sorting a subquery without limit doesn't change the outer result
+        for sortterm in select.orderby[:]:
+            operations.append(RemoveSortOperation(sortterm))
+            select.remove_sort_term(sortterm)
+        for colnum, asc in columns:
+            sortterm = SortTerm(select.selection[colnum].copy(select), asc)
+            select.add_sort_term(sortterm)
+            operations.append(AddSortOperation(sortterm))
+    operations.append(SetLimitOperation(select.limit, select))
+    select.set_limit(limit)
+    return operations
+
+
+def push_down_limit(rqlst):
+    """Copy, in place, the LIMIT of selects which only wrap an union (see
+    `Union.wrap_selects`) into each select of the union, eg rewrite
+    `Any X ORDERBY X LIMIT 10 OFFSET 5 WITH X BEING ((Any Y WHERE Y is Person)
+    UNION (Any Y WHERE Y is Company))` into `Any X ORDERBY X LIMIT 10 OFFSET 5
+    WITH X BEING ((Any Y ORDERBY Y LIMIT 15 WHERE Y is Person) UNION
+    (Any Y ORDERBY Y LIMIT 15 WHERE Y is Company))`, so that each member of
+    the union may stop early. Return the number of limited selects.
+
+    The outer select is left untouched and still applies its own LIMIT /
+    OFFSET. Only selects with a single subquery and without WHERE clause,
+    GROUPBY, HAVING, DISTINCT or aggregate functions are considered, and
+    they may only be sorted on columns of the subquery. Members of the union
+    having an OFFSET, or a LIMIT and a sort order to change, are left
+    untouched.
+    """
+    undo_manager = _undo_manager(rqlst)
+    nblimited = 0
+    for select in _selects(rqlst):
+        if (select.limit is None or len(select.with_) != 1
+                or select.where is not None or select.groupby or select.having
+                or select.distinct or _aggregates(select)):
+            continue
+        columns = _sort_columns(select)
+        if columns is None:
+            continue
+        limit = select.limit + select.offset
+        for subselect in select.with_[0].query.children:
+            operations = _limit_select(subselect, limit, columns)
+            if operations:
+                nblimited += 1
+            if undo_manager is not None:
+                for operation in operations:
+                    undo_manager.add_operation(operation)
+    return nblimited
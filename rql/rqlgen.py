@@ -20,6 +20,8 @@
 """
 __docformat__ = "restructuredtext en"
 
+from random import Random
+
 from six.moves import range
 
 NOT = 1
@@ -200,6 +202,193 @@ class RQLGenerator(object):
 RQLGENERATOR = RQLGenerator()
 
 
+# relation types not used by the workload generator
+SPECIAL_RELATIONS = frozenset(('eid', 'is', 'is_instance_of', 'identity',
+                               'has_text'))
+
+
+class RQLWorkloadGenerator(object):
+    """Generate random, valid selection queries for a schema, with a tunable
+    shape. Using the same seed, a generator produces the same queries.
+
+    Example:
+
+    >>> generator = RQLWorkloadGenerator(schema, seed=0)  # doctest: +SKIP
+    >>> generator.select(relations=3, or_branches=2)      # doctest: +SKIP
+    'Any V0,A0 WHERE V0 is Ticket, V0 concerns V1, ...'
+    """
+
+    def __init__(self, schema, seed=None):
+        self.schema = schema
+        self.random = Random(seed)
+        # etype: {rtype: [(other etype, True if etype is the subject)]}
+        self._links = {}
+        # etype: [(rtype, final type)]
+        self._attributes = {}
+        for rtype in sorted(str(rtype) for rtype in schema.relations()):
+            if rtype in SPECIAL_RELATIONS:
+                continue
+            rschema = schema.rschema(rtype)
+            for subjtype, objtypes in rschema.associations():
+                subjtype = str(subjtype)
+                for objtype in objtypes:
+                    objtype = str(objtype)
+                    if rschema.final:
+                        self._attributes.setdefault(subjtype, []).append(
+                            (rtype, objtype))
+                    else:
+                        self._links.setdefault(subjtype, {}).setdefault(
+                            rtype, []).append((objtype, True))
+                        self._links.setdefault(objtype, {}).setdefault(
+                            rtype, []).append((subjtype, False))
+        self._etypes = sorted(self._links)
+
+    def workload(self, count, **shape):
+        """Return an iterator on `count` selection queries of the given shape
+        (see `select`).
+        """
+        for _ in range(count):
+            yield self.select(**shape)
+
+    def select(self, relations=2, attributes=2, untyped=0.,
+               or_branches=0, negations=0, subqueries=0, limit=None):
+        """Return a selection query with:
+
+        * `relations` relations between entity variables, linking the
+          selected variable to `relations` other variables,
+        * `attributes` attribute relations, either selected or restricted by a
+          constant,
+        * a type restriction for each variable, except for a `untyped`
+          fraction of them (the more untyped variables, the more solutions),
+        * a disjunction of `or_branches` attribute restrictions,
+        * `negations` negated relations,
+        * `subqueries` relations to a variable defined by a sub-query,
+        * a `limit` if specified.
+
+        Fewer relations may be generated if the schema doesn't allow them.
+        """
+        rand = self.random
+        variables = [('V0', rand.choice(self._etypes))]
+        negvariables = []
+        restrictions = []
+        for _ in range(relations):
+            link = self._link(variables)
+            if link is None:
+                break
+            name = 'V%s' % len(variables)
+            restrictions.append(self._relation(link, name))
+            variables.append((name, link[2]))
+        for i in range(negations):
+            link = self._link(variables)
+            if link is None:
+                break
+            # negate a relation to an existing variable if possible
+            targets = [var for var, etype in variables
+                       if etype == link[2] and var != link[0]]
+            if targets:
+                name = rand.choice(targets)
+            else:
+                name = 'N%s' % i
+                negvariables.append((name, link[2]))
+            restrictions.append('NOT ' + self._relation(link, name))
+        subqueries_defs = []
+        for i in range(subqueries):
+            link = self._link(variables)
+            if link is None:
+                break
+            alias = 'S%s' % i
+            restrictions.append(self._relation(link, alias))
+            subquery = ['%s is %s' % (alias, link[2])]
+            attribute = self._attribute(link[2], constant=True)
+            if attribute is not None:
+                subquery.append('%s %s %s' % (alias, attribute[0],
+                                              self._constant(attribute[1])))
+            subqueries_defs.append('%s BEING (Any %s WHERE %s)' % (
+                alias, alias, ', '.join(subquery)))
+        typerestrictions = ['%s is %s' % var for var in variables + negvariables
+                            if rand.random() >= untyped]
+        selection = [variables[0][0]]
+        for i in range(attributes):
+            var, etype = rand.choice(variables)
+            if rand.random() < 0.5:
+                attribute = self._attribute(etype, constant=True)
+                if attribute is not None:
+                    restrictions.append('%s %s %s' % (
+                        var, attribute[0], self._constant(attribute[1])))
+                    continue
+            attribute = self._attribute(etype)
+            if attribute is not None:
+                name = 'A%s' % i
+                restrictions.append('%s %s %s' % (var, attribute[0], name))
+                selection.append(name)
+        if or_branches:
+            for var, etype in rand.sample(variables, len(variables)):
+                attribute = self._attribute(etype, constant=True)
+                if attribute is not None:
+                    branches = [(var, attribute[0], self._constant(attribute[1]))
+                                for _ in range(or_branches)]
+                    restrictions.append('(%s)' % ' OR '.join(
+                        '%s %s %s' % branch for branch in branches))
+                    break
+        rql = ['Any %s' % ','.join(selection)]
+        if len(selection) > 1:
+            rql.append('ORDERBY %s' % selection[1])
+        if limit is not None:
+            rql.append('LIMIT %s' % limit)
+        restrictions = typerestrictions + restrictions
+        if restrictions:
+            rql.append('WHERE %s' % ', '.join(restrictions))
+        if subqueries_defs:
+            rql.append('WITH %s' % ', '.join(subqueries_defs))
+        return ' '.join(rql)
+
+    def _link(self, variables):
+        """Return (variable, (rtype, other etype, subject side)) for a random
+        relation from one of the given variables, or None if there is none.
+        """
+        candidates = [(var, etype) for var, etype in variables
+                      if etype in self._links]
+        if not candidates:
+            return None
+        var, etype = self.random.choice(candidates)
+        links = self._links[etype]
+        rtype = self.random.choice(sorted(links))
+        etype, subject = self.random.choice(links[rtype])
+        return var, rtype, etype, subject
+
+    def _relation(self, link, name):
+        var, rtype, etype, subject = link
+        if subject:
+            return '%s %s %s' % (var, rtype, name)
+        return '%s %s %s' % (name, rtype, var)
+
+    def _attribute(self, etype, constant=False):
+        """Return a random (rtype, final type) for an attribute of the given
+        entity type, or None if there is none. If `constant` is true, only
+        consider attributes whose type has a constant generator.
+        """
+        attributes = self._attributes.get(etype, ())
+        if constant:
+            attributes = [(rtype, ftype) for rtype, ftype in attributes
+                          if ftype in CONSTANT_GENERATORS]
+        if not attributes:
+            return None
+        return self.random.choice(attributes)
+
+    def _constant(self, ftype):
+        return CONSTANT_GENERATORS[ftype](self.random)
+
+
+CONSTANT_GENERATORS = {
+    'String': lambda rand: '"value%s"' % rand.randint(0, 100),
+    'Int': lambda rand: str(rand.randint(0, 100)),
+    'Float': lambda rand: '%.1f' % (rand.random() * 100),
+    'Boolean': lambda rand: rand.choice(('TRUE', 'FALSE')),
+    'Date': lambda rand: 'TODAY',
+    'Datetime': lambda rand: 'NOW',
+}
+
+
 def _test():
     """
     Launch doctest
@@ -19,11 +19,12 @@
 
 __docformat__ = "restructuredtext en"
 
-from logilab.common.graph import has_path
+import warnings
+
 from logilab.database import UnknownFunction
 
-from rql._exceptions import BadRQLQuery
-from rql.utils import function_description
+from rql._exceptions import BadRQLQuery, CartesianProductWarning
+from rql.utils import function_description, visitor_handler
 from rql.nodes import (Relation, VariableRef, Constant, Not, Exists, Function,
                        And, Comparison, variable_refs, make_relation)
 
@@ -71,6 +72,165 @@ class STCheckState(object):
             self.var_info[var] = vi
 
 
+class VarGraphIndex(object):
+    """Compiled form of a select's `vargraph`, answering repeated
+    `has_unique_value_path` queries for this select.
+
+    Paths starting from a given variable are computed once by a single
+    depth-first traversal, yielding the same paths as
+    `logilab.common.graph.has_path`. Relation cardinality flags are computed
+    once per edge and path checks are cached, so each query is a lookup once
+    its starting variable has been traversed.
+    """
+
+    def __init__(self, schema, select):
+        self.schema = schema
+        self.graph = select.vargraph
+        self.aggregated = select.aggregated
+        # variable name -> {reachable variable name: parent in the dfs tree}
+        self._trees = {}
+        # (variable name, variable name) -> (has rdefs, unique, final) flags
+        self._edges = {}
+        # (from variable name, variable name) -> path to variable ok
+        self._prefixes = {}
+
+    def _tree(self, fromvar):
+        try:
+            return self._trees[fromvar]
+        except KeyError:
+            pass
+        graph = self.graph
+        parents = {fromvar: None}
+        stack = [(fromvar, iter(graph[fromvar]))]
+        while stack:
+            var, destvars = stack[-1]
+            for destvar in destvars:
+                if destvar not in parents:
+                    parents[destvar] = var
+                    stack.append((destvar, iter(graph.get(destvar, ()))))
+                    break
+            else:
+                stack.pop()
+        self._trees[fromvar] = parents
+        return parents
+
+    def _edge(self, fromvar, var):
+        try:
+            return self._edges[(fromvar, var)]
+        except KeyError:
+            pass
+        try:
+            rtype = self.graph[(fromvar, var)]
+            cardidx = 0
+        except KeyError:
+            rtype = self.graph[(var, fromvar)]
+            cardidx = 1
+        rschema = self.schema.rschema(rtype)
+        rdefs = rschema.rdefs.values()
+        flags = (bool(rdefs),
+                 all(rdef.cardinality[cardidx] in '?1' for rdef in rdefs),
+                 rschema.final)
+        self._edges[(fromvar, var)] = flags
+        return flags
+
+    def _hop_ok(self, fromvar, var, last):
+        hasrdefs, unique, final = self._edge(fromvar, var)
+        # XXX aggregats handling needs much probably some enhancements...
+        return (not hasrdefs or var in self.aggregated
+                or (unique and (last or not final)))
+
+    def _prefix_ok(self, root, parents, var):
+        """return True if every step of the path from `root` to `var` links to
+        a single value, `var` being an intermediate variable of the path
+        """
+        if var == root:
+            return True
+        try:
+            return self._prefixes[(root, var)]
+        except KeyError:
+            pass
+        # walk up to the first known prefix then check steps downward, so
+        # that they are checked in path order
+        path = []
+        while var != root and (root, var) not in self._prefixes:
+            path.append(var)
+            var = parents[var]
+        ok = var == root or self._prefixes[(root, var)]
+        for nextvar in reversed(path):
+            ok = ok and self._hop_ok(var, nextvar, False)
+            self._prefixes[(root, nextvar)] = ok
+            var = nextvar
+        return ok
+
+    def has_unique_value_path(self, fromvar, tovar):
+        parents = self._tree(fromvar)
+        if tovar == fromvar or tovar not in parents:
+            return False
+        parent = parents[tovar]
+        return (self._prefix_ok(fromvar, parents, parent)
+                and self._hop_ok(parent, tovar, True))
+
+
+def _outer_reference(vref, select):
+    """return True if `vref` isn't in an EXISTS or NOT subtree of `select`"""
+    node = vref.parent
+    while node is not select:
+        if isinstance(node, (Exists, Not)):
+            return False
+        node = node.parent
+    return True
+
+
+def disconnected_components(select):
+    """return the list of groups (sets of names) of variables and column
+    aliases of `select` which are not linked to each other, either by a
+    relation (possibly to an expression over variables), through a subquery
+    (see `select.vargraph`) or by a HAVING comparison. More than one group
+    implies a cartesian product.
+
+    Variables only referenced in EXISTS or NOT subtrees are ignored since they
+    don't imply a cartesian product.
+    """
+    graph = dict(select.vargraph or ())
+    if select.where is not None:
+        # relations to a plain variable are in the vargraph, not those to an
+        # expression such as `Y creation_date A + 1`
+        for relation in select.where.iget_nodes(Relation):
+            rhs = relation.children[1].children[0]
+            if isinstance(rhs, VariableRef):
+                continue
+            lhsname = relation.children[0].name
+            for vref in rhs.iget_nodes(VariableRef):
+                graph[lhsname] = list(graph.get(lhsname, ())) + [vref.name]
+                graph[vref.name] = list(graph.get(vref.name, ())) + [lhsname]
+    for term in select.having or ():
+        for comparison in term.iget_nodes(Comparison):
+            vnames = set(vref.name for vref in comparison.iget_nodes(VariableRef))
+            for vname in vnames:
+                graph[vname] = list(graph.get(vname, ())) + list(vnames)
+    names = set(select.aliases)
+    for var in select.defined_vars.values():
+        if any(_outer_reference(vref, select) for vref in var.references()):
+            names.add(var.name)
+    components = []
+    seen = set()
+    for name in sorted(names):
+        if name in seen:
+            continue
+        component = set()
+        stack = [name]
+        while stack:
+            vname = stack.pop()
+            if vname in seen:
+                continue
+            seen.add(vname)
+            if vname in names:
+                component.add(vname)
+            stack += graph.get(vname, ())
+        components.append(component)
+    return components
+
+
 class RQLSTChecker(object):
     """Check a RQL syntax tree for errors not detected on parsing.
 
@@ -80,12 +240,20 @@ class RQLSTChecker(object):
 
     use assertions for internal error but specific `BadRQLQuery` exception for
     errors due to a bad rql input
+
+    `cartesian` tells what to do with selects implying a cartesian product
+    (see `disconnected_components`): nothing if None (the default), emit a
+    `CartesianProductWarning` if 'warn', or consider it as an error if
+    'error'.
     """
 
-    def __init__(self, schema, special_relations=None, backend=None):
+    def __init__(self, schema, special_relations=None, backend=None,
+                 cartesian=None):
+        assert cartesian in (None, 'warn', 'error'), cartesian
         self.schema = schema
         self.special_relations = special_relations or {}
         self.backend = backend
+        self.cartesian = cartesian
 
     def check(self, node):
         state = STCheckState()
@@ -100,13 +268,13 @@ class RQLSTChecker(object):
 
     def _visit(self, node, state):
         try:
-            node.accept(self, state)
+            visitor_handler(self, node)(self, node, state)
         except GoTo as ex:
             self._visit(ex.node, state)
         else:
             for c in node.children:
                 self._visit(c, state)
-            node.leave(self, state)
+            visitor_handler(self, node, 'leave')(self, node, state)
 
     def _visit_selectedterm(self, node, state):
         for i, term in enumerate(node.selection):
@@ -170,13 +338,15 @@ class RQLSTChecker(object):
             # a selected variable with only ?1 cardinality selected
             selectidx = frozenset(vref.name for term in selected
                                   for vref in term.get_nodes(VariableRef))
+            vgindex = VarGraphIndex(self.schema, node)
             for sortterm in node.orderby:
                 for vref in sortterm.term.get_nodes(VariableRef):
                     if vref.name in selectidx:
                         continue
                     for vname in selectidx:
                         try:
-                            if self.has_unique_value_path(node, vname, vref.name):
+                            if self.has_unique_value_path(node, vname, vref.name,
+                                                          vgindex):
                                 break
                         except KeyError:
                             continue  # unlinked variable (usually from a subquery)
@@ -185,28 +355,32 @@ class RQLSTChecker(object):
                                ' variable in the selection but may have different'
                                ' values for a resulting row')
                         state.error(msg % vref.name)
+        if self.cartesian is not None:
+            self._check_cartesian(node, state)
 
-    def has_unique_value_path(self, select, fromvar, tovar):
-        graph = select.vargraph
-        path = has_path(graph, fromvar, tovar)
-        if path is None:
-            return False
-        for var in path:
-            try:
-                rtype = graph[(fromvar, var)]
-                cardidx = 0
-            except KeyError:
-                rtype = graph[(var, fromvar)]
-                cardidx = 1
-            rschema = self.schema.rschema(rtype)
-            for rdef in rschema.rdefs.values():
-                # XXX aggregats handling needs much probably some enhancements...
-                if not (var in select.aggregated
-                        or (rdef.cardinality[cardidx] in '?1' and
-                            (var == tovar or not rschema.final))):
-                    return False
-            fromvar = var
-        return True
+    def _check_cartesian(self, select, state):
+        components = disconnected_components(select)
+        if len(components) < 2:
+            return
+        msg = 'cartesian product between unrelated variables %s' % ', '.join(
+            '(%s)' % ', '.join(sorted(component)) for component in components)
+        if self.cartesian == 'error':
+            state.error(msg)
+        else:
+            warnings.warn('%s in "%s"' % (msg, select.as_string()),
+                          CartesianProductWarning, stacklevel=2)
+
+    def has_unique_value_path(self, select, fromvar, tovar, vgindex=None):
+        """return True if `tovar` is reachable from `fromvar` in the select's
+        variables graph, through relations where each `fromvar` value is
+        linked to a single value.
+
+        `vgindex` is an optional :class:`VarGraphIndex` for `select`, which
+        should be given when checking several paths of the same select.
+        """
+        if vgindex is None:
+            vgindex = VarGraphIndex(self.schema, select)
+        return vgindex.has_unique_value_path(fromvar, tovar)
 
     def visit_insert(self, insert, state):
         self._visit_selectedterm(insert, state)
@@ -394,6 +568,9 @@ class RQLSTChecker(object):
 
             for vref in relation.children[1].get_nodes(VariableRef):
                 state.add_var_info(vref.variable, VAR_HAS_REL)
+        self._update_vargraph(relation, lhsvar)
+
+    def _update_vargraph(self, relation, lhsvar):
         try:
             vargraph = relation.stmt.vargraph
             rhsvarname = relation.children[1].children[0].variable.name
@@ -447,12 +624,15 @@ class RQLSTChecker(object):
                        function.children[0].descr().aggregat:
                     state.error('can\'t nest aggregat functions')
             if funcdescr.name == 'IN':
-                # assert function.parent.operator == '='
-                if len(function.children) == 1:
-                    function.parent.append(function.children[0])
-                    function.parent.remove(function)
-                # else:
-                #    assert len(function.children) >= 1
+                self._normalize_in(function)
+
+    def _normalize_in(self, function):
+        # assert function.parent.operator == '='
+        if len(function.children) == 1:
+            function.parent.append(function.children[0])
+            function.parent.remove(function)
+        # else:
+        #    assert len(function.children) >= 1
 
     def leave_function(self, node, state):
         pass
@@ -483,6 +663,38 @@ class RQLSTChecker(object):
         pass
 
 
+class RQLSTNormalizer(RQLSTChecker):
+    """Do the syntax tree rewriting and variable graph computation done by
+    :class:`RQLSTChecker`, without checking for errors.
+
+    This is intended for queries which are known to be valid (eg validated
+    once by the checker), for which only the tree normalization expected by
+    further processing is needed.
+    """
+
+    def check(self, node):
+        self._visit(node, STCheckState())
+
+    def visit_union(self, node, state):
+        pass
+
+    def leave_select(self, node, state):
+        pass
+
+    def visit_sortterm(self, sortterm, state):
+        pass
+
+    def visit_relation(self, relation, state):
+        self._update_vargraph(relation, relation.children[0].variable)
+
+    def visit_function(self, function, state):
+        if function.name == 'IN':
+            self._normalize_in(function)
+
+    def visit_constant(self, constant, state):
+        pass
+
+
 class RQLSTAnnotator(object):
     """Annotate RQL syntax tree to ease further code generation from it.
 
@@ -498,8 +710,12 @@ class RQLSTAnnotator(object):
         # assert not node.annotated
         node.accept(self)
         node.annotated = True
+        node.annotator = self
+        node.invalidate_descriptions()
 
     def _visit_stmt(self, node):
+        # index of scope nodes, shared by scope computations during this visit
+        node.scopes_index = {}
         for var in node.defined_vars.values():
             var.prepare_annotation()
         for i, term in enumerate(node.selection):
@@ -513,6 +729,7 @@ class RQLSTAnnotator(object):
                 vref.variable.set_scope(node)
         if node.where is not None:
             node.where.accept(self, node)
+        node.scopes_index = None
 
     visit_insert = visit_delete = visit_set = _visit_stmt
 
@@ -25,7 +25,6 @@ from __future__ import print_function
 
 __docformat__ = "restructuredtext en"
 
-from copy import deepcopy
 from warnings import warn
 
 from six import integer_types
@@ -33,8 +32,9 @@ from six.moves import range
 
 from logilab.common.deprecation import deprecated
 
-from rql import BadRQLQuery, CoercionError, nodes
-from rql.base import BaseNode, Node
+from rql import (BadRQLQuery, CoercionError, FrozenTreeError, RQLException,
+                 nodes)
+from rql.base import BaseNode, Node, combine_fingerprints
 from rql.utils import rqlvar_maker
 
 _MARKER = object()
@@ -54,6 +54,173 @@ def _check_references(defined, varrefs):
     return True
 
 
+class TreeCopier(object):
+    """Copy syntax tree nodes into the `stmt` statement, as `node.copy(stmt)`
+    would do.
+
+    Nodes of known classes are created without going through their
+    constructor and edition methods, and variables are mapped once to the
+    statement's variables. Other nodes are copied using their `copy` method.
+    """
+
+    def __init__(self, stmt):
+        self.stmt = stmt
+        # map original variables to the statement's variables
+        self.variables = {}
+
+    def copy(self, node):
+        try:
+            copier = _NODE_COPIERS[node.__class__]
+        except KeyError:
+            return node.copy(self.stmt)
+        return copier(self, node)
+
+    def variable(self, vref):
+        var = vref.variable
+        try:
+            return self.variables[var]
+        except KeyError:
+            if isinstance(var, nodes.ColumnAlias):
+                newvar = self.stmt.get_variable(vref.name, var.colnum)
+            else:
+                newvar = self.stmt.get_variable(vref.name)
+            newvar.init_copy(var)
+            self.variables[var] = newvar
+            return newvar
+
+
+def _node_copier(cls, attrs):
+    def copy_node(copier, node):
+        new = cls.__new__(cls)
+        for attr in attrs:
+            setattr(new, attr, getattr(node, attr))
+        new.parent = None
+        new._fpcache = None
+        new.children = children = []
+        for child in node.children:
+            # inlined TreeCopier.copy
+            copy_child = _NODE_COPIERS.get(child.__class__)
+            if copy_child is None:
+                child = child.copy(copier.stmt)
+            else:
+                child = copy_child(copier, child)
+            child.parent = new
+            child._position = len(children)
+            children.append(child)
+        return new
+    return copy_node
+
+
+def _copy_variableref(copier, vref):
+    new = nodes.VariableRef.__new__(nodes.VariableRef)
+    new.variable = var = copier.variable(vref)
+    new.name = vref.name
+    new.parent = None
+    var.stinfo['references'].add(new)
+    return new
+
+
+def _copy_constant(copier, const):
+    new = nodes.Constant.__new__(nodes.Constant)
+    new.value = const.value
+    new.type = const.type
+    new.uid = const.uid
+    new.uidtype = const.uidtype
+    new.parent = None
+    return new
+
+
+def _copy_exists(copier, exists):
+    new = nodes.Exists.__new__(nodes.Exists)
+    new.parent = None
+    new.query = copier.copy(exists.query)
+    new.query.parent = new
+    return new
+
+
+def _copy_subquery(copier, subquery):
+    new = nodes.SubQuery.__new__(nodes.SubQuery)
+    new.parent = None
+    new.aliases = [copier.copy(vref) for vref in subquery.aliases]
+    for vref in new.aliases:
+        vref.parent = new
+    new.query = subquery.query.copy()
+    new.query.parent = new
+    return new
+
+
+_NODE_COPIERS = {
+    nodes.And: _node_copier(nodes.And, ()),
+    nodes.Or: _node_copier(nodes.Or, ()),
+    nodes.Not: _node_copier(nodes.Not, ()),
+    nodes.Relation: _node_copier(nodes.Relation, ('r_type', 'optional')),
+    nodes.Comparison: _node_copier(nodes.Comparison, ('operator', 'optional')),
+    nodes.MathExpression: _node_copier(nodes.MathExpression, ('operator',)),
+    nodes.UnaryExpression: _node_copier(nodes.UnaryExpression, ('operator',)),
+    nodes.Function: _node_copier(nodes.Function, ('name',)),
+    nodes.SortTerm: _node_copier(nodes.SortTerm, ('asc',)),
+    nodes.VariableRef: _copy_variableref,
+    nodes.Constant: _copy_constant,
+    nodes.Exists: _copy_exists,
+    nodes.SubQuery: _copy_subquery,
+}
+
+
+# frozen trees ################################################################
+
+# names of methods modifying syntax tree nodes
+TREE_EDITION_METHODS = frozenset((
+    # nodes
+    'append', 'insert', 'remove', 'replace', 'set_where', 'set_optional',
+    'change_optional', 'set_aliases', 'set_query', 'add_restriction',
+    'add_type_restriction', 'add_constant_restriction', 'add_eid_restriction',
+    'add_relation', 'remove_node',
+    # statements
+    'add_group_var', 'add_main_relation', 'add_main_variable', 'add_selected',
+    'add_sort_term', 'add_sort_var', 'add_subquery', 'append_select',
+    'append_selected', 'make_variable', 'save_state', 'recover',
+    'remove_group_term', 'remove_groups', 'remove_select', 'remove_selected',
+    'remove_sort_term', 'remove_sort_terms', 'remove_subquery',
+    'select_only_variables', 'set_distinct', 'set_groupby', 'set_having',
+    'set_limit', 'set_offset', 'set_orderby', 'set_possible_types',
+    'set_statement_type', 'set_with', 'undefine_variable', 'wrap_selects',
+    'clean_solutions',
+))
+
+# map node classes to their frozen counterpart
+_FROZEN_CLASSES = {}
+
+
+def _frozen_method(name):
+    def method(self, *args, **kwargs):
+        raise FrozenTreeError("can't call %s() on a frozen syntax tree" % name)
+    method.__name__ = name
+    return method
+
+
+def frozen_class(cls):
+    """Return the frozen counterpart of the `cls` node class: a subclass whose
+    tree edition methods raise :exc:`FrozenTreeError`.
+    """
+    if cls.frozen:
+        return cls
+    try:
+        return _FROZEN_CLASSES[cls]
+    except KeyError:
+        pass
+    attrs = {'__slots__': (), 'frozen': True, '_thawed_class': cls}
+    for name in TREE_EDITION_METHODS:
+        if hasattr(cls, name):
+            attrs[name] = _frozen_method(name)
+    frozen = type('Frozen' + cls.__name__, (cls,), attrs)
+    try:
+        _NODE_COPIERS[frozen] = _NODE_COPIERS[cls]
+    except KeyError:
+        pass
+    _FROZEN_CLASSES[cls] = frozen
+    return frozen
+
+
 class undo_modification(object):
     def __init__(self, select):
         self.select = select
@@ -82,6 +249,7 @@ class ScopeNode(BaseNode):
     def set_where(self, node):
         self.where = node
         node.parent = self
+        self.invalidate_nodes_index()
 
     def set_having(self, terms):
         if self.should_register_op:
@@ -91,15 +259,17 @@ class ScopeNode(BaseNode):
         self.having = terms
         for node in terms:
             node.parent = self
+        self.invalidate_nodes_index()
 
     def copy(self, copy_solutions=True, solutions=None):
-        new = self.__class__()
+        new = self._thawed_class()
         if self.schema is not None:
             new.schema = self.schema
         if solutions is not None:
             new.solutions = solutions
         elif copy_solutions and self.solutions:
-            new.solutions = deepcopy(self.solutions)
+            # solutions are dictionaries of strings, no need for a deep copy
+            new.solutions = [solution.copy() for solution in self.solutions]
         return new
 
     # construction helper methods #############################################
@@ -116,12 +286,11 @@ class ScopeNode(BaseNode):
 
         the variable is created if it doesn't exist yet
         """
-        try:
-            return self.defined_vars[name]
-        except Exception:
+        var = self.defined_vars.get(name)
+        if var is None:
             self.defined_vars[name] = var = nodes.Variable(name)
             var.stmt = self
-            return var
+        return var
 
     def allocate_varname(self):
         """return an yet undefined variable name"""
@@ -147,6 +316,7 @@ class ScopeNode(BaseNode):
             var.stinfo[key] = set()
             for solution in solutions:
                 var.stinfo[key].add(solution[var.name])
+        self.invalidate_descriptions()
         # for debugging
         # for sol in solutions:
         #    for vname in sol:
@@ -179,6 +349,10 @@ class Statement(object):
     # used
     schema = None     # ISchema
     annotated = False  # set by the annotator
+    annotator = None  # set by the annotator, used to annotate recovered selects
+    frozen = False    # set by `freeze`
+    scopes_index = None  # set by the annotator during annotation
+    _nodes_index = None  # per class nodes index, see `get_nodes`
 
     # navigation helper methods #############################################
 
@@ -201,6 +375,111 @@ class Statement(object):
     def neged(self, traverse_scope=False, _fromnode=None, strict=False):
         return None
 
+    # node index ##############################################################
+
+    def get_nodes(self, klass):
+        """Return the list of nodes of a given class in the statement.
+
+        Results are indexed per class on the statement (the index is dropped
+        by methods modifying the tree), so that repeated lookups on the same
+        tree don't walk it again.
+        """
+        return list(self._indexed_nodes(klass))
+
+    def iget_nodes(self, klass):
+        """Return an iterator over nodes of a given class in the statement
+        (see `get_nodes`).
+        """
+        return iter(self._indexed_nodes(klass))
+
+    def _indexed_nodes(self, klass):
+        index = self._nodes_index
+        if index is None:
+            if self.frozen:
+                return tuple(BaseNode.get_nodes(self, klass))
+            index = self._nodes_index = {}
+        try:
+            return index[klass]
+        except KeyError:
+            found = tuple(BaseNode.get_nodes(self, klass))
+            # the index of frozen trees is filled by `freeze`
+            if not self.frozen:
+                index[klass] = found
+            return found
+
+    # frozen trees ############################################################
+
+    def freeze(self):
+        """Make the tree read-only: tree edition methods of its nodes (append,
+        replace, remove, set_*...) will raise :exc:`FrozenTreeError`, so the
+        tree may be safely shared (eg between threads or in a cache).
+
+        Freezing should be done once annotation and solutions computation are
+        done. Attributes and variables information (`stinfo`) modified
+        directly are not protected. Frozen nodes are instances of classes
+        built on the fly, so the tree should be thawed before being pickled;
+        they are otherwise visited, compared and fingerprinted as their
+        mutable counterpart.
+
+        Fingerprints and statements nodes index are computed when freezing and
+        aren't written afterwards, nor are column descriptions cached (see
+        `Union.get_description`), so that frozen trees are never modified.
+
+        Return the tree itself.
+        """
+        if self.frozen:
+            return self
+        self.invalidate_nodes_index()
+        # fill caches which won't be written once frozen
+        self.fingerprint()
+        self.fingerprint(abstract_constants=True)
+        treenodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            treenodes.append(node)
+            stack += node.children
+        classes = set(node.__class__ for node in treenodes)
+        for node in treenodes:
+            if isinstance(node, Statement):
+                node._nodes_index = dict(
+                    (klass, tuple(BaseNode.get_nodes(node, klass)))
+                    for klass in classes)
+        for node in treenodes:
+            node.__class__ = frozen_class(node.__class__)
+        return self
+
+    def thaw(self):
+        """Return a mutable version of the tree: a copy if it is frozen, else
+        the tree itself.
+        """
+        if self.frozen:
+            return self.copy()
+        return self
+
+    # fingerprint #############################################################
+
+    def _fingerprint(self, abstract_constants):
+        # statements are not cached since they may be modified without
+        # notification, and their variables are not visible from the outside
+        sections = [
+            combine_fingerprints(label, [node._fingerprint(abstract_constants)
+                                         for node in terms])
+            for label, terms in self._fingerprint_sections()]
+        label = self._fingerprint_label(abstract_constants)
+        return combine_fingerprints(label, sections)[0], ()
+
+    def _fingerprint_sections(self):
+        """Return a list of (label, nodes) describing the statement's clauses
+        for fingerprint computation.
+        """
+        return [('children', self.children)]
+
+    def _where_fingerprint_sections(self):
+        if self.where is None:
+            return [('where', ()), ('having', self.having)]
+        return [('where', (self.where,)), ('having', self.having)]
+
 
 class Union(Statement, Node):
     """the select node is the root of the syntax tree for selection statement
@@ -211,6 +490,14 @@ class Union(Statement, Node):
     # used
     undoing = False  # used to prevent from memorizing when undoing !
     memorizing = 0   # recoverable modification attributes
+    # maximum number of operations retained by the undo manager, None for no
+    # limit (see `rql.undo.SelectionManager`)
+    max_undo_operations = None
+    undo_mode = 'operations'  # see `set_undo_mode`
+    # column descriptions cached by `get_description`
+    _descriptions = None
+    # maximum number of (mainindex, tr) keys of this cache
+    max_cached_descriptions = 8
 
     def wrap_selects(self):
         """return a new rqlst root containing the given union as a subquery"""
@@ -269,11 +556,32 @@ class Union(Statement, Node):
         `tr`:
           optional translation function taking a string as argument and
           returning a string
+
+        Descriptions are cached for each (`mainindex`, `tr`) pair until the
+        tree is modified, annotated or solved again, unless the tree is
+        frozen. The cache keeps at most
+        `max_cached_descriptions` pairs, hence references to as many
+        translation functions.
         """
-        if tr is None:
-            def tr(x, **k):
-                return x
-        return [c.get_description(mainindex, tr) for c in self.children]
+        descriptions = self._descriptions
+        if descriptions is None:
+            descriptions = {}
+            # frozen trees are never written, hence have no cache
+            if not self.frozen:
+                self._descriptions = descriptions
+        try:
+            description = descriptions[(mainindex, tr)]
+        except KeyError:
+            if len(descriptions) >= self.max_cached_descriptions:
+                descriptions.clear()
+            if tr is None:
+                def translate(x, **k):
+                    return x
+            else:
+                translate = tr
+            description = descriptions[(mainindex, tr)] = [
+                c.get_description(mainindex, translate) for c in self.children]
+        return [list(descr) for descr in description]
 
     # repr / as_string / copy #################################################
 
@@ -377,13 +685,38 @@ class Union(Statement, Node):
         try:
             return self._undo_manager
         except AttributeError:
-            from rql.undo import SelectionManager
-            self._undo_manager = SelectionManager(self)
+            from rql.undo import SelectionManager, SnapshotManager
+            if self.undo_mode == 'snapshot':
+                self._undo_manager = SnapshotManager(self)
+            else:
+                self._undo_manager = SelectionManager(self,
+                                                      self.max_undo_operations)
             return self._undo_manager
 
     @property
     def should_register_op(self):
-        return self.memorizing and not self.undoing
+        return (self.memorizing and not self.undoing
+                and self.undo_mode == 'operations')
+
+    def set_undo_mode(self, mode):
+        """select how `save_state` and `recover` work:
+
+        * 'operations' (the default): modifications are recorded and undone
+          one by one (see `rql.undo.SelectionManager`),
+        * 'snapshot': selects are copied when the state is saved and put back
+          in place when it's recovered (see `rql.undo.SnapshotManager`).
+
+        The mode can't be changed while a state is saved.
+        """
+        if mode not in ('operations', 'snapshot'):
+            raise ValueError('unknown undo mode %r' % mode)
+        if self.memorizing:
+            raise RQLException("can't change undo mode while a state is saved")
+        self.undo_mode = mode
+        try:
+            del self._undo_manager
+        except AttributeError:
+            pass
 
     def undo_modification(self):
         return undo_modification(self)
@@ -409,14 +742,18 @@ class Union(Statement, Node):
         if self.should_register_op:
             from rql.undo import AppendSelectOperation
             self.undo_manager.add_operation(AppendSelectOperation(self, select))
+        select._position = len(self.children)
         self.children.append(select)
+        self.invalidate_nodes_index()
 
     def remove_select(self, select):
-        idx = self.children.index(select)
+        idx = self.child_index(select)
         if self.should_register_op:
             from rql.undo import RemoveSelectOperation
             self.undo_manager.add_operation(RemoveSelectOperation(self, select, idx))
         self.children.pop(idx)
+        self._update_positions(idx)
+        self.invalidate_nodes_index()
 
 
 class Select(Statement, nodes.EditableMixIn, ScopeNode):
@@ -480,6 +817,15 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
             children += self.with_
         return children
 
+    def _fingerprint_label(self, abstract_constants):
+        return ('Select', self.distinct, self.limit, self.offset)
+
+    def _fingerprint_sections(self):
+        return ([('selection', self.selection), ('groupby', self.groupby),
+                 ('orderby', self.orderby)]
+                + self._where_fingerprint_sections()
+                + [('with', self.with_)])
+
     # repr / as_string / copy #################################################
 
     def __repr__(self):
@@ -517,18 +863,19 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
 
     def copy(self, copy_solutions=True, solutions=None):
         new = ScopeNode.copy(self, copy_solutions, solutions)
+        copy = TreeCopier(new).copy
         if self.with_:
-            new.set_with([sq.copy(new) for sq in self.with_], check=False)
+            new.set_with([copy(sq) for sq in self.with_], check=False)
         for child in self.selection:
-            new.append_selected(child.copy(new))
+            new.append_selected(copy(child))
         if self.groupby:
-            new.set_groupby([sq.copy(new) for sq in self.groupby])
+            new.set_groupby([copy(sq) for sq in self.groupby])
         if self.orderby:
-            new.set_orderby([sq.copy(new) for sq in self.orderby])
+            new.set_orderby([copy(sq) for sq in self.orderby])
         if self.where:
-            new.set_where(self.where.copy(new))
+            new.set_where(copy(self.where))
         if self.having:
-            new.set_having([sq.copy(new) for sq in self.having])
+            new.set_having([copy(sq) for sq in self.having])
         new.distinct = self.distinct
         new.limit = self.limit
         new.offset = self.offset
@@ -598,11 +945,13 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
         self.orderby = terms
         for node in terms:
             node.parent = self
+        self.invalidate_nodes_index()
 
     def set_groupby(self, terms):
         self.groupby = terms
         for node in terms:
             node.parent = self
+        self.invalidate_nodes_index()
 
     def set_with(self, terms, check=True):
         self.with_ = []
@@ -615,6 +964,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
             self.with_ = []
         node.parent = self
         self.with_.append(node)
+        self.invalidate_nodes_index()
         if check and len(node.aliases) != len(node.query.children[0].selection):
             raise BadRQLQuery('Should have the same number of aliases than '
                               'selected terms in sub-query')
@@ -628,6 +978,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
     def remove_subquery(self, node):
         self.with_.remove(node)
         node.parent = None
+        self.invalidate_nodes_index()
         for i, alias in enumerate(node.aliases):
             del self.aliases[alias.name]
 
@@ -671,6 +1022,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
                 if asol not in newsolutions:
                     newsolutions.append(asol)
             self.solutions = newsolutions
+        self.invalidate_descriptions()
 
     def get_selection_solutions(self):
         """return the set of variable names which take different type according
@@ -712,6 +1064,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
             raise BadRQLQuery('Entity type are not allowed in selection')
         term.parent = self
         self.selection.append(term)
+        self.invalidate_nodes_index()
 
     # XXX proprify edition, we should specify if we want:
     # * undo support
@@ -737,6 +1090,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
         # it...)
         oldnode.parent = None
         newnode.parent = self
+        self.invalidate_nodes_index()
         return oldnode, self, None
 
     def remove(self, node):
@@ -752,6 +1106,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
         else:
             raise Exception('duh XXX')
         node.parent = None
+        self.invalidate_nodes_index()
         return node, self, None
 
     def undefine_variable(self, var):
@@ -797,6 +1152,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
             self.undo_manager.add_operation(UnselectVarOperation(var, index))
         for vref in self.selection.pop(index).iget_nodes(nodes.VariableRef):
             vref.unregister_reference()
+        self.invalidate_nodes_index()
 
     def add_selected(self, term, index=None):
         """override Select.add_selected to memoize modification when needed"""
@@ -810,6 +1166,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
         if index is not None:
             self.selection.insert(index, term)
             term.parent = self
+            self.invalidate_nodes_index()
         else:
             self.append_selected(term)
         if self.should_register_op:
@@ -829,6 +1186,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
         else:
             self.groupby.insert(index, vref)
         vref.parent = self
+        self.invalidate_nodes_index()
         if self.should_register_op:
             from rql.undo import AddGroupOperation
             self.undo_manager.add_operation(AddGroupOperation(vref))
@@ -842,6 +1200,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
             vref.unregister_reference()
         index = next(i for i, g in enumerate(self.groupby) if term.is_equivalent(g))
         del self.groupby[index]
+        self.invalidate_nodes_index()
     remove_group_var = deprecated('[rql 0.29] use remove_group_term instead')(remove_group_term)
 
     def remove_groups(self):
@@ -865,6 +1224,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
         else:
             self.orderby.insert(index, term)
         term.parent = self
+        self.invalidate_nodes_index()
         for vref in term.iget_nodes(nodes.VariableRef):
             try:
                 vref.register_reference()
@@ -887,6 +1247,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
         for vref in term.iget_nodes(nodes.VariableRef):
             vref.unregister_reference()
         self.orderby.remove(term)
+        self.invalidate_nodes_index()
 
     def select_only_variables(self):
         selection = []
@@ -896,6 +1257,7 @@ class Select(Statement, nodes.EditableMixIn, ScopeNode):
                     vref.parent = self
                     selection.append(vref)
         self.selection = selection
+        self.invalidate_nodes_index()
 
 
 class Delete(Statement, ScopeNode):
@@ -923,12 +1285,21 @@ class Delete(Statement, ScopeNode):
     def selection(self):
         return [vref for et, vref in self.main_variables]
 
+    def _fingerprint_label(self, abstract_constants):
+        return (self.TYPE, tuple(etype for etype, vref in self.main_variables))
+
+    def _fingerprint_sections(self):
+        return ([('variables', self.selection),
+                 ('relations', self.main_relations)]
+                + self._where_fingerprint_sections())
+
     def add_main_variable(self, etype, vref):
         """add a variable to the list of deleted variables"""
         # if etype == 'Any':
         #    raise BadRQLQuery('"Any" is not supported in DELETE statement')
         vref.parent = self
         self.main_variables.append((etype, vref))
+        self.invalidate_nodes_index()
 
     def add_main_relation(self, relation):
         """add a relation to the list of deleted relations"""
@@ -937,6 +1308,7 @@ class Delete(Statement, ScopeNode):
         assert isinstance(relation.children[1].children[0], nodes.VariableRef)
         relation.parent = self
         self.main_relations.append(relation)
+        self.invalidate_nodes_index()
 
     # repr / as_string / copy #################################################
 
@@ -978,12 +1350,13 @@ class Delete(Statement, ScopeNode):
         for etype, var in self.main_variables:
             vref = nodes.VariableRef(new.get_variable(var.name))
             new.add_main_variable(etype, vref)
+        copy = TreeCopier(new).copy
         for child in self.main_relations:
-            new.add_main_relation(child.copy(new))
+            new.add_main_relation(copy(child))
         if self.where:
-            new.set_where(self.where.copy(new))
+            new.set_where(copy(self.where))
         if self.having:
-            new.set_having([sq.copy(new) for sq in self.having])
+            new.set_having([copy(sq) for sq in self.having])
         return new
 
 
@@ -1013,6 +1386,14 @@ class Insert(Statement, ScopeNode):
     def selection(self):
         return [vref for et, vref in self.main_variables]
 
+    def _fingerprint_label(self, abstract_constants):
+        return (self.TYPE, tuple(etype for etype, vref in self.main_variables))
+
+    def _fingerprint_sections(self):
+        return ([('variables', self.selection),
+                 ('relations', self.main_relations)]
+                + self._where_fingerprint_sections())
+
     def add_main_variable(self, etype, vref):
         """add a variable to the list of inserted variables"""
         if etype == 'Any':
@@ -1020,6 +1401,7 @@ class Insert(Statement, ScopeNode):
         self.main_variables.append((etype, vref))
         vref.parent = self
         self.inserted_variables[vref.variable] = 1
+        self.invalidate_nodes_index()
 
     def add_main_relation(self, relation):
         """add a relation to the list of inserted relations"""
@@ -1032,6 +1414,7 @@ insertion variable'
                 raise BadRQLQuery(msg % (var, var))
         relation.parent = self
         self.main_relations.append(relation)
+        self.invalidate_nodes_index()
 
     # repr / as_string / copy #################################################
 
@@ -1069,12 +1452,13 @@ insertion variable'
         for etype, var in self.main_variables:
             vref = nodes.VariableRef(new.get_variable(var.name))
             new.add_main_variable(etype, vref)
+        copy = TreeCopier(new).copy
         for child in self.main_relations:
-            new.add_main_relation(child.copy(new))
+            new.add_main_relation(copy(child))
         if self.where:
-            new.set_where(self.where.copy(new))
+            new.set_where(copy(self.where))
         if self.having:
-            new.set_having([sq.copy(new) for sq in self.having])
+            new.set_having([copy(sq) for sq in self.having])
         return new
 
 
@@ -1101,10 +1485,18 @@ class Set(Statement, ScopeNode):
     def selection(self):
         return []
 
+    def _fingerprint_label(self, abstract_constants):
+        return self.TYPE
+
+    def _fingerprint_sections(self):
+        return ([('relations', self.main_relations)]
+                + self._where_fingerprint_sections())
+
     def add_main_relation(self, relation):
         """add a relation to the list of modified relations"""
         relation.parent = self
         self.main_relations.append(relation)
+        self.invalidate_nodes_index()
 
     # repr / as_string / copy #################################################
 
@@ -1131,10 +1523,11 @@ class Set(Statement, ScopeNode):
 
     def copy(self):
         new = Set()
+        copy = TreeCopier(new).copy
         for child in self.main_relations:
-            new.add_main_relation(child.copy(new))
+            new.add_main_relation(copy(child))
         if self.where:
-            new.set_where(self.where.copy(new))
+            new.set_where(copy(self.where))
         if self.having:
-            new.set_having([sq.copy(new) for sq in self.having])
+            new.set_having([copy(sq) for sq in self.having])
         return new
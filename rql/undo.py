@@ -19,45 +19,136 @@
 
 __docformat__ = "restructuredtext en"
 
+from collections import deque
+
+from six.moves import range
+
+from rql._exceptions import UndoError
 from rql.nodes import Exists, VariableRef, BinaryNode
 from rql.stmts import Select
 
 
 class SelectionManager(object):
-    """Manage the operation stacks."""
+    """Manage the operation stacks.
 
-    def __init__(self, selection):
+    Operations are appended to `op_list` when done and popped from its end
+    when undone. `state_stack` holds the savepoints set by `push_state`, as
+    numbers of operations recorded since the manager's creation.
+
+    An operation is coalesced with the previous one when the latter has a
+    `merge` method accepting it, unless a savepoint lies between them.
+
+    If `max_operations` is set, only this number of operations is retained,
+    older ones being dropped. Savepoints set before dropped operations can't
+    be recovered anymore.
+    """
+
+    def __init__(self, selection, max_operations=None):
         self._selection = selection  # The selection tree
-        self.op_list = []           # The operations we'll have to undo
-        self.state_stack = []       # The save_state()'s index stack
+        self.op_list = deque(maxlen=max_operations)  # The operations we'll have to undo
+        self.state_stack = []       # The save_state()'s savepoints stack
+        self.nb_dropped = 0         # number of operations dropped from op_list
+
+    @property
+    def max_operations(self):
+        return self.op_list.maxlen
+
+    def __len__(self):
+        """return the number of operations recorded since the manager's
+        creation, including dropped ones
+        """
+        return self.nb_dropped + len(self.op_list)
 
     def push_state(self):
         """defines current state as the new 'start' state"""
-        self.state_stack.append(len(self.op_list))
+        self.state_stack.append(len(self))
 
     def recover(self):
         """recover to the latest pushed state"""
-        last_state_index = self.state_stack.pop()
-        # if last_index == 0, then there's no intermediate state => undo all !
-        for i in self.op_list[:-last_state_index] or self.op_list[:]:
+        savepoint = self.state_stack.pop()
+        if savepoint < self.nb_dropped:
+            raise UndoError('%s operations to undo have been dropped'
+                            % (self.nb_dropped - savepoint))
+        for i in range(len(self) - savepoint):
             self.undo()
 
     def add_operation(self, operation):
         """add an operation to the current ones"""
-        # stores operations in reverse order :
-        self.op_list.insert(0, operation)
+        if self.op_list and (not self.state_stack
+                             or len(self) > self.state_stack[-1]):
+            merge = getattr(self.op_list[-1], 'merge', None)
+            if merge is not None and merge(operation):
+                return
+        if len(self.op_list) == self.op_list.maxlen:
+            self.nb_dropped += 1
+        self.op_list.append(operation)
 
     def undo(self):
         """undo the latest operation"""
         assert len(self.op_list) > 0
-        op = self.op_list.pop(0)
+        op = self.op_list.pop()
         self._selection.undoing = 1
         op.undo(self._selection)
         self._selection.undoing = 0
 
     def flush(self):
         """flush the current operations"""
-        self.op_list = []
+        self.op_list.clear()
+        self.nb_dropped = 0
+        self.state_stack = [0] * len(self.state_stack)
+
+
+class SnapshotManager(object):
+    """Manage saved states of the tree as copies of its selects, as an
+    alternative to `SelectionManager` (see `Union.set_undo_mode`).
+
+    `push_state` copies selects of the union and `recover` puts the copies
+    back in place of the modified selects, whatever the number of
+    modifications done in between. Operations aren't recorded.
+
+    Recovered selects are new nodes: nodes of the tree should be fetched
+    again from the union. They are annotated again by the annotator of the
+    union if it was annotated.
+    """
+
+    def __init__(self, selection):
+        self._selection = selection  # The selection tree
+        self.state_stack = []       # copies of selects, None once flushed
+
+    def push_state(self):
+        """defines current state as the new 'start' state"""
+        self.state_stack.append([select.copy()
+                                 for select in self._selection.children])
+
+    def recover(self):
+        """recover to the latest pushed state"""
+        selects = self.state_stack.pop()
+        if selects is None:
+            return
+        union = self._selection
+        for select in union.children:
+            select.parent = None
+        del union.children[:]
+        for select in selects:
+            union.append(select)
+        try:
+            del union._subq_cache
+        except AttributeError:
+            pass
+        # copies aren't annotated
+        if union.annotated:
+            if union.annotator is None:
+                union.annotated = False
+            else:
+                for select in selects:
+                    union.annotator.annotate(select)
+
+    def add_operation(self, operation):
+        """operations aren't recorded"""
+
+    def flush(self):
+        """forget saved states"""
+        self.state_stack = [None] * len(self.state_stack)
 
 
 class NodeOperation(object):
@@ -122,9 +213,23 @@ class UnselectVarOperation(NodeOperation):
 
 class AddNodeOperation(NodeOperation):
     """Defines how to undo add_node()."""
+    # (node, stmt) of following add operations coalesced into this one
+    merged = ()
+
+    def merge(self, operation):
+        """coalesce a following add operation into this one"""
+        if type(operation) is not AddNodeOperation:
+            return False
+        if not self.merged:
+            self.merged = []
+        self.merged.append((operation.node, operation.stmt))
+        self.merged += operation.merged
+        return True
 
     def undo(self, selection):
         """undo the operation on the selection"""
+        for node, stmt in reversed(self.merged):
+            stmt.remove_node(node)
         self.stmt.remove_node(self.node)
 
 
@@ -135,6 +240,16 @@ class ReplaceNodeOperation(object):
         self.old_node = old_node
         self.new_node = new_node
 
+    def merge(self, operation):
+        """coalesce a following replacement of the node inserted by this
+        operation, eg when several restrictions are added in a row
+        """
+        if (type(operation) is not ReplaceNodeOperation
+                or operation.old_node is not self.new_node):
+            return False
+        self.new_node = operation.new_node
+        return True
+
     def undo(self, selection):
         """undo the operation on the selection"""
         # unregister reference from the inserted node
@@ -165,11 +280,13 @@ class RemoveNodeOperation(NodeOperation):
         """undo the operation on the selection"""
         parent = self.node_parent
         if self.index is None:
+            # a binary node's sibling of the removed node replaced it
             if isinstance(parent, Select):
+                sibling = parent.where
                 parent.where = self.node
             else:  # Exists
+                sibling = parent.query
                 parent.query = self.node
-            sibling = self.node
         if self.binary_remove:
             # if 'parent' was a BinaryNode, then first reinsert the removed node
             # at the same pos in the original 'parent' Binary Node, and then
@@ -179,11 +296,15 @@ class RemoveNodeOperation(NodeOperation):
             if self.index is not None:
                 sibling = self.node_parent.children[self.index]
                 parent.children[self.index] = self.node
+                self.node._position = self.index
             sibling.parent = self.node
         elif self.index is not None:
             parent.insert(self.index, self.node)
         # register reference from the removed node
         self.node.parent = parent
+        self.node.invalidate_fingerprint()
+        parent.invalidate_fingerprint()
+        parent.invalidate_nodes_index()
         for varref in self.node.iget_nodes(VariableRef):
             varref.register_reference()
 
@@ -235,6 +356,12 @@ class ChangeValueOperation(object):
         self.value = previous_value
         self.node = node
 
+    def merge(self, operation):
+        """coalesce a following change of the same value, since undoing this
+        operation restores the oldest value anyway
+        """
+        return type(operation) is type(self) and operation.node is self.node
+
 
 class SetDistinctOperation(ChangeValueOperation):
     """Defines how to undo 'set_distinct'."""
@@ -264,12 +391,13 @@ class SetOptionalOperation(ChangeValueOperation):
     """Defines how to undo 'set_limit'."""
 
     def __init__(self, rel, previous_value):
+        ChangeValueOperation.__init__(self, previous_value, rel)
         self.rel = rel
-        self.value = previous_value
 
     def undo(self, selection):
         """undo the operation on the selection"""
         self.rel.optional = self.value
+        self.rel.invalidate_fingerprint()
 
 
 class SetHavingOperation(object):
@@ -288,6 +416,7 @@ class SetHavingOperation(object):
             for varref in term.iget_nodes(VariableRef):
                 varref.unregister_reference()
         self.select.having = self.value
+        self.select.invalidate_nodes_index()
 
 # Union operations ############################################################
 
@@ -302,7 +431,10 @@ class AppendSelectOperation(object):
     def undo(self, selection):
         """undo the operation on the union's children"""
         self.select.parent = self.union
-        self.union.children.remove(self.select)
+        index = self.union.child_index(self.select)
+        del self.union.children[index]
+        self.union._update_positions(index)
+        self.union.invalidate_nodes_index()
 
 
 class RemoveSelectOperation(AppendSelectOperation):
@@ -317,8 +449,8 @@ class RemoveSelectOperation(AppendSelectOperation):
         self.union.insert(self.origindex, self.select)
 
 
-__all__ = ('SelectionManager', 'MakeVarOperation', 'UndefineVarOperation',
-           'SelectVarOperation', 'UnselectVarOperation', 'AddNodeOperation',
+__all__ = ('SelectionManager', 'SnapshotManager', 'MakeVarOperation',
+           'UndefineVarOperation', 'SelectVarOperation', 'UnselectVarOperation', 'AddNodeOperation',
            'ReplaceNodeOperation', 'RemoveNodeOperation',
            'AddSortOperation', 'AddGroupOperation',
            'SetOptionalOperation', 'SetDistinctOperation')
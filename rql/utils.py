@@ -17,6 +17,9 @@
 # with rql. If not, see <http://www.gnu.org/licenses/>.
 """Miscellaneous utilities for RQL."""
 
+from bisect import bisect
+from types import FunctionType
+
 from logilab.database import SQL_FUNCTIONS_REGISTRY, FunctionDescr, CAST
 from logilab.common.decorators import monkeypatch
 
@@ -142,6 +145,94 @@ def common_parent(node1, node2):
     raise Exception('DUH!')
 
 
+def _scope_info(scope, index):
+    """return (depth, parent scope) for the given scope node, filling `index`
+    for it and its ancestor scopes
+    """
+    try:
+        return index[scope]
+    except KeyError:
+        pass
+    chain = []
+    while scope is not None and scope not in index:
+        chain.append(scope)
+        if scope is scope.stmt:
+            scope = None
+        else:
+            scope = scope.parent.scope
+    depth = -1 if scope is None else index[scope][0]
+    for node in reversed(chain):
+        depth += 1
+        index[node] = (depth, scope)
+        scope = node
+    return index[scope]
+
+
+def common_scope(scope1, scope2, index=None):
+    """return the first common scope node (eg Select or Exists node) between
+    scope nodes scope1 and scope2
+
+    algorithm :
+     1) climb from the deepest scope until both scopes are at the same depth
+     2) climb from both scopes until we find a common scope
+
+    `index` is an optional dictionary caching scope nodes depth and parent
+    scope, which may be shared between calls as long as the tree is not
+    modified.
+    """
+    if index is None:
+        index = {}
+    depth1, parent1 = _scope_info(scope1, index)
+    depth2, parent2 = _scope_info(scope2, index)
+    while depth1 > depth2:
+        scope1 = parent1
+        depth1, parent1 = index[scope1]
+    while depth2 > depth1:
+        scope2 = parent2
+        depth2, parent2 = index[scope2]
+    while scope1 is not scope2:
+        if parent1 is None:
+            raise Exception('DUH!')
+        scope1, scope2 = parent1, parent2
+        parent1 = index[scope1][1]
+        parent2 = index[scope2][1]
+    return scope1
+
+
+# upper bounds (in seconds) of the duration histograms buckets of
+# `StageCounter`, the last bucket being for longer durations
+DURATION_BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.)
+
+
+class StageCounter(object):
+    """Count calls and time spent in a processing stage, with an histogram of
+    durations (see `DURATION_BUCKETS`).
+
+    Counters are not protected by a lock, so they may be slightly inaccurate
+    when updated concurrently.
+    """
+    __slots__ = ('count', 'errors', 'total', 'max', 'histogram')
+
+    def __init__(self):
+        self.count = self.errors = 0
+        self.total = self.max = 0.
+        self.histogram = [0] * (len(DURATION_BUCKETS) + 1)
+
+    def add(self, duration, failed=False):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.histogram[bisect(DURATION_BUCKETS, duration)] += 1
+
+    def as_dict(self):
+        return {'count': self.count, 'errors': self.errors,
+                'total': self.total, 'max': self.max,
+                'histogram': list(self.histogram)}
+
+
 def register_function(funcdef):
     RQL_FUNCTIONS_REGISTRY.register_function(funcdef)
     SQL_FUNCTIONS_REGISTRY.register_function(funcdef)
@@ -174,17 +265,75 @@ def uquote(value):
     return u''.join(res)
 
 
+# visitor dispatch ############################################################
+
+# maps a prefix ('visit' / 'leave') to the name of the visitor class attribute
+# holding its dispatch table, mapping node classes to handler functions. Tables
+# are stored on visitor classes so that they live as long as the class.
+_DISPATCH_TABLES = {'visit': '_rql_visit_table', 'leave': '_rql_leave_table'}
+
+
+def _class_handler(vclass, name):
+    """return the plain function defined as `name` on `vclass` (or one of its
+    ancestors), or None if there is no such function (eg method set on the
+    instance, or a descriptor other than a function)
+    """
+    for klass in getattr(vclass, '__mro__', ()):
+        try:
+            handler = klass.__dict__[name]
+        except KeyError:
+            continue
+        if isinstance(handler, FunctionType):
+            return handler
+        break
+    return None
+
+
+def _instance_handler(name):
+    """return a handler looking up `name` on the visitor at call time"""
+    def handler(visitor, node, *args, **kwargs):
+        return getattr(visitor, name)(node, *args, **kwargs)
+    return handler
+
+
+def visitor_handler(visitor, node, prefix='visit'):
+    """Return the function handling `node` for the given `visitor`, i.e. its
+    `<prefix>_<lowercased node class name>` method. The returned function
+    should be called with the visitor as first argument.
+
+    Handlers are resolved once per visitor class and node class, then stored in
+    a table on the visitor class keyed by node class, avoiding string formatting and attribute
+    lookups on each visit. Methods which are not defined on the visitor class
+    (eg set on the instance) are still looked up on the visitor at call time.
+    """
+    vclass = visitor.__class__
+    attr = _DISPATCH_TABLES[prefix]
+    # look in the class's own dictionary, subclasses get their own table
+    table = vclass.__dict__.get(attr)
+    if table is None:
+        table = {}
+        setattr(vclass, attr, table)
+    nclass = node.__class__
+    try:
+        return table[nclass]
+    except KeyError:
+        # nodes of frozen trees are handled as their mutable counterpart
+        if getattr(nclass, 'frozen', False):
+            name = '%s_%s' % (prefix, nclass._thawed_class.__name__.lower())
+        else:
+            name = '%s_%s' % (prefix, nclass.__name__.lower())
+        handler = _class_handler(vclass, name) or _instance_handler(name)
+        table[nclass] = handler
+        return handler
+
+
 class VisitableMixIn(object):
 
     def accept(self, visitor, *args, **kwargs):
-        visit_id = self.__class__.__name__.lower()
-        visit_method = getattr(visitor, 'visit_%s' % visit_id)
-        return visit_method(self, *args, **kwargs)
+        return visitor_handler(visitor, self)(visitor, self, *args, **kwargs)
 
     def leave(self, visitor, *args, **kwargs):
-        visit_id = self.__class__.__name__.lower()
-        visit_method = getattr(visitor, 'leave_%s' % visit_id)
-        return visit_method(self, *args, **kwargs)
+        return visitor_handler(visitor, self, 'leave')(visitor, self, *args, **kwargs)
 
 
 class RQLVisitorHandler(object):
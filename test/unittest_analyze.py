@@ -527,6 +527,46 @@ class AnalyzerClassTest(TestCase):
                                      {'Y': 'Person', 'L': 'Address',
                                       'F': 'String'}])
 
+    def test_slow_query_log(self):
+        records = []
+        self.helper.log_slow_queries(0, records.append)
+        rql = ('Any L, Y, F WHERE Y located L '
+               'WITH Y,F BEING ((Any X,F WHERE X is Person, X firstname F) '
+               'UNION (Any X,F WHERE X is Company, X name F))')
+        node = self.helper.parse(rql)
+        self.helper.compute_solutions(node, debug=DEBUG)
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record['rql'], node.as_string())
+        self.assertEqual(len(record['domains']), 3)
+        self.assertEqual(record['domains'][2], {'L': 11, 'Y': 2, 'F': 1})
+        self.assertEqual(record['variables'], 7)
+        self.assertEqual(record['solutions'], 4)
+        self.assertGreater(record['constraints'], 0)
+        self.assertGreaterEqual(record['time'], record['solve'])
+        node = self.helper.parse(UNRESOLVABLE_QUERIES[0])
+        self.assertRaises(TypeResolverException,
+                          self.helper.compute_solutions, node)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1]['solutions'], 0)
+        self.helper.log_slow_queries(None)
+        self.helper.compute_solutions(self.helper.parse(rql))
+        self.assertEqual(len(records), 2)
+
+    def test_slow_query_sink_error(self):
+        def sink(record):
+            raise ValueError('buggy sink')
+        self.helper.log_slow_queries(0, sink)
+        try:
+            node = self.helper.parse(UNRESOLVABLE_QUERIES[0])
+            # the resolution error isn't hidden by the sink's error
+            self.assertRaises(TypeResolverException,
+                              self.helper.compute_solutions, node)
+            node = self.helper.parse('Any X WHERE X is Person')
+            self.assertRaises(ValueError, self.helper.compute_solutions, node)
+        finally:
+            self.helper.log_slow_queries(None)
+
     def test_subqueries_aggregat(self):
         node = self.helper.parse('Any L, SUM(X)*100/Y GROUPBY L '
                                  'WHERE X is Person, X located L '
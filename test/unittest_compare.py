@@ -17,7 +17,8 @@
 # with rql. If not, see <http://www.gnu.org/licenses/>.
 from logilab.common.testlib import TestCase, SkipTest, unittest_main
 
-from rql import RQLHelper
+from rql import RQLHelper, parse
+from rql.compare import canonical_form, canonical_fingerprint
 from unittest_analyze import RelationSchema, EntitySchema, DummySchema as BaseSchema
 
 
@@ -220,5 +221,90 @@ class RQLCompareClassTest(TestCase):
         self._compareNotEquivalent(r1, r2)
 
 
+class CanonicalFingerprintTC(TestCase):
+
+    def assertSameFingerprint(self, rql1, rql2):
+        tree1, tree2 = parse(rql1), parse(rql2)
+        self.assertEqual(canonical_form(tree1), canonical_form(tree2))
+        self.assertEqual(canonical_fingerprint(tree1), canonical_fingerprint(tree2))
+
+    def assertDifferentFingerprint(self, rql1, rql2):
+        self.assertNotEqual(canonical_fingerprint(parse(rql1)),
+                            canonical_fingerprint(parse(rql2)))
+
+    def test_same(self):
+        for rql1, rql2 in (
+            ('Any X WHERE X name N, X work_for Y, Y name "a"',
+             'Any P WHERE C name "a", P work_for C, P name M'),
+            ('Any X WHERE X eid IN (1, 2, 3)',
+             'Any Y WHERE Y eid IN (3, 2, 1)'),
+            ('Any X,Y WHERE X age A, Y age B, X age > (A - B) * 2',
+             'Any X,Y WHERE X age A, Y age B, X age > 2 * (A - B)'),
+            ('Any X WHERE NOT EXISTS(X work_for Y, Y name "a") OR X name "b"',
+             'Any Z WHERE Z name "b" OR NOT EXISTS(Y name "a", Z work_for Y)'),
+            ('Any X,COUNT(Y) GROUPBY X WHERE X age A, Y age B HAVING COUNT(Y) = 2',
+             'Any X,COUNT(Y) GROUPBY X WHERE Y age B, X age A HAVING 2 = COUNT(Y)'),
+            ('(Any X WHERE X is Person) UNION (Any X WHERE X is Company)',
+             '(Any Y WHERE Y is Company) UNION (Any X WHERE X is Person)'),
+            ('Any N WITH X,N BEING (Any X,N WHERE X name N)',
+             'Any M WITH Y,M BEING (Any A,B WHERE A name B)'),
+            ('SET X name "a" WHERE X work_for Y, Y eid %(x)s',
+             'SET A name "a" WHERE B eid %(x)s, A work_for B'),
+        ):
+            with self.subTest(rql=rql1):
+                self.assertSameFingerprint(rql1, rql2)
+
+    def test_different(self):
+        for rql1, rql2 in (
+            ('Any X WHERE X work_for Y, Z work_for Y, Z name "a"',
+             'Any X WHERE X work_for Y, Z work_for Y, X name "a"'),
+            ('Any X,Y WHERE X name N, Y name M',
+             'Any Y,X WHERE X name N, Y name "a"'),
+            ('Any X ORDERBY N,F WHERE X name N, X firstname F',
+             'Any X ORDERBY F,N WHERE X name N, X firstname F'),
+            ('Any X,Y WHERE X age A, Y age B, X age > A - B',
+             'Any X,Y WHERE X age A, Y age B, X age > B - A'),
+            ('Any N WITH X,N BEING (Any X,N WHERE X name N)',
+             'Any N WITH N,X BEING (Any X,N WHERE X name N)'),
+        ):
+            with self.subTest(rql=rql1):
+                self.assertDifferentFingerprint(rql1, rql2)
+
+    def test_string_concatenation(self):
+        self.assertDifferentFingerprint('Any X WHERE X name "a" + "b"',
+                                        'Any X WHERE X name "b" + "a"')
+        # types of variables are unknown
+        self.assertDifferentFingerprint('Any X,Y WHERE X age A, Y age B, X age > A + B',
+                                        'Any X,Y WHERE X age A, Y age B, X age > B + A')
+        helper = RQLHelper(DummySchema(), None)
+        for solve in (False, True):
+            forms = []
+            for rql in ('Any X WHERE X name N, X firstname F, X name > N + F',
+                        'Any X WHERE X name N, X firstname F, X name > F + N'):
+                tree = helper.parse(rql)
+                if solve:
+                    helper.compute_solutions(tree)
+                forms.append(canonical_form(tree))
+            self.assertNotEqual(forms[0], forms[1], solve)
+
+    def test_numeric_addition(self):
+        helper = RQLHelper(DummySchema(), None)
+        for solve in (False, True):
+            forms = []
+            for rql in ('Any X,Y WHERE X number A, Y number B, X number > A + B * 2',
+                        'Any X,Y WHERE X number A, Y number B, X number > 2 * B + A'):
+                tree = helper.parse(rql)
+                if solve:
+                    helper.compute_solutions(tree)
+                forms.append(canonical_form(tree))
+            self.assertEqual(forms[0], forms[1], solve)
+
+    def test_tree_unchanged(self):
+        tree = parse('Any X WHERE X name N, X work_for Y, Y eid IN (2, 1)')
+        canonical_form(tree)
+        self.assertEqual(tree.as_string(),
+                         'Any X WHERE X name N, X work_for Y, Y eid IN(2, 1)')
+
+
 if __name__ == '__main__':
     unittest_main()
@@ -0,0 +1,87 @@
+# copyright 2004-2010 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This file is part of rql.
+#
+# rql is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# rql is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with rql. If not, see <http://www.gnu.org/licenses/>.
+from logilab.common.testlib import TestCase, unittest_main
+
+from rql import RQLHelper
+from unittest_analyze import DummySchema
+
+
+class CostEstimatorTC(TestCase):
+
+    def setUp(self):
+        self.helper = RQLHelper(DummySchema(), None)
+
+    def estimate(self, rql):
+        rqlst = self.helper.parse(rql)
+        self.helper.compute_solutions(rqlst)
+        return self.helper.estimate_cost(rqlst)
+
+    def test_attributes(self):
+        score, breakdown = self.estimate('Any X WHERE X name N')
+        self.assertEqual(score, 3)
+        self.assertEqual(breakdown, {'selects': 1, 'solutions': 3, 'joins': 0,
+                                     'fanouts': 0, 'cartesian': 0,
+                                     'optional': 0, 'aggregates': 0})
+
+    def test_fanouts(self):
+        # work_for is ?*, connait is **
+        score1, breakdown = self.estimate('Any X WHERE X work_for C, X is Person')
+        self.assertEqual((breakdown['joins'], breakdown['fanouts']), (1, 1))
+        score2, breakdown = self.estimate('Any X WHERE X connait Y, X is Person, '
+                                          'Y is Person')
+        self.assertEqual((breakdown['joins'], breakdown['fanouts']), (1, 2))
+        self.assertGreater(score2, score1)
+
+    def test_simplified(self):
+        helper = RQLHelper(DummySchema(), None, {'eid': 'uid'})
+        rqlst = helper.parse('Any Y WHERE X work_for Y, X eid 12')
+        helper.compute_solutions(rqlst)
+        helper.simplify(rqlst)
+        self.assertEqual(rqlst.as_string(), 'Any Y WHERE 12 work_for Y')
+        score, breakdown = helper.estimate_cost(rqlst)
+        self.assertEqual((breakdown['joins'], breakdown['fanouts']), (0, 0))
+
+    def test_cartesian(self):
+        score1, breakdown = self.estimate('Any X,Y WHERE X is Person, X work_for Y')
+        self.assertEqual(breakdown['cartesian'], 0)
+        score2, breakdown = self.estimate('Any X,Y WHERE X is Person, Y is Company')
+        self.assertEqual(breakdown['cartesian'], 1)
+        self.assertGreater(score2, score1)
+        for rql in ('Any X,Y WHERE X creation_date A, Y creation_date A + 1',
+                    'Any X,Y WHERE X name N, Y name UPPER(N)'):
+            score, breakdown = self.estimate(rql)
+            self.assertEqual(breakdown['cartesian'], 0)
+
+    def test_optional_aggregates(self):
+        score, breakdown = self.estimate('Any X,COUNT(C) GROUPBY X '
+                                         'WHERE X work_for C?, X is Person')
+        self.assertEqual(breakdown['optional'], 1)
+        self.assertEqual(breakdown['aggregates'], 1)
+        self.assertEqual(score, 1 + 1 + 5 + 2 + 2)
+
+    def test_subqueries(self):
+        score, breakdown = self.estimate(
+            'Any X WHERE X located L WITH L BEING '
+            '((Any A WHERE A is Address) UNION (Any A WHERE B located A))')
+        self.assertEqual(breakdown['selects'], 3)
+        self.assertEqual(breakdown['solutions'], 3 + 1 + 3)
+        self.assertEqual(breakdown['joins'], 2)
+
+
+if __name__ == '__main__':
+    unittest_main()
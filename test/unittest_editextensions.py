@@ -18,9 +18,21 @@
 
 from logilab.common.testlib import TestCase, unittest_main
 
-from rql import parse
+from rql import RQLException, RQLHelper, UndoError, parse
 from rql.nodes import Exists
 
+from unittest_analyze import DummySchema
+
+
+def stinfo_summary(select):
+    """return a comparable summary of variables information of `select`"""
+    summary = {}
+    for name, var in select.defined_vars.items():
+        summary[name] = (var.scope is select,
+                         sorted(rel.as_string() for rel in var.stinfo['relations']),
+                         sorted(var.stinfo['selected']))
+    return summary
+
 
 class RQLUndoTestCase(TestCase):
 
@@ -114,6 +126,138 @@ class RQLUndoTestCase(TestCase):
         # check references after recovering
         rqlst.check_references()
 
+    def test_nested_states(self):
+        rqlst = parse('Any X WHERE X is Person')
+        select = rqlst.children[0]
+        rqlst.save_state()
+        select.add_constant_restriction(select.defined_vars['X'], 'name',
+                                        'a', 'String')
+        rqlst.save_state()
+        # nothing to undo
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(),
+                         'Any X WHERE X is Person, X name "a"')
+        rqlst.save_state()
+        select.set_limit(10)
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(),
+                         'Any X WHERE X is Person, X name "a"')
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(), 'Any X WHERE X is Person')
+        rqlst.check_references()
+
+    def test_coalesce(self):
+        rqlst = parse('Any X WHERE X is Person')
+        select = rqlst.children[0]
+        var = select.defined_vars['X']
+        rqlst.save_state()
+        for limit in (10, 20, 30):
+            select.set_limit(limit)
+        select.set_offset(10)
+        select.set_offset(20)
+        rqlst.save_state()
+        select.set_limit(40)
+        for name in ('a', 'b', 'c'):
+            select.add_constant_restriction(var, 'name', name, 'String')
+        self.assertEqual(len(rqlst.undo_manager.op_list), 4)
+        rqlst.check_references()
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(),
+                         'Any X LIMIT 30 OFFSET 20 WHERE X is Person')
+        rqlst.check_references()
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(), 'Any X WHERE X is Person')
+        rqlst.check_references()
+
+    def test_coalesce_add_node(self):
+        rqlst = parse('(Any X) UNION (Any X)')
+        rqlst.save_state()
+        for select in rqlst.children:
+            select.add_type_restriction(select.defined_vars['X'], 'Person')
+        self.assertEqual(len(rqlst.undo_manager.op_list), 1)
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(), '(Any X) UNION (Any X)')
+        rqlst.check_references()
+
+    def test_max_operations(self):
+        rqlst = parse('Any X WHERE X is Person')
+        rqlst.max_undo_operations = 2
+        select = rqlst.children[0]
+        rqlst.save_state()
+        select.set_distinct(True)
+        rqlst.save_state()
+        select.set_limit(10)
+        select.set_offset(10)
+        self.assertEqual(len(rqlst.undo_manager.op_list), 2)
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(), 'DISTINCT Any X WHERE X is Person')
+        rqlst.save_state()
+        select.set_limit(10)
+        select.set_offset(10)
+        rqlst.recover()
+        # the operation setting DISTINCT has been dropped
+        self.assertRaises(UndoError, rqlst.recover)
+        self.assertEqual(rqlst.as_string(), 'DISTINCT Any X WHERE X is Person')
+
+    def test_snapshot(self):
+        rql = ('Any X,N WHERE X is Person, X name N, X work_for C WITH C BEING '
+               '(Any P WHERE P is Company)')
+        rqlst = parse(rql)
+        rqlst.set_undo_mode('snapshot')
+        select = rqlst.children[0]
+        rqlst.save_state()
+        select.remove_node(select.where.children[0])
+        select.set_limit(10)
+        rqlst.save_state()
+        select.add_eid_restriction(select.defined_vars['X'], 1)
+        rqlst.set_limit(5)
+        self.assertEqual(len(rqlst.undo_manager.state_stack), 2)
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(),
+                         'Any X,N LIMIT 10 WHERE X work_for C '
+                         'WITH C BEING (Any P WHERE P is Company)')
+        rqlst.check_references()
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(), rql)
+        rqlst.check_references()
+        select = rqlst.children[0]
+        self.assertIs(select.parent, rqlst)
+        for node in select.iget_nodes(object):
+            for child in node.children:
+                self.assertIs(child.parent, node)
+
+    def test_recover_annotations(self):
+        helper = RQLHelper(DummySchema(), None, {'eid': 'uid'})
+        for mode in ('operations', 'snapshot'):
+            rqlst = helper.parse('Any X,N WHERE X name N')
+            helper.compute_solutions(rqlst)
+            description = rqlst.get_description(0)
+            summary = stinfo_summary(rqlst.children[0])
+            rqlst.set_undo_mode(mode)
+            rqlst.save_state()
+            select = rqlst.children[0]
+            select.remove_selected(select.selection[1])
+            rqlst.recover()
+            self.assertTrue(rqlst.annotated, mode)
+            self.assertEqual(stinfo_summary(rqlst.children[0]), summary, mode)
+            self.assertEqual(rqlst.get_description(0), description, mode)
+            if mode == 'snapshot':
+                self.assertIsNot(rqlst.children[0], select)
+                self.assertIsNone(select.parent)
+
+    def test_undo_mode(self):
+        rqlst = parse('Any X WHERE X is Person')
+        self.assertRaises(ValueError, rqlst.set_undo_mode, 'copy')
+        rqlst.save_state()
+        self.assertRaises(RQLException, rqlst.set_undo_mode, 'snapshot')
+        rqlst.recover()
+        rqlst.set_undo_mode('snapshot')
+        self.assertEqual(rqlst.undo_manager.__class__.__name__,
+                         'SnapshotManager')
+        rqlst.set_undo_mode('operations')
+        self.assertEqual(rqlst.undo_manager.__class__.__name__,
+                         'SelectionManager')
+
 
 if __name__ == '__main__':
     unittest_main()
@@ -0,0 +1,81 @@
+# copyright 2004-2010 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This file is part of rql.
+#
+# rql is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# rql is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with rql. If not, see <http://www.gnu.org/licenses/>.
+"""Memory footprint regression tests, using tools/bench_memory.py.
+
+Thresholds are about 30% above values measured with CPython 3.11 (parsed: 4009,
+annotated: 4830, resolved: 6032 bytes/tree, stinfo: 1317 bytes/variable), so
+they may have to be updated when trees representation changes.
+"""
+
+import sys
+from os.path import dirname, join
+
+from logilab.common.testlib import TestCase, unittest_main
+
+from rql import RQLHelper
+
+try:
+    import tracemalloc  # noqa
+except ImportError:  # python 2
+    bench_memory = None
+else:
+    sys.path.insert(0, join(dirname(__file__), '..', 'tools'))
+    import bench_memory
+
+# maximum bytes retained per tree after each step
+TREE_THRESHOLDS = {'parsed': 5200, 'annotated': 6300, 'resolved': 7800}
+# maximum bytes per variable stinfo
+STINFO_THRESHOLD = 1700
+# maximum bytes per node for most common node types
+NODE_THRESHOLDS = {'VariableRef': 210, 'Relation': 360, 'Comparison': 340,
+                   'Constant': 230}
+
+
+class MemoryFootprintTC(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if bench_memory is None:
+            return
+        schema, queries = bench_memory.default_corpus()
+        helper = RQLHelper(schema, None, {'eid': 'uid'})
+        queries = bench_memory.valid_queries(helper, queries)
+        cls.result = bench_memory.measure(helper, queries)
+
+    def setUp(self):
+        if bench_memory is None:
+            self.skipTest('tracemalloc is not available')
+
+    def test_trees(self):
+        self.assertGreater(self.result['trees'], 100)
+        for step, threshold in sorted(TREE_THRESHOLDS.items()):
+            size = self.result[step] // self.result['trees']
+            self.assertLessEqual(size, threshold, '%s: %s bytes/tree' % (step, size))
+
+    def test_stinfo(self):
+        nbvars, size = self.result['stinfo']
+        self.assertLessEqual(size // nbvars, STINFO_THRESHOLD)
+
+    def test_nodes(self):
+        for name, threshold in sorted(NODE_THRESHOLDS.items()):
+            count, size = self.result['nodes'][name]
+            self.assertLessEqual(size // count, threshold, name)
+
+
+if __name__ == '__main__':
+    unittest_main()
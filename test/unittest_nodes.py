@@ -23,8 +23,10 @@ from datetime import date, datetime
 
 from logilab.common.testlib import TestCase, unittest_main
 
-from rql import nodes, stmts, parse, BadRQLQuery, RQLHelper, RQLException, CoercionError
+from rql import (nodes, stmts, parse, BadRQLQuery, RQLHelper, RQLException, CoercionError,
+                 FrozenTreeError)
 from rql.stcheck import RQLSTAnnotator
+from rql.compare import canonical_form
 
 from unittest_analyze import DummySchema
 schema = DummySchema()
@@ -500,6 +502,46 @@ class NodesTest(TestCase):
         sort = tree.children[0].orderby[0]
         self.check_equal_but_not_same(sort, sort.copy(select))
 
+    def test_copy_select(self):
+        tree = self._parse('Any X,N ORDERBY N WHERE X name N, X work_for Y?, '
+                           'NOT EXISTS(Y connait X) WITH N BEING (Any N WHERE Z name N)')
+        tree.children[0].solutions = [{'X': 'Person', 'Y': 'Company', 'N': 'String'}]
+        select = tree.children[0]
+        copy = select.copy()
+        self.assertEqual(copy.as_string(), select.as_string())
+        self.assertEqual(copy.solutions, select.solutions)
+        self.assertIsNot(copy.solutions[0], select.solutions[0])
+        self.assertEqual(sorted(copy.defined_vars), ['X', 'Y'])
+        self.assertEqual(copy.aliases['N'].query, copy.with_[0].query)
+        self.assertIsNot(copy.with_[0].query, select.with_[0].query)
+        for vref in copy.get_nodes(nodes.VariableRef):
+            self.assertIs(vref.variable.stmt, vref.stmt)
+        copy.check_references()
+        # optional on both sides of the relation
+        tree = self._parse('Any X,Y WHERE X? work_for Y?')
+        copy = tree.copy()
+        self.assertEqual(copy.as_string(), tree.as_string())
+
+    def test_index_path(self):
+        tree = self._parse('Any X WHERE X name IN("a", "b", "c", "d"), '
+                           'X work_for Y, EXISTS(Y connait X)')
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            self.assertIs(tree.go_to_index_path(node.index_path()), node)
+            stack += node.children
+        func = tree.get_nodes(nodes.Function)[0]
+        self.assertEqual([c.index_path()[-1] for c in func.children], [0, 1, 2, 3])
+        const = func.children[1]
+        func.remove(const)
+        self.assertEqual(func.child_index(func.children[2]), 2)
+        func.insert(0, const)
+        self.assertEqual([func.child_index(c) for c in func.children], [0, 1, 2, 3])
+        self.assertEqual([c.value for c in func.children], ['b', 'a', 'c', 'd'])
+        # positions are checked, children list modified directly are supported
+        func.children.reverse()
+        self.assertEqual([func.child_index(c) for c in func.children], [0, 1, 2, 3])
+
     def test_selected_index(self):
         tree = self._simpleparse("Any X ORDERBY N DESC WHERE X is Person, X name N")
         annotator.annotate(tree)
@@ -741,6 +783,24 @@ class NodesTest(TestCase):
         self.assertEqual(select.selection[0].get_type(), 'String')
         self.assertEqual(tree.get_description(0), [['String']])
 
+    def test_get_description_cache(self):
+        def upper(msgid, **kwargs):
+            return msgid.upper()
+        tree = sparse('Any X,N WHERE X name N')
+        descr = tree.get_description(0)
+        self.assertEqual(descr, [['Company, Person, Student', 'name']])
+        descr[0][0] = 'modified'
+        self.assertEqual(tree.get_description(0),
+                         [['Company, Person, Student', 'name']])
+        self.assertEqual(tree.get_description(0, upper),
+                         [['COMPANY, PERSON, STUDENT', 'NAME']])
+        self.assertEqual(len(tree._descriptions), 2)
+        select = tree.children[0]
+        select.set_possible_types([{'X': 'Person', 'N': 'String'}])
+        self.assertEqual(tree.get_description(0), [['Person', 'name']])
+        select.remove_selected(select.selection[1])
+        self.assertEqual(tree.get_description(0), [['Person']])
+
     def test_replace_node_select(self):
         tree = sparse(u'Any X, MAX(X) WHERE X name "toto tata"')
         select = tree.children[0]
@@ -785,6 +845,164 @@ class NodesTest(TestCase):
         sparse('SET X name "foo" WHERE X is Person HAVING MAX(X) > 1')
 
 
+class VariableInfoTC(TestCase):
+
+    def test_mapping(self):
+        stinfo = nodes.VariableInfo()
+        self.assertEqual(dict(stinfo), {'references': set(), 'relations': set(),
+                                        'rhsrelations': set(), 'selected': set()})
+        self.assertEqual(stinfo.get('relations'), set())
+        self.assertRaises(KeyError, stinfo.__getitem__, 'optrelations')
+        self.assertNotIn('optrelations', stinfo)
+        self.assertIsNone(stinfo.get('optrelations'))
+        stinfo.setdefault('optrelations', set()).add(1)
+        self.assertEqual(stinfo['optrelations'], set([1]))
+        stinfo['whatever'] = 2
+        self.assertEqual(stinfo['whatever'], 2)
+        self.assertEqual(stinfo.pop('whatever'), 2)
+        self.assertNotIn('whatever', stinfo)
+        self.assertRaises(KeyError, stinfo.__getitem__, 'whatever')
+        stinfo['relations'].add(3)
+        stinfo.reset_annotation()
+        self.assertEqual(stinfo['relations'], set())
+        self.assertIsNone(stinfo['scope'])
+        self.assertNotIn('optrelations', stinfo)
+
+    def test_annotated(self):
+        tree = sparse('Any X WHERE X name N, X work_for Y?')
+        select = tree.children[0]
+        stinfo = select.defined_vars['X'].stinfo
+        self.assertEqual(len(stinfo['references']), 3)
+        self.assertEqual(stinfo['selected'], set([0]))
+        self.assertEqual(len(stinfo['relations']), 2)
+        self.assertNotIn('optrelations', stinfo)
+        self.assertEqual(len(select.defined_vars['Y'].stinfo['optrelations']), 1)
+        self.assertIn('Person', stinfo['possibletypes'])
+        self.assertEqual(select.defined_vars['N'].stinfo['attrvar'],
+                         select.defined_vars['X'])
+
+
+class FingerprintTC(TestCase):
+
+    def test_variables_naming(self):
+        tree1 = parse('Any X WHERE X name "a", X work_for Y, Y name N')
+        tree2 = parse('Any A WHERE A name "a", A work_for B, B name C')
+        tree3 = parse('Any A WHERE A name "a", B work_for A, B name C')
+        self.assertEqual(tree1.fingerprint(), tree2.fingerprint())
+        self.assertNotEqual(tree1.fingerprint(), tree3.fingerprint())
+        # X work_for Y / B work_for A
+        self.assertEqual(tree1.children[0].where.children[0].children[1].fingerprint(),
+                         tree3.children[0].where.children[0].children[1].fingerprint())
+
+    def test_abstract_constants(self):
+        tree1 = parse('Any X WHERE X name "a"')
+        tree2 = parse('Any X WHERE X name "b"')
+        tree3 = parse('Any X WHERE X name 1')
+        self.assertNotEqual(tree1.fingerprint(), tree2.fingerprint())
+        self.assertEqual(tree1.fingerprint(True), tree2.fingerprint(True))
+        self.assertNotEqual(tree1.fingerprint(True), tree3.fingerprint(True))
+
+    def test_statements(self):
+        fingerprints = set(parse(rql).fingerprint() for rql in (
+            'Any X WHERE X name "a"',
+            'DISTINCT Any X WHERE X name "a"',
+            'Any X LIMIT 1 WHERE X name "a"',
+            'Any X ORDERBY X WHERE X name "a"',
+            'Any X WHERE X name "a" WITH X BEING (Any X WHERE X is Person)',
+            'DELETE Person X WHERE X name "a"',
+            'DELETE Company X WHERE X name "a"',
+            'SET X name "b" WHERE X name "a"',
+            'INSERT Person X: X name "a"',
+            '(Any X WHERE X name "a") UNION (Any X WHERE X name "b")',
+        ))
+        self.assertEqual(len(fingerprints), 10)
+
+    def test_invalidation(self):
+        tree = parse('Any X WHERE X name "a", NOT X work_for Y')
+        expected = parse('Any X WHERE X name "a", NOT X work_for Y?').fingerprint()
+        select = tree.children[0]
+        fingerprint = tree.fingerprint()
+        relation = select.where.children[1].children[0]
+        relation.set_optional('right')
+        self.assertEqual(tree.fingerprint(), expected)
+        select.save_state()
+        select.remove_node(relation)
+        self.assertNotEqual(tree.fingerprint(), expected)
+        select.recover()
+        self.assertEqual(tree.fingerprint(), expected)
+        relation.optional = None
+        relation.invalidate_fingerprint()
+        self.assertEqual(tree.fingerprint(), fingerprint)
+
+
+class FreezeTC(TestCase):
+
+    def test_freeze(self):
+        tree = sparse('Any X,N ORDERBY N WHERE X name N, NOT X work_for Y '
+                      'WITH N BEING (Any N WHERE Z name N)')
+        rql = tree.as_string()
+        self.assertIs(tree.freeze(), tree)
+        self.assertTrue(tree.frozen)
+        select = tree.children[0]
+        relation = select.get_nodes(nodes.Relation)[0]
+        self.assertRaises(FrozenTreeError, select.where.append, relation)
+        self.assertRaises(FrozenTreeError, select.set_limit, 10)
+        self.assertRaises(FrozenTreeError, select.remove_node, relation)
+        self.assertRaises(FrozenTreeError, relation.set_optional, 'right')
+        self.assertRaises(FrozenTreeError, tree.save_state)
+        subselect = select.with_[0].query.children[0]
+        self.assertRaises(FrozenTreeError, subselect.set_distinct, True)
+        self.assertEqual(tree.as_string(), rql)
+
+    def test_thaw(self):
+        tree = sparse('Any X,N WHERE X name N, X work_for Y')
+        self.assertIs(tree.thaw(), tree)
+        tree.freeze()
+        thawed = tree.thaw()
+        self.assertFalse(thawed.frozen)
+        self.assertEqual(thawed.as_string(), tree.as_string())
+        self.assertEqual(thawed.children[0].solutions, tree.children[0].solutions)
+        self.assertFalse(any(node.frozen for node in thawed.children[0].where.children))
+        thawed.children[0].set_limit(10)
+        self.assertEqual(thawed.as_string(), 'Any X,N LIMIT 10 WHERE X name N, X work_for Y')
+        self.assertEqual(tree.as_string(), 'Any X,N WHERE X name N, X work_for Y')
+
+    def test_visit_frozen(self):
+        tree = sparse('Any X,N ORDERBY N WHERE X name N, NOT X work_for Y '
+                      'WITH N BEING (Any N WHERE Z name N)')
+        rql = canonical_form(tree)
+        description = tree.get_description(0)
+        tree.freeze()
+        self.assertEqual(canonical_form(tree), rql)
+        helper.annotate(tree)
+        self.assertEqual(tree.get_description(0), description)
+        tree = sparse('Any X,N WHERE X name N, X work_for Y')
+        thawed = tree.copy()
+        tree.freeze()
+        self.assertTrue(tree.is_equivalent(thawed))
+        self.assertTrue(thawed.is_equivalent(tree))
+
+    def test_fingerprint_frozen(self):
+        tree = sparse('Any X WHERE X name "toto", X work_for Y')
+        fingerprint = tree.fingerprint()
+        abstract_fingerprint = tree.fingerprint(abstract_constants=True)
+        tree.freeze()
+        self.assertEqual(tree.fingerprint(), fingerprint)
+        self.assertEqual(tree.fingerprint(abstract_constants=True),
+                         abstract_fingerprint)
+
+    def test_frozen_caches(self):
+        tree = sparse('Any X,N WHERE X name N, X work_for Y')
+        tree.freeze()
+        select = tree.children[0]
+        index = dict(select._nodes_index)
+        self.assertEqual(len(select.get_nodes(nodes.Relation)), 2)
+        select.get_nodes(nodes.Constant)
+        self.assertEqual(select._nodes_index, index)
+        tree.get_description(0)
+        self.assertIsNone(tree._descriptions)
+
+
 class GetNodesFunctionTest(TestCase):
     def test_known_values_1(self):
         tree = parse('Any X where X name "turlututu"').children[0]
@@ -818,6 +1036,38 @@ class GetNodesFunctionTest(TestCase):
         self.assertEqual(sorted(x.name for x in varrefs),
                          ['X', 'X', 'X', 'Y', 'Y'])
 
+    def test_index(self):
+        tree = sparse('Any X,N ORDERBY N WHERE X name N, NOT X work_for Y '
+                      'WITH N BEING (Any N WHERE Z name N)')
+        select = tree.children[0]
+        walk = nodes.BaseNode.get_nodes
+        for root in (tree, select):
+            for klass in (nodes.Relation, nodes.VariableRef,
+                          (nodes.Not, nodes.Relation)):
+                self.assertEqual(root.get_nodes(klass), walk(root, klass))
+                self.assertEqual(list(root.iget_nodes(klass)), walk(root, klass))
+        # index is dropped by tree modification, including in sub-queries
+        rel = select.add_relation(select.get_variable('X'), 'connait',
+                                  select.get_variable('Y'))
+        self.assertIn(rel, tree.get_nodes(nodes.Relation))
+        subselect = select.with_[0].query.children[0]
+        subselect.add_constant_restriction(subselect.get_variable('Z'), 'age', 12, 'Int')
+        self.assertEqual(tree.get_nodes(nodes.Constant), walk(tree, nodes.Constant))
+        select.remove_node(rel)
+        self.assertNotIn(rel, tree.get_nodes(nodes.Relation))
+        select.add_sort_var(select.get_variable('X'))
+        self.assertEqual(select.get_nodes(nodes.SortTerm), walk(select, nodes.SortTerm))
+
+    def test_index_undo(self):
+        tree = sparse('Any X WHERE X name N, X work_for Y')
+        select = tree.children[0]
+        rels = select.get_nodes(nodes.Relation)
+        tree.save_state()
+        select.remove_node(rels[0])
+        self.assertEqual(len(tree.get_nodes(nodes.Relation)), 1)
+        tree.recover()
+        self.assertEqual(tree.get_nodes(nodes.Relation), rels)
+
 
 if __name__ == '__main__':
     unittest_main()
@@ -0,0 +1,314 @@
+# copyright 2004-2010 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This file is part of rql.
+#
+# rql is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# rql is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with rql. If not, see <http://www.gnu.org/licenses/>.
+from logilab.common.testlib import TestCase, unittest_main
+
+from rql import RQLHelper
+from unittest_analyze import DummySchema
+
+
+class FoldConstantsTC(TestCase):
+
+    def setUp(self):
+        self.helper = RQLHelper(DummySchema(), None)
+
+    def fold(self, rql, kwargs=None):
+        rqlst = self.helper.parse(rql)
+        nbfolded = self.helper.fold_constants(rqlst, kwargs)
+        return nbfolded, rqlst.as_string()
+
+    def test_math(self):
+        self.assertEqual(self.fold('Any X WHERE X number > 1 + 2 * 3'),
+                         (2, 'Any X WHERE X number > 7'))
+        self.assertEqual(self.fold('Any 1 + 2.5, -(3), 7.0 / -2, 7 % -2, 6 & 3'),
+                         (5, 'Any 3.5,-3,-3.5,1,2'))
+        self.assertEqual(self.fold('Any X WHERE X number > N + 1, X number N'),
+                         (0, 'Any X WHERE X number > (N + 1), X number N'))
+
+    def test_not_folded(self):
+        for rql in ('Any (1.0 / 0)',
+                    'Any (1 + "a")',
+                    # backends don't agree on integer division
+                    'Any (7 / 2)',
+                    # nor on case mapping and length of non ASCII strings
+                    u'Any UPPER("stra\xdfe")',
+                    u'Any LENGTH("\xe9t\xe9")',
+                    # exponent notation isn't valid RQL
+                    'Any X WHERE X name > (0.001 * 0.01)',
+                    'Any (10000000000.0 * 1000000000000.0)',
+                    'Any X WHERE X creation_date > (TODAY - 7)',
+                    'Any (9223372036854775807 + 1)'):
+            with self.subTest(rql=rql):
+                self.assertEqual(self.fold(rql), (0, rql))
+
+    def test_sort_group_terms(self):
+        # an integer constant sort term is a column index
+        self.assertEqual(self.fold('Any X ORDERBY (1 + 1) WHERE X number N'),
+                         (0, 'Any X ORDERBY (1 + 1) WHERE X number N'))
+        self.assertEqual(self.fold('Any X,COUNT(N) GROUPBY X,(1 + 1) WHERE X number N'),
+                         (0, 'Any X,COUNT(N) GROUPBY X,(1 + 1) WHERE X number N'))
+        self.assertEqual(self.fold('Any X ORDERBY (N + (1 + 1)) WHERE X number N'),
+                         (1, 'Any X ORDERBY (N + 2) WHERE X number N'))
+
+    def test_round_trip(self):
+        for rql in ('Any X WHERE X name > 0.001 * 1.5',
+                    'Any X WHERE X name > 0.001 * 0.01',
+                    'Any 1000000.0 * 1000000.0, 2.0 / 3, -(0.5)'):
+            with self.subTest(rql=rql):
+                nbfolded, folded = self.fold(rql)
+                self.assertEqual(self.helper.parse(folded).as_string(), folded)
+
+    def test_functions(self):
+        self.assertEqual(self.fold('Any UPPER("foo"), LENGTH(LOWER("AB")), ABS(-2)'),
+                         (4, 'Any "FOO",2,2.0'))
+        self.assertEqual(self.fold('Any COUNT(X) WHERE X name UPPER(N), X firstname N'),
+                         (0, 'Any COUNT(X) WHERE X name UPPER(N), X firstname N'))
+
+    def test_substitute(self):
+        rql = 'Any X WHERE X number %(x)s + 1'
+        self.assertEqual(self.fold(rql), (0, 'Any X WHERE X number (%(x)s + 1)'))
+        self.assertEqual(self.fold(rql, {'x': 3}), (1, 'Any X WHERE X number 4'))
+
+    def test_subquery(self):
+        self.assertEqual(
+            self.fold('Any X WHERE X number 1 + 2 WITH X BEING '
+                      '(Any Y WHERE Y number 2 * 2)'),
+            (2, 'Any X WHERE X number 3 WITH X BEING (Any Y WHERE Y number 4)'))
+
+    def test_undo(self):
+        rqlst = self.helper.parse('Any 1 + 1 WHERE X number 2 * (3 + 1)')
+        rqlst.save_state()
+        self.assertEqual(self.helper.fold_constants(rqlst), 3)
+        self.assertEqual(rqlst.as_string(), 'Any 2 WHERE X number 8')
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(),
+                         'Any (1 + 1) WHERE X number (2 * (3 + 1))')
+
+
+class OptimizeRestrictionsTC(TestCase):
+
+    def setUp(self):
+        self.helper = RQLHelper(DummySchema(), None)
+
+    def optimize(self, rql, solve=False):
+        rqlst = self.helper.parse(rql)
+        if solve:
+            self.helper.compute_solutions(rqlst)
+        nbrewritten = self.helper.optimize_restrictions(rqlst)
+        rqlst.check_references()
+        return nbrewritten, rqlst.as_string()
+
+    def test_or_to_in(self):
+        self.assertEqual(
+            self.optimize('Any X WHERE X name "a" OR X name "b" OR X name "c"'),
+            (1, 'Any X WHERE X name IN("a", "b", "c")'))
+        self.assertEqual(
+            self.optimize('Any X WHERE X name "a" OR X firstname "b" '
+                          'OR X name IN("c", "a")'),
+            (1, 'Any X WHERE (X name IN("a", "c")) OR (X firstname "b")'))
+        self.assertEqual(
+            self.optimize('Any X WHERE X name "a" OR X name "a"'),
+            (1, 'Any X WHERE X name "a"'))
+
+    def test_or_to_in_unchanged(self):
+        for rql in ('Any X WHERE (X name "a") OR (Y name "b"), X work_for Y',
+                    'Any X WHERE (X name "a") OR (X firstname "b")',
+                    'Any X WHERE (NOT X name "a") OR (X name "b")',
+                    'Any X WHERE (X name "a") OR (X name > "b")',
+                    'Any X,Y WHERE (X name Y) OR (X name "b")'):
+            with self.subTest(rql=rql):
+                self.assertEqual(self.optimize(rql), (0, rql))
+
+    def test_duplicates(self):
+        self.assertEqual(
+            self.optimize('Any X WHERE X name "a", X work_for C, X name "a", '
+                          'EXISTS(X name "a")'),
+            (1, 'Any X WHERE X name "a", X work_for C, EXISTS(X name "a")'))
+
+    def test_redundant_type_restrictions(self):
+        # only companies are worked for
+        self.assertEqual(
+            self.optimize('Any X,C WHERE X is Person, X work_for C, C is Company',
+                          solve=True),
+            (1, 'Any X,C WHERE X is Person, X work_for C'))
+        # students have a first name too
+        self.assertEqual(
+            self.optimize('Any X WHERE X is Person, X firstname F', solve=True),
+            (0, 'Any X WHERE X is Person, X firstname F'))
+        # solutions are required
+        self.assertEqual(
+            self.optimize('Any X,C WHERE X is Person, X work_for C, C is Company'),
+            (0, 'Any X,C WHERE X is Person, X work_for C, C is Company'))
+
+    def test_undo(self):
+        rql = ('Any X,C WHERE X work_for C, C is Company WITH X BEING '
+               '(Any P WHERE P is Person, (P name "a") OR (P name "b"))')
+        rqlst = self.helper.parse(rql)
+        self.helper.compute_solutions(rqlst)
+        rqlst.save_state()
+        self.assertEqual(self.helper.optimize_restrictions(rqlst), 2)
+        self.assertEqual(rqlst.as_string(),
+                         'Any X,C WHERE X work_for C WITH X BEING '
+                         '(Any P WHERE P is Person, P name IN("a", "b"))')
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(), rql)
+        rqlst.check_references()
+        for node in rqlst.iget_nodes(object):
+            for child in node.children:
+                self.assertIs(child.parent, node)
+
+
+class PushDownRestrictionsTC(TestCase):
+
+    def setUp(self):
+        self.helper = RQLHelper(DummySchema(), None)
+
+    def push(self, rql):
+        rqlst = self.helper.parse(rql)
+        nbpushed = self.helper.push_down_restrictions(rqlst)
+        rqlst.check_references()
+        return nbpushed, rqlst.as_string()
+
+    def test_push(self):
+        self.assertEqual(
+            self.push('Any X WHERE X name "foo", X work_for C WITH X BEING '
+                      '(Any Y WHERE Y is Person)'),
+            (1, 'Any X WHERE X work_for C WITH X BEING '
+             '(Any Y WHERE Y is Person, Y name "foo")'))
+        self.assertEqual(
+            self.push('Any X WHERE X name "foo" WITH X BEING '
+                      '((Any Y WHERE Y is Person) UNION (Any Y WHERE Y is Company))'),
+            (1, 'Any X WITH X BEING ((Any Y WHERE Y is Person, Y name "foo") '
+             'UNION (Any Y WHERE Y is Company, Y name "foo"))'))
+
+    def test_nested(self):
+        self.assertEqual(
+            self.push('Any X WHERE X name "foo" WITH X BEING (Any Y WHERE '
+                      'Y name > "a" WITH Y BEING (Any Z WHERE Z is Person))'),
+            (3, 'Any X WITH X BEING (Any Y WITH Y BEING '
+             '(Any Z WHERE Z is Person, Z name > "a", Z name "foo"))'))
+
+    def test_unchanged(self):
+        for rql in ('Any X WHERE X name N, X work_for C WITH X BEING '
+                    '(Any Y WHERE Y is Person)',
+                    'Any X WHERE X name "foo" WITH X BEING '
+                    '(Any Y LIMIT 10 WHERE Y is Person)',
+                    'Any X,C WHERE C work_for X?, X name "foo" WITH X BEING '
+                    '(Any Y WHERE Y is Company)',
+                    # Y is NULL when there is no work_for relation
+                    'Any X WHERE X name "foo" WITH X BEING '
+                    '(Any Y WHERE Z work_for Y?)'):
+            with self.subTest(rql=rql):
+                self.assertEqual(self.push(rql), (0, rql))
+
+    def test_simplified(self):
+        helper = RQLHelper(DummySchema(), None, {'eid': 'uid'})
+        rqlst = helper.parse('Any Y WHERE X work_for Y, X eid 12 WITH Y BEING '
+                             '(Any Z WHERE Z is Company)')
+        helper.compute_solutions(rqlst)
+        helper.simplify(rqlst)
+        rql = rqlst.as_string()
+        self.assertEqual(rql, 'Any Y WHERE 12 work_for Y WITH Y BEING '
+                         '(Any Z WHERE Z is Company)')
+        self.assertEqual(helper.push_down_restrictions(rqlst), 0)
+        self.assertEqual(rqlst.as_string(), rql)
+
+    def test_undo(self):
+        rql = ('Any X,N WHERE X name "foo", X firstname N WITH X BEING '
+               '(Any Y WHERE Y is Person)')
+        rqlst = self.helper.parse(rql)
+        self.helper.compute_solutions(rqlst)
+        rqlst.save_state()
+        self.assertEqual(self.helper.push_down_restrictions(rqlst), 1)
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(), rql)
+        rqlst.check_references()
+        for node in rqlst.iget_nodes(object):
+            for child in node.children:
+                self.assertIs(child.parent, node)
+        for subselect in rqlst.children[0].with_[0].query.children:
+            for node in subselect.iget_nodes(object):
+                for child in node.children:
+                    self.assertIs(child.parent, node)
+
+
+class PushDownLimitTC(TestCase):
+
+    def setUp(self):
+        self.helper = RQLHelper(DummySchema(), None)
+
+    def push(self, rql):
+        rqlst = self.helper.parse(rql)
+        nblimited = self.helper.push_down_limit(rqlst)
+        rqlst.check_references()
+        return nblimited, rqlst.as_string()
+
+    def test_sorted(self):
+        self.assertEqual(
+            self.push('Any X,N ORDERBY N DESC LIMIT 10 OFFSET 5 WITH X,N BEING '
+                      '((Any Y,M ORDERBY Y WHERE Y name M) UNION '
+                      '(Any Y,M LIMIT 5 WHERE Y firstname M))'),
+            (1, 'Any X,N ORDERBY N DESC LIMIT 10 OFFSET 5 WITH X,N BEING '
+             '((Any Y,M ORDERBY M DESC LIMIT 15 WHERE Y name M) UNION '
+             '(Any Y,M LIMIT 5 WHERE Y firstname M))'))
+
+    def test_unsorted(self):
+        self.assertEqual(
+            self.push('Any X LIMIT 10 WITH X BEING ((Any Y LIMIT 20 WHERE '
+                      'Y is Person) UNION (Any Y LIMIT 5 OFFSET 2 WHERE '
+                      'Y is Company))'),
+            (1, 'Any X LIMIT 10 WITH X BEING ((Any Y LIMIT 10 WHERE '
+             'Y is Person) UNION (Any Y LIMIT 5 OFFSET 2 WHERE Y is Company))'))
+
+    def test_wrapped_union(self):
+        rqlst = self.helper.parse('(Any X WHERE X is Person) UNION '
+                                  '(Any X WHERE X is Company)')
+        rqlst.set_limit(10)
+        rqlst.set_offset(3)
+        self.assertEqual(self.helper.push_down_limit(rqlst), 2)
+        self.assertEqual(rqlst.as_string(),
+                         'Any A LIMIT 10 OFFSET 3 WITH A BEING '
+                         '((Any X LIMIT 13 WHERE X is Person) UNION '
+                         '(Any X LIMIT 13 WHERE X is Company))')
+
+    def test_unchanged(self):
+        for rql in ('Any X LIMIT 10 WHERE X name "a" WITH X BEING '
+                    '((Any Y WHERE Y is Person) UNION (Any Y WHERE Y is Company))',
+                    'DISTINCT Any X LIMIT 10 WITH X BEING '
+                    '((Any Y WHERE Y is Person) UNION (Any Y WHERE Y is Company))',
+                    'Any COUNT(X) LIMIT 10 WITH X BEING '
+                    '((Any Y WHERE Y is Person) UNION (Any Y WHERE Y is Company))',
+                    'Any X ORDERBY LOWER(N) LIMIT 10 WITH X,N BEING '
+                    '((Any Y,M WHERE Y name M) UNION (Any Y,M WHERE Y firstname M))',
+                    'Any X,N ORDERBY N LIMIT 10 WITH X,N BEING '
+                    '(Any Y,M ORDERBY Y LIMIT 5 WHERE Y name M)'):
+            with self.subTest(rql=rql):
+                self.assertEqual(self.push(rql), (0, rql))
+
+    def test_undo(self):
+        rql = ('Any X,N ORDERBY N LIMIT 10 WITH X,N BEING ((Any Y,M ORDERBY Y '
+               'WHERE Y name M) UNION (Any Y,M WHERE Y firstname M))')
+        rqlst = self.helper.parse(rql)
+        rqlst.save_state()
+        self.assertEqual(self.helper.push_down_limit(rqlst), 2)
+        rqlst.recover()
+        self.assertEqual(rqlst.as_string(), rql)
+        rqlst.check_references()
+
+
+if __name__ == '__main__':
+    unittest_main()
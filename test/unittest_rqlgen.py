@@ -19,7 +19,9 @@
 import doctest
 import unittest
 
-from rql import rqlgen
+from rql import rqlgen, RQLHelper
+
+from unittest_analyze import DummySchema
 
 
 def load_tests(loader, tests, ignore):
@@ -120,5 +122,41 @@ class RQLGenTC(unittest.TestCase):
                          'X lastname "Kent"')
 
 
+class RQLWorkloadGeneratorTC(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = DummySchema()
+        self.helper = RQLHelper(self.schema, None, {'eid': 'uid'})
+
+    def test_seed(self):
+        queries = list(rqlgen.RQLWorkloadGenerator(self.schema, 12).workload(5))
+        self.assertEqual(
+            list(rqlgen.RQLWorkloadGenerator(self.schema, 12).workload(5)), queries)
+
+    def test_shape(self):
+        generator = rqlgen.RQLWorkloadGenerator(self.schema, 0)
+        rql = generator.select(relations=3, attributes=0, or_branches=2, subqueries=1,
+                               limit=10)
+        select = self.helper.parse(rql).children[0]
+        self.assertEqual(select.limit, 10)
+        self.assertEqual(len(select.with_), 1)
+        self.assertEqual(len(select.defined_vars), 4)
+        rql = generator.select(relations=0, attributes=0)
+        self.assertEqual(len(self.helper.parse(rql).children[0].defined_vars), 1)
+
+    def test_valid(self):
+        generator = rqlgen.RQLWorkloadGenerator(self.schema, 0)
+        shapes = ({}, {'relations': 0, 'attributes': 0},
+                  {'relations': 4, 'attributes': 3, 'untyped': 0.5, 'or_branches': 3,
+                   'negations': 2, 'subqueries': 2, 'limit': 5})
+        for shape in shapes:
+            for rql in generator.workload(30, **shape):
+                tree = self.helper.parse(rql)
+                self.helper.compute_solutions(tree)
+                self.assertTrue(tree.children[0].solutions, rql)
+                self.assertEqual(self.helper.parse(tree.as_string()).as_string(),
+                                 tree.as_string())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -19,7 +19,11 @@
 from __future__ import print_function
 import six
 
-from rql import RQLHelper, BadRQLQuery, stmts, nodes
+import warnings
+
+from rql import (RQLHelper, BadRQLQuery, CartesianProductWarning, RQLSyntaxError,
+                 stmts, nodes)
+from rql.stcheck import VarGraphIndex, disconnected_components
 from unittest_analyze import DummySchema
 
 if six.PY2:
@@ -189,6 +193,83 @@ class CheckClassTest(unittest.TestCase):
             with self.subTest(rql=rql):
                 self._test_rewrite(rql, expected)
 
+    def test_trusted(self):
+        helper = RQLHelper(DummySchema(), None, {'eid': 'uid'})
+        rql = 'DISTINCT Any PF ORDERBY PN WHERE P firstname PF, P name PN'
+        self.assertEqual(helper.parse(rql, trusted=True).as_string(), rql)
+        helper.trusted_check_rate = 1
+        self.assertRaises(BadRQLQuery, helper.parse, rql, trusted=True)
+
+    def test_trusted_rewrite(self):
+        helper = RQLHelper(DummySchema(), None, {'eid': 'uid'})
+        for rql in ("DISTINCT Any P WHERE P connait S OR S connait P, S name 'chouette'",
+                    'Any X WHERE X work_for Y, Y eid IN (12)',
+                    'Any X WHERE NOT X work_for Y',
+                    'DISTINCT Any VF ORDERBY VCD DESC WHERE VC work_for S, S name "draft"'
+                    ' WITH VF, VC, VCD BEING (Any VF, MAX(VC), VCD GROUPBY VF, VCD'
+                    ' WHERE VC connait VF, VC creation_date VCD)'):
+            with self.subTest(rql=rql):
+                checked = helper.parse(rql)
+                trusted = helper.parse(rql, trusted=True)
+                self.assertEqual(trusted.as_string(), checked.as_string())
+                self.assertEqual(trusted.children[0].vargraph,
+                                 checked.children[0].vargraph)
+                self.assertEqual(trusted.children[0].aggregated,
+                                 checked.children[0].aggregated)
+
+    def test_stats(self):
+        helper = RQLHelper(DummySchema(), None, {'eid': 'uid'})
+        rqlst = helper.parse('Any X WHERE X eid 12, X name N')
+        helper.compute_solutions(rqlst)
+        helper.simplify(rqlst)
+        stats = helper.stats(reset=True)
+        self.assertEqual(sorted(stats), sorted(RQLHelper.STAGES))
+        for stage in RQLHelper.STAGES:
+            self.assertEqual(stats[stage]['count'], 1)
+            self.assertEqual(sum(stats[stage]['histogram']), 1)
+            self.assertGreaterEqual(stats[stage]['max'], stats[stage]['total'])
+        self.assertEqual(helper.stats()['parse']['count'], 0)
+
+    def test_hooks(self):
+        helper = RQLHelper(DummySchema(), None, {'eid': 'uid'})
+        calls = []
+
+        def hook(stage, rqlst, duration, size, error):
+            calls.append((stage, size))
+        for stage in ('parse', 'annotate', 'solve'):
+            helper.add_hook(stage, hook)
+        rql = 'Any X WHERE X name N'
+        helper.compute_solutions(helper.parse(rql))
+        self.assertEqual(calls, [('parse', len(rql)), ('annotate', 2), ('solve', 3)])
+        helper.remove_hook('parse', hook)
+        del calls[:]
+        helper.parse(rql)
+        self.assertEqual(calls, [('annotate', 2)])
+        self.assertRaises(ValueError, helper.add_hook, 'unknown', hook)
+
+    def test_failed_stages(self):
+        helper = RQLHelper(DummySchema(), None, {'eid': 'uid'})
+        calls = []
+
+        def hook(stage, rqlst, duration, size, error):
+            calls.append((stage, rqlst, error))
+            if error is not None:
+                raise ValueError('buggy hook')
+        for stage in ('parse', 'check'):
+            helper.add_hook(stage, hook)
+        with self.assertRaises(BadRQLQuery) as cm:
+            helper.parse('Any X WHERE X unknown Y')
+        self.assertEqual([(stage, error) for stage, rqlst, error in calls],
+                         [('parse', None), ('check', cm.exception)])
+        self.assertIs(calls[0][1], calls[1][1])
+        del calls[:]
+        with self.assertRaises(RQLSyntaxError) as cm:
+            helper.parse('Any X WHERE')
+        self.assertEqual(calls, [('parse', None, cm.exception)])
+        stats = helper.stats()
+        self.assertEqual((stats['parse']['count'], stats['parse']['errors']), (2, 1))
+        self.assertEqual((stats['check']['count'], stats['check']['errors']), (1, 1))
+
     def test_subquery_graphdict(self):
         # test two things:
         # * we get graph information from subquery
@@ -204,6 +285,62 @@ class CheckClassTest(unittest.TestCase):
                           ('VC', 'VCD'): 'creation_date'})
         self.assertEqual(rqlst.children[0].aggregated, set(('VC',)))
 
+    def test_vargraph_index(self):
+        select = self.parse('Any P WHERE P work_for X, P name PN, X name XN, '
+                            'Y work_for X, Y firstname YF').children[0]
+        index = VarGraphIndex(DummySchema(), select)
+        self.assertTrue(index.has_unique_value_path('P', 'PN'))
+        self.assertTrue(index.has_unique_value_path('P', 'XN'))
+        # X -> Y through work_for object is multivalued
+        self.assertFalse(index.has_unique_value_path('P', 'YF'))
+        self.assertFalse(index.has_unique_value_path('X', 'Y'))
+        self.assertFalse(index.has_unique_value_path('P', 'P'))
+        self.assertRaises(KeyError, index.has_unique_value_path, 'Z', 'P')
+        # a single traversal per starting variable
+        self.assertEqual(list(index._trees), ['P', 'X'])
+
+    def test_disconnected_components(self):
+        for rql, expected in [
+            ('Any X,Y WHERE X work_for Y', [{'X', 'Y'}]),
+            ('Any X,Y WHERE X is Person, Y is Company', [{'X'}, {'Y'}]),
+            ('Any X,Y,Z WHERE X work_for Y, Z is Person', [{'X', 'Y'}, {'Z'}]),
+            # variables only used in EXISTS / NOT don't imply a cartesian product
+            ('Any X WHERE X is Person, NOT EXISTS(Y work_for Z)', [{'X'}]),
+            ('Any X WHERE X is Person, EXISTS(Y work_for Z)', [{'X'}]),
+            # linked through a subquery
+            ('Any X,Y WHERE X is Person, Y is Company WITH X,Y BEING '
+             '(Any A,B WHERE A work_for B)', [{'X', 'Y'}]),
+            # linked through HAVING
+            ('Any X,Y GROUPBY X,Y WHERE X is Person, Y is Company '
+             'HAVING COUNT(X) > COUNT(Y)', [{'X', 'Y'}]),
+            # linked through an expression
+            ('Any X,Y WHERE X creation_date A, Y creation_date A + 1',
+             [{'A', 'X', 'Y'}]),
+            ('Any X,Y WHERE X name N, Y name UPPER(N)', [{'N', 'X', 'Y'}]),
+        ]:
+            with self.subTest(rql=rql):
+                select = self.parse(rql).children[0]
+                self.assertEqual(disconnected_components(select), expected)
+
+    def test_cartesian(self):
+        rql = 'Any X,Y WHERE X is Person, Y is Company'
+        self.parse(rql)
+        helper = RQLHelper(DummySchema(), None, cartesian='warn')
+        with warnings.catch_warnings(record=True) as warns:
+            warnings.simplefilter('always')
+            helper.parse(rql)
+            helper.parse('Any X,Y WHERE X work_for Y')
+        self.assertEqual(len(warns), 1)
+        self.assertTrue(issubclass(warns[0].category, CartesianProductWarning))
+        helper = RQLHelper(DummySchema(), None, cartesian='error')
+        with self.assertRaises(BadRQLQuery) as cm:
+            helper.parse(rql)
+        self.assertIn('cartesian product between unrelated variables (X), (Y)',
+                      str(cm.exception))
+        helper.parse('Any X,Y WHERE X work_for Y')
+        helper.parse('Any X,Y WHERE X creation_date A, Y creation_date A + 1')
+        helper.parse('Any X,Y WHERE X name N, Y name UPPER(N)')
+
 
 class CopyTest(unittest.TestCase):
 
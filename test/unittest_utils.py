@@ -16,6 +16,9 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with rql. If not, see <http://www.gnu.org/licenses/>.
 
+import gc
+import weakref
+
 from six.moves import range
 
 from logilab.common.testlib import TestCase, unittest_main
@@ -57,6 +60,75 @@ class RQLHandlerClassTest(TestCase):
         self.visitor.visit(tree)
 
 
+class VisitorHandlerTC(TestCase):
+
+    def test_dispatch_per_class(self):
+        class CountingVisitor(utils.RQLVisitorHandler):
+            def __init__(self):
+                self.relations = 0
+
+            def visit_relation(self, relation):
+                self.relations += 1
+
+        class SubVisitor(CountingVisitor):
+            def visit_relation(self, relation):
+                self.relations += 10
+
+        tree = parse('Any X WHERE X name "turlututu", X born <= TODAY', {})
+        relation = tree.get_nodes(nodes.Relation)[0]
+        visitor = CountingVisitor()
+        relation.accept(visitor)
+        relation.accept(visitor)
+        self.assertEqual(visitor.relations, 2)
+        # subclasses get their own table
+        subvisitor = SubVisitor()
+        relation.accept(subvisitor)
+        self.assertEqual(subvisitor.relations, 10)
+        self.assertIs(utils.visitor_handler(visitor, relation),
+                      CountingVisitor.__dict__['visit_relation'])
+
+    def test_dispatch_table_lifetime(self):
+        class TemporaryVisitor(utils.RQLVisitorHandler):
+            def visit_relation(self, relation):
+                pass
+
+        tree = parse('Any X WHERE X name "turlututu"', {})
+        tree.get_nodes(nodes.Relation)[0].accept(TemporaryVisitor())
+        vclass = weakref.ref(TemporaryVisitor)
+        del TemporaryVisitor
+        gc.collect()
+        self.assertIsNone(vclass())
+
+    def test_dispatch_instance_method(self):
+        visitor = utils.RQLVisitorHandler()
+        visited = []
+        visitor.leave_relation = visited.append
+        tree = parse('Any X WHERE X name "turlututu"', {})
+        relation = tree.get_nodes(nodes.Relation)[0]
+        relation.leave(visitor)
+        self.assertEqual(visited, [relation])
+        self.assertRaises(AttributeError, relation.leave, utils.RQLVisitorHandler())
+
+
+class CommonScopeTC(TestCase):
+
+    def test_common_scope(self):
+        tree = parse('Any X WHERE X name N, EXISTS(X work_for Y, '
+                     'NOT EXISTS(Y connait Z)), EXISTS(X connait W)', {})
+        select = tree.children[0]
+        exists1 = select.where.children[0].children[1]
+        exists2 = exists1.query.children[1].children[0]
+        exists3 = select.where.children[1]
+        index = {}
+        self.assertIs(utils.common_scope(exists2, exists2, index), exists2)
+        self.assertIs(utils.common_scope(exists2, exists1, index), exists1)
+        self.assertIs(utils.common_scope(exists1, exists2, index), exists1)
+        self.assertIs(utils.common_scope(exists2, exists3, index), select)
+        self.assertIs(utils.common_scope(select, exists2, index), select)
+        self.assertEqual(index[exists2], (2, exists1))
+        self.assertIs(utils.common_scope(exists3, exists1), select)
+
+
 class RQLVarMakerTC(TestCase):
 
     def test_rqlvar_maker(self):
@@ -0,0 +1,185 @@
+# copyright 2004-2010 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This file is part of rql.
+#
+# rql is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# rql is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with rql. If not, see <http://www.gnu.org/licenses/>.
+"""Measure memory retained by parsed RQL syntax trees.
+
+Usage: bench_memory.py [file]
+
+Trees are built for each query of the given file (one query per line) or of
+the default corpus (queries of the test suite and of data/benchuniq.rql), using
+the test suite schema. Queries which can't be parsed or resolved using this
+schema are skipped.
+
+Memory retained by trees is measured using `tracemalloc` snapshots taken after
+parsing, annotation and type resolution. Memory by node type and for variables
+`stinfo` is the shallow size of the objects and of their own containers.
+"""
+from __future__ import print_function
+
+import gc
+import sys
+import tracemalloc
+from os.path import dirname, join
+
+from rql import nodes
+from rql.base import BaseNode
+
+# parsing, annotation and type resolution steps
+STEPS = ('parsed', 'annotated', 'resolved')
+
+
+def _traced_size(snapshot):
+    return sum(stat.size for stat in snapshot.statistics('filename'))
+
+
+def measure(helper, queries):
+    """Build syntax trees for the given queries and return a dictionary
+    describing memory they retain:
+
+    * 'trees', number of trees,
+    * 'parsed', 'annotated', 'resolved': bytes retained by trees after each
+      step,
+    * 'nodes': dictionary of (number of nodes, bytes) by node class name,
+    * 'stinfo': (number of variables, bytes of their `stinfo`).
+
+    Queries are expected to be valid for the helper's schema.
+    """
+    gc.collect()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        sizes = [_traced_size(tracemalloc.take_snapshot())]
+        trees = [helper.parse(rql, annotate=False) for rql in queries]
+        for step in (helper.annotate, helper.compute_solutions):
+            gc.collect()
+            sizes.append(_traced_size(tracemalloc.take_snapshot()))
+            for tree in trees:
+                step(tree)
+        gc.collect()
+        sizes.append(_traced_size(tracemalloc.take_snapshot()))
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    result = {'trees': len(trees), 'nodes': {}}
+    for i, step in enumerate(STEPS):
+        result[step] = sizes[i + 1] - sizes[0]
+    nbvars = stinfosize = 0
+    for tree in trees:
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            count, size = result['nodes'].get(node.__class__.__name__, (0, 0))
+            result['nodes'][node.__class__.__name__] = (count + 1,
+                                                        size + _node_size(node))
+            stack += node.children
+            for var in _variables(node):
+                nbvars += 1
+                stinfosize += _stinfo_size(var.stinfo)
+    result['stinfo'] = (nbvars, stinfosize)
+    return result
+
+
+def _node_size(node):
+    size = sys.getsizeof(node)
+    if hasattr(node, '__dict__'):
+        size += sys.getsizeof(node.__dict__)
+    if isinstance(node, BaseNode) and isinstance(node.children, list):
+        size += sys.getsizeof(node.children)
+    return size
+
+
+def _variables(node):
+    for attr in ('defined_vars', 'aliases'):
+        if isinstance(getattr(node, attr, None), dict):
+            for var in getattr(node, attr).values():
+                yield var
+
+
+def _stinfo_size(stinfo):
+    size = sys.getsizeof(stinfo)
+    for key in nodes.VariableInfo.__slots__:
+        # don't use stinfo.get which could return a value shared by variables
+        try:
+            value = getattr(stinfo, key)
+        except AttributeError:
+            continue
+        if isinstance(value, (set, dict, list)):
+            size += sys.getsizeof(value)
+    return size
+
+
+def read_queries(path):
+    """Return queries of the given file, one query per line."""
+    with open(path) as stream:
+        return [line.strip() for line in stream if line.strip()]
+
+
+def default_corpus():
+    """Return the test suite schema and the default queries corpus."""
+    tooldir = dirname(__file__) or '.'
+    testdir = join(tooldir, '..', 'test')
+    if testdir not in sys.path:
+        sys.path.insert(0, testdir)
+    from unittest_analyze import DummySchema
+    from unittest_parser import SPEC_QUERIES
+    from unittest_stcheck import OK_QUERIES
+    queries = list(OK_QUERIES) + list(SPEC_QUERIES)
+    queries += read_queries(join(tooldir, 'data', 'benchuniq.rql'))
+    return DummySchema(), queries
+
+
+def valid_queries(helper, queries):
+    """Return queries which can be parsed and resolved by the helper."""
+    valid = []
+    for rql in queries:
+        try:
+            helper.compute_solutions(helper.parse(rql))
+        except Exception:
+            continue
+        valid.append(rql)
+    return valid
+
+
+def main(args):
+    from rql import RQLHelper
+    schema, queries = default_corpus()
+    if args:
+        queries = read_queries(args[0])
+    helper = RQLHelper(schema, None, {'eid': 'uid'})
+    # this also fills caches (eg parser's) before measure
+    queries = valid_queries(helper, queries)
+    if not queries:
+        print('no valid query')
+        return 1
+    result = measure(helper, queries)
+    print('%s trees' % result['trees'])
+    for step in STEPS:
+        print('%-10s %8d bytes/tree' % (step, result[step] // result['trees']))
+    nbvars, size = result['stinfo']
+    if nbvars:
+        print('%-10s %8d bytes/variable (%s variables)' % (
+            'stinfo', size // nbvars, nbvars))
+    print()
+    for name, (count, size) in sorted(result['nodes'].items(),
+                                      key=lambda x: -x[1][1]):
+        print('%-14s %8d nodes %8d bytes/node' % (name, count, size // count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
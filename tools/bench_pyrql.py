@@ -15,11 +15,169 @@
 #
 # You should have received a copy of the GNU Lesser General Public License along
 # with rql. If not, see <http://www.gnu.org/licenses/>.
+"""Benchmark of the RQL processing pipeline.
+
+Each query of the corpus (data/bench_corpus.rql by default, one query per line)
+goes through the following stages, each one being timed separately: parsing,
+checking, annotation, solutions computation, copy, as_string and
+simplification. Queries are resolved using the synthetic schema of
+bench_schema.py; queries of the corpus which can't be processed are skipped.
+
+Timings percentiles are reported for each stage. They may be saved as JSON
+(--output) and compared to a previous run (--baseline): the script then exits
+with status 1 if the median time of a stage increased by more than the given
+threshold.
+"""
 from __future__ import print_function
 
-from rql import parse
+import argparse
+import json
+import platform
 import sys
-f = open(sys.argv[1])
-for l in f:
-    parse(l)
-    print(".", end="")
+import time
+from os.path import dirname, join
+from timeit import default_timer
+
+import rql
+from rql import RQLHelper
+
+from bench_schema import BenchSchema
+
+STAGES = ('parse', 'check', 'annotate', 'compute_solutions', 'copy',
+          'as_string', 'simplify')
+PERCENTILES = (50, 90, 99)
+DEFAULT_CORPUS = join(dirname(__file__) or '.', 'data', 'bench_corpus.rql')
+
+
+def process(helper, rqlstring, timings=None):
+    """Run the processing pipeline on the given query, appending time spent in
+    each stage to the `timings` dictionary if specified.
+    """
+    steps = (
+        ('parse', lambda tree: rql.parse(rqlstring, False)),
+        ('check', helper._checker.check),
+        ('annotate', helper.annotate),
+        ('compute_solutions', helper.compute_solutions),
+        ('copy', lambda tree: tree.copy()),
+        ('as_string', lambda tree: tree.as_string()),
+        ('simplify', helper.simplify),
+    )
+    tree = None
+    for stage, step in steps:
+        start = default_timer()
+        result = step(tree)
+        if timings is not None:
+            timings[stage].append(default_timer() - start)
+        if stage == 'parse':
+            tree = result
+    return tree
+
+
+def percentile(values, percent):
+    """Return the given percentile of sorted `values` (nearest rank)."""
+    index = max(int(round(percent / 100. * len(values))) - 1, 0)
+    return values[index]
+
+
+def run(helper, queries, rounds):
+    """Process the queries `rounds` times and return statistics by stage, in
+    microseconds.
+    """
+    timings = dict((stage, []) for stage in STAGES)
+    for _ in range(rounds):
+        for rqlstring in queries:
+            process(helper, rqlstring, timings)
+    stats = {}
+    for stage in STAGES:
+        values = sorted(value * 1e6 for value in timings[stage])
+        stats[stage] = dict(('p%s' % percent, percentile(values, percent))
+                            for percent in PERCENTILES)
+        stats[stage]['mean'] = sum(values) / len(values)
+        stats[stage]['total'] = sum(values)
+    return stats
+
+
+def valid_queries(helper, queries):
+    """Return queries which can go through the whole pipeline."""
+    valid = []
+    for rqlstring in queries:
+        try:
+            process(helper, rqlstring)
+        except Exception as ex:
+            print('skipping %r: %s' % (rqlstring, ex), file=sys.stderr)
+            continue
+        valid.append(rqlstring)
+    return valid
+
+
+def compare(stats, baseline, threshold):
+    """Print comparison of `stats` to `baseline` statistics and return the list
+    of stages whose median time increased by more than `threshold`.
+    """
+    regressions = []
+    print('\n%-18s %10s %10s %8s' % ('stage', 'base p50', 'p50', 'ratio'))
+    for stage in STAGES:
+        if stage not in baseline:
+            continue
+        base, current = baseline[stage]['p50'], stats[stage]['p50']
+        ratio = current / base if base else 1.
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(stage)
+            flag = ' REGRESSION'
+        print('%-18s %10.1f %10.1f %8.2f%s' % (stage, base, current, ratio, flag))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0])
+    parser.add_argument('corpus', nargs='?', default=DEFAULT_CORPUS,
+                        help='file containing one RQL query per line')
+    parser.add_argument('-n', '--rounds', type=int, default=20,
+                        help='number of times the corpus is processed')
+    parser.add_argument('-o', '--output',
+                        help='write results as JSON to this file')
+    parser.add_argument('-b', '--baseline',
+                        help='compare results to JSON results of a previous run')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='relative increase of the median time of a stage '
+                        'considered as a regression (default: 0.1)')
+    parser.add_argument('-l', '--label', default='',
+                        help='label stored in JSON results, eg version number')
+    options = parser.parse_args(args)
+    helper = RQLHelper(BenchSchema(), None, {'eid': 'uid'})
+    with open(options.corpus) as stream:
+        queries = [line.strip() for line in stream if line.strip()]
+    # this also warms caches up
+    queries = valid_queries(helper, queries)
+    stats = run(helper, queries, options.rounds)
+    print('%s queries, %s rounds, times in microseconds' % (
+        len(queries), options.rounds))
+    print('%-18s %10s %10s %10s %10s %12s' % (
+        'stage', 'mean', 'p50', 'p90', 'p99', 'total'))
+    for stage in STAGES:
+        print('%-18s %10.1f %10.1f %10.1f %10.1f %12.0f' % (
+            stage, stats[stage]['mean'], stats[stage]['p50'],
+            stats[stage]['p90'], stats[stage]['p99'], stats[stage]['total']))
+    if options.output:
+        results = {'label': options.label,
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': '%s %s' % (platform.python_implementation(),
+                                        platform.python_version()),
+                   'corpus': options.corpus,
+                   'queries': len(queries),
+                   'rounds': options.rounds,
+                   'stages': stats}
+        with open(options.output, 'w') as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as stream:
+            baseline = json.load(stream)
+        if compare(stats, baseline['stages'], options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+# copyright 2004-2010 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This file is part of rql.
+#
+# rql is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# rql is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with rql. If not, see <http://www.gnu.org/licenses/>.
+"""Measure how processing time and memory grow with queries complexity.
+
+Queries are generated by `rql.rqlgen.RQLWorkloadGenerator` for the schema of
+bench_schema.py, with one shape parameter (--parameter) growing from 0 to
+--max. Median time of each stage of the pipeline (see bench_pyrql.py) and
+memory retained per tree (see bench_memory.py) are printed for each value as
+tab separated values, ready to be plotted.
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+
+from rql import RQLHelper
+from rql.rqlgen import RQLWorkloadGenerator
+
+import bench_memory
+import bench_pyrql
+from bench_schema import BenchSchema
+
+PARAMETERS = ('relations', 'attributes', 'or_branches', 'negations',
+              'subqueries')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0])
+    parser.add_argument('-p', '--parameter', choices=PARAMETERS,
+                        default='relations', help='growing shape parameter')
+    parser.add_argument('-m', '--max', type=int, default=10,
+                        help='maximum value of the growing parameter')
+    parser.add_argument('-u', '--untyped', type=float, default=0.,
+                        help='fraction of variables without type restriction')
+    parser.add_argument('-q', '--queries', type=int, default=50,
+                        help='number of queries generated for each value')
+    parser.add_argument('-n', '--rounds', type=int, default=5,
+                        help='number of times queries are processed')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='seed of the queries generator')
+    options = parser.parse_args(args)
+    schema = BenchSchema()
+    helper = RQLHelper(schema, None, {'eid': 'uid'})
+    print('\t'.join((options.parameter,) + bench_pyrql.STAGES
+                    + ('bytes/tree',)))
+    for value in range(options.max + 1):
+        generator = RQLWorkloadGenerator(schema, options.seed)
+        shape = {options.parameter: value, 'untyped': options.untyped}
+        queries = list(generator.workload(options.queries, **shape))
+        # this also warms caches up
+        queries = bench_pyrql.valid_queries(helper, queries)
+        stats = bench_pyrql.run(helper, queries, options.rounds)
+        memory = bench_memory.measure(helper, queries)
+        print('\t'.join([str(value)]
+                        + ['%.1f' % stats[stage]['p50']
+                           for stage in bench_pyrql.STAGES]
+                        + [str(memory['resolved'] // memory['trees'])]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# copyright 2004-2010 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This file is part of rql.
+#
+# rql is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# rql is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with rql. If not, see <http://www.gnu.org/licenses/>.
+"""Synthetic schema used by benchmarks, implementing the part of the yams
+schema interface used by rql.
+
+It describes a small issue tracker with users, projects, tickets and blogs,
+queried by data/bench_corpus.rql.
+"""
+
+FINAL_ETYPES = ('String', 'Int', 'Float', 'Boolean', 'Date', 'Datetime',
+                'Bytes')
+
+# entity types, with the entity types they're specialized by
+ENTITY_TYPES = {
+    'CWEType': (), 'CWUser': (), 'CWGroup': (), 'EmailAddress': (),
+    'Company': (), 'Person': ('Employee',), 'Employee': (),
+    'Project': (), 'Version': (), 'Ticket': (), 'Comment': (), 'Tag': (),
+    'Blog': (), 'BlogEntry': (), 'File': (),
+}
+NONFINAL_ETYPES = tuple(sorted(ENTITY_TYPES))
+
+# relation type: (subject types, object types, cardinality, options)
+RELATION_TYPES = {
+    'eid': (NONFINAL_ETYPES, ('Int',), '11', ()),
+    'creation_date': (NONFINAL_ETYPES, ('Datetime',), '?1', ()),
+    'modification_date': (NONFINAL_ETYPES, ('Datetime',), '?1', ()),
+    'is': (NONFINAL_ETYPES, ('CWEType',), '1*', ()),
+    'is_instance_of': (NONFINAL_ETYPES, ('CWEType',), '+*', ()),
+    'identity': (NONFINAL_ETYPES, NONFINAL_ETYPES, '11', ()),
+    'owned_by': (NONFINAL_ETYPES, ('CWUser',), '**', ()),
+    'created_by': (NONFINAL_ETYPES, ('CWUser',), '?*', ('inlined',)),
+    'name': (('CWEType', 'CWGroup', 'Company', 'Project', 'Tag', 'File'),
+             ('String',), '11', ()),
+    'login': (('CWUser',), ('String',), '11', ()),
+    'firstname': (('CWUser', 'Person', 'Employee'), ('String',), '?1', ()),
+    'surname': (('CWUser', 'Person', 'Employee'), ('String',), '?1', ()),
+    'address': (('EmailAddress',), ('String',), '11', ()),
+    'title': (('Ticket', 'Blog', 'BlogEntry'), ('String',), '11', ()),
+    'description': (('Project', 'Ticket', 'Version'), ('String',), '?1', ()),
+    'content': (('BlogEntry', 'Comment'), ('String',), '?1', ()),
+    'data': (('File',), ('Bytes',), '11', ()),
+    'priority': (('Ticket',), ('Int',), '11', ()),
+    'load': (('Ticket',), ('Float',), '?1', ()),
+    'done': (('Ticket',), ('Boolean',), '11', ()),
+    'num': (('Version',), ('String',), '11', ()),
+    'publication_date': (('Version', 'BlogEntry'), ('Date',), '?1', ()),
+    'salary': (('Employee',), ('Int', 'Float'), '?1', ()),
+    'in_group': (('CWUser',), ('CWGroup',), '+*', ()),
+    'use_email': (('CWUser', 'Person', 'Employee', 'Company'),
+                  ('EmailAddress',), '*?', ()),
+    'works_for': (('Employee',), ('Company',), '?*', ('inlined',)),
+    'knows': (('Person', 'Employee'), ('Person', 'Employee'), '**',
+              ('symmetric',)),
+    'version_of': (('Version',), ('Project',), '1*', ('inlined',)),
+    'concerns': (('Ticket',), ('Project',), '1*', ('inlined',)),
+    'done_in': (('Ticket',), ('Version',), '?*', ()),
+    'depends_on': (('Ticket', 'Project'), ('Ticket', 'Project'), '**', ()),
+    'comments': (('Comment',), ('Ticket', 'BlogEntry', 'Comment'), '1*',
+                 ('inlined',)),
+    'tags': (('Tag',), ('Ticket', 'Project', 'BlogEntry', 'File'), '**', ()),
+    'entry_of': (('BlogEntry',), ('Blog',), '?*', ()),
+    'attachment': (('Ticket', 'BlogEntry'), ('File',), '*?', ()),
+}
+
+
+class ERSchema(object):
+
+    def __init__(self, type):
+        self.type = type
+
+    def __hash__(self):
+        return hash(self.type)
+
+    def __eq__(self, other):
+        return self.type == getattr(other, 'type', other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return self.type
+
+
+class EntitySchema(ERSchema):
+
+    def __init__(self, type):
+        super(EntitySchema, self).__init__(type)
+        self.final = type in FINAL_ETYPES
+        self._specialized_by = []
+        self._destinations = {}
+
+    def specialized_by(self):
+        return self._specialized_by
+
+    def destination(self, rtype):
+        return self._destinations[rtype]
+
+
+class RelationDefinition(object):
+
+    def __init__(self, subject, object, cardinality):
+        self.subject = subject
+        self.object = object
+        self.cardinality = cardinality
+
+
+class RelationSchema(ERSchema):
+
+    def __init__(self, type, subjects, objects, cardinality, options):
+        super(RelationSchema, self).__init__(type)
+        self.final = objects[0] in FINAL_ETYPES
+        self.inlined = 'inlined' in options
+        self.symmetric = 'symmetric' in options
+        self._subjects = subjects
+        self._objects = objects
+        self.rdefs = {}
+        for subject in subjects:
+            for object in objects:
+                self.rdefs[(subject, object)] = RelationDefinition(
+                    subject, object, cardinality)
+
+    def associations(self):
+        return [(subject, self._objects) for subject in self._subjects]
+
+    def subjects(self, etype=None):
+        if etype is None or etype in self._objects:
+            return self._subjects
+        return ()
+
+    def objects(self, etype=None):
+        if etype is None or etype in self._subjects:
+            return self._objects
+        return ()
+
+
+class BenchSchema(object):
+
+    def __init__(self):
+        self._types = {}
+        for etype in FINAL_ETYPES + NONFINAL_ETYPES:
+            self._types[etype] = EntitySchema(etype)
+        for etype, specializations in ENTITY_TYPES.items():
+            self._types[etype]._specialized_by = [
+                self._types[spec] for spec in specializations]
+        self._relations = {}
+        for rtype, definition in RELATION_TYPES.items():
+            rschema = self._relations[rtype] = RelationSchema(rtype, *definition)
+            for subject in rschema._subjects:
+                self._types[subject]._destinations[rtype] = rschema._objects[0]
+
+    def entities(self):
+        return self._types.values()
+
+    def relations(self):
+        return self._relations.keys()
+
+    def has_entity(self, etype):
+        return etype in self._types
+
+    def has_relation(self, rtype):
+        return rtype in self._relations
+
+    def __contains__(self, ertype):
+        return self.has_entity(ertype) or self.has_relation(ertype)
+
+    def rschema(self, rtype):
+        return self._relations[rtype]
+
+    def eschema(self, etype):
+        return self._types[etype]
@@ -0,0 +1,113 @@
+# copyright 2004-2010 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This file is part of rql.
+#
+# rql is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# rql is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with rql. If not, see <http://www.gnu.org/licenses/>.
+"""Compare undo modes of syntax trees (see `Union.set_undo_mode`).
+
+Each select query of the corpus (data/bench_corpus.rql by default, one query per
+line) is parsed, annotated and solved, then a state is saved, a number of
+modifications (--edits) are done on each select and the state is recovered.
+Saving, modifying and recovering are timed separately for each undo mode, and
+medians are reported in microseconds per tree.
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+from timeit import default_timer
+
+from rql import RQLHelper
+from rql.nodes import Variable
+
+import bench_pyrql
+from bench_schema import BenchSchema
+
+MODES = ('operations', 'snapshot')
+PHASES = ('save', 'edit', 'recover')
+
+
+def edit(tree, nbedits):
+    """Modify selects of the tree: add (and remove every other time) eid
+    restrictions, change limit and offset.
+    """
+    for select in tree.children:
+        variables = [var for var in select.defined_vars.values()
+                     if isinstance(var, Variable)]
+        if not variables:
+            continue
+        for i in range(nbedits):
+            relation = select.add_eid_restriction(variables[i % len(variables)], i)
+            if i % 2:
+                select.remove_node(relation)
+            select.set_limit(i + 1)
+            select.set_offset(i)
+
+
+def run(helper, queries, mode, nbedits, rounds):
+    """Time the save / edit / recover phases in the given undo mode, return
+    median times by phase in microseconds.
+    """
+    timings = dict((phase, []) for phase in PHASES)
+    for _ in range(rounds):
+        for rqlstring in queries:
+            tree = helper.parse(rqlstring)
+            helper.compute_solutions(tree)
+            tree.set_undo_mode(mode)
+            steps = (('save', tree.save_state),
+                     ('edit', lambda: edit(tree, nbedits)),
+                     ('recover', tree.recover))
+            for phase, step in steps:
+                start = default_timer()
+                step()
+                timings[phase].append(default_timer() - start)
+    return dict((phase, bench_pyrql.percentile(
+        sorted(value * 1e6 for value in values), 50))
+        for phase, values in timings.items())
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0])
+    parser.add_argument('corpus', nargs='?', default=bench_pyrql.DEFAULT_CORPUS,
+                        help='file containing one RQL query per line')
+    parser.add_argument('-e', '--edits', type=int, nargs='+',
+                        default=[1, 10, 100],
+                        help='numbers of modifications done on each select')
+    parser.add_argument('-n', '--rounds', type=int, default=5,
+                        help='number of times the corpus is processed')
+    options = parser.parse_args(args)
+    helper = RQLHelper(BenchSchema(), None, {'eid': 'uid'})
+    with open(options.corpus) as stream:
+        queries = [line.strip() for line in stream if line.strip()]
+    # only select queries have an undo manager
+    queries = [rqlstring for rqlstring in
+               bench_pyrql.valid_queries(helper, queries)
+               if helper.parse(rqlstring).TYPE == 'select']
+    print('%s queries, %s rounds, median times in microseconds' % (
+        len(queries), options.rounds))
+    print('%-6s %-10s' % ('edits', 'mode')
+          + ''.join('%10s' % phase for phase in PHASES + ('total',)))
+    for nbedits in options.edits:
+        for mode in MODES:
+            stats = run(helper, queries, mode, nbedits, options.rounds)
+            print('%-6s %-10s' % (nbedits, mode)
+                  + ''.join('%10.1f' % stats[phase] for phase in PHASES)
+                  + '%10.1f' % sum(stats.values()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())